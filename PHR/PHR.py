@@ -2,7 +2,8 @@
 
 Usage:
     PHR.py
-    PHR.py kgc generate masterkey
+    PHR.py kgc generate masterkey [--curve=<curve>]
+    PHR.py kgc provision <identities> [--processes=<n>]
     PHR.py -h|--help
     PHR.py -v|--version
 Options:
@@ -11,40 +12,53 @@ Options:
     -l<user> --login=<user>         Login as user.
     -r<record> --record=<record>    Execute command for a specific public health record.
     -t<type> --type=<type>          Specify type of data.
+    --curve=<curve>                 Pairing curve, like SS512, MNT224 or BN254 (default $PHR_CURVE or SS512).
+    --processes=<n>                 Number of worker processes to generate keys with.
 """
 import os
+import secrets
 import sys
+import time
+from itertools import islice
 from pathlib import Path
-from subprocess import call
 
+import compression
+import envelope
+import instrumentation
+import layout
 import pairing_pickle
-from charm.core.math.pairing import GT
-from charm.toolbox.pairinggroup import PairingGroup, extract_key
-from charm.toolbox.symcrypto import SymmetricCryptoAbstraction
+import parallel
+import proxy_client
+import streaming
+from context import DEFAULT_CURVE, Context
 from docopt import docopt
-from json_helper import DataHelper, RecordAlreadyExists
-from type_id_proxy_reencryption import TIPRE
+from lazy_record import LazyRecord
+from storage import RecordAlreadyExists
 
 dir_path = os.path.dirname(os.path.realpath(__file__))
 
 kgc_path = Path('{}/keys/kgc'.format(dir_path))
-try:
-    kgc_path.mkdir(parents=True)
-except:
-    pass
 reencryption_path = Path('{}/keys/reencryption'.format(dir_path))
-try:
-    reencryption_path.mkdir(parents=True)
-except:
-    pass
-group = PairingGroup('SS512', secparam=1024)
-pre = TIPRE(group)
-data_helper = DataHelper(group)
+# The group, TIPRE and the stores, built when first used, see context.py. With
+# PHR_MEMO, the TIPRE memos are kept in that file between processes.
+context = Context(kgc_path, reencryption_path, memo_path=os.environ.get('PHR_MEMO'))
+# Wrap record keys under a KEK per (owner, type, epoch), see envelope.py
+envelope_mode = os.environ.get('PHR_ENVELOPE') == '1'
+
+
+def __getattr__(name):
+    # PHR.group, PHR.pre, ... are the ones of the context
+    if name in ('group', 'pre', 'data_helper', 'keystore', 'delegations', 'keks'):
+        return getattr(context, name)
+    raise AttributeError("module '{}' has no attribute '{}'".format(__name__, name))
 
 
 def SYMKEY(): return "enc_sym_key"
 
 
+def ORIGINAL(): return "original_record"
+
+
 def USER(user): return "user_{}".format(user)
 
 
@@ -54,63 +68,390 @@ def HOSPITAL(hospital): return "hospital_{}".format(hospital)
 def HEALTHCLUB(healthclub): return "healthclub_{}".format(healthclub)
 
 
-def kgc_generate_master():
-    master_secret_key, params = pre.setup()
+def kgc_generate_master(curve=None):
+    """
+    Generate the master key and the params of the KGC. The curve is recorded in
+    the params, later processes build their group on it.
+
+    :param curve:   Pairing curve, None for PHR_CURVE or SS512
+    """
+    context.configure(curve or os.environ.get('PHR_CURVE', DEFAULT_CURVE))
+    master_secret_key, params = context.pre.setup()
+    params = dict(params, curve=context.curve)
 
+    kgc_path.mkdir(parents=True, exist_ok=True)
     with (kgc_path / 'master_key').open(mode='wb') as f:
-        pairing_pickle.dump(group, master_secret_key, f)
+        pairing_pickle.dump(context.group, master_secret_key, f)
     with (kgc_path / 'params').open(mode='wb') as f:
-        pairing_pickle.dump(group, params, f)
+        pairing_pickle.dump(context.group, params, f)
 
 
-def kgc_generate_user(user_id: str):
+def user_key_path(user):
+    """
+    Path of the key of user, placed by layout.py
+    """
+    return layout.current().find(kgc_path, user)
+
+
+def reencryption_key_path(user, to_user, type_attribute):
+    """
+    Path of the reencryption key of user for to_user and type_attribute, placed by layout.py
+    """
+    return layout.current().find(reencryption_path, 'from_{}_to_{}_type_{}'.format(user, to_user, type_attribute))
+
+
+def has_user_key(user):
+    return context.user_keys.exists(user) or user_key_path(user).exists()
+
+
+def load_master_key():
     with (kgc_path / 'master_key').open(mode='rb') as f:
-        master_key = pairing_pickle.load(group, f)
+        return pairing_pickle.load(context.group, f)
+
+
+def kgc_generate_user(user_id: str):
+    master_key = load_master_key()
 
-    if (kgc_path / '{}'.format(user_id)).exists():
+    if has_user_key(user_id):
         print('User with this id is already registered in this KGC')
     else:
-        with (kgc_path / '{}'.format(user_id)).open(mode='wb') as f:
-            pairing_pickle.dump(group, pre.keyGen(master_key, user_id), f)
+        path = layout.current().path(kgc_path, user_id)
+        path.parent.mkdir(parents=True, exist_ok=True)
+        with path.open(mode='wb') as f:
+            pairing_pickle.dump(context.group, context.pre.keyGen(master_key, user_id), f)
+
+
+def generate_user_keys(master_key, identities):
+    """
+    :return:    List of (identity, key) tuples, the keys in the binary format
+    """
+    return [(identity, pairing_pickle.dump2(context.group, context.pre.keyGen(master_key, identity)))
+            for identity in identities]
+
+
+def kgc_provision(identities, processes=None, chunk_size=256):
+    """
+    Generate the keys of many identities, like the patients of a hospital, into
+    the provisioned keystore (see context.py). The master key is loaded once,
+    and the keys are generated in a pool of worker processes. Identities that
+    have a key already are skipped.
+
+    :param identities:  Iterable of identities, like user_alice
+    :param processes:   Number of worker processes, None to generate the keys in this process
+    :param chunk_size:  Number of identities per task
+    :return:            Number of generated keys
+    """
+    start = time.time()
+    master_key = load_master_key()
+    identities = iter(identities)
+    generated = skipped = 0
+
+    def pending():
+        nonlocal skipped
+        while True:
+            chunk = list(islice(identities, chunk_size))
+            if not chunk:
+                return
+            new = [identity for identity in chunk if not has_user_key(identity)]
+            skipped += len(chunk) - len(new)
+            if new:
+                yield new
+
+    if processes:
+        keys = parallel.generate_user_keys(context.group, master_key, pending(), processes)
+    else:
+        keys = (key for chunk in pending() for key in generate_user_keys(master_key, chunk))
+    with context.user_keys.durability.group():
+        for identity, key in keys:
+            try:
+                context.user_keys.write(identity, key)
+            except RecordAlreadyExists:
+                skipped += 1
+                continue
+            generated += 1
+
+    elapsed = time.time() - start
+    print('Generated {} keys in {:.1f}s ({:.1f} keys/s), skipped {} identities that have a key'.format(
+        generated, elapsed, generated / elapsed if elapsed else 0, skipped))
+    return generated
 
 
 def get_params():
-    with (kgc_path / 'params').open(mode='rb') as f:
-        return pairing_pickle.load(group, f)
+    return context.keystore.load(kgc_path / 'params')
+
+
+def get_user_key(user):
+    """
+    The key of user, from the provisioned keystore or its own key file
+    """
+    if context.user_keys.exists(user):
+        return context.keystore.load_entry(context.user_keys, user)
+    return context.keystore.load(user_key_path(user))
 
 
 def load_user_key(user):
-    print('Loading user key: {}'.format(kgc_path / user))
-    with (kgc_path / user).open(mode='rb') as f:
-        user_key = pairing_pickle.load(group, f)
-    return user_key
+    print('Loading user key: {}'.format(user))
+    with instrumentation.stage('load_key'):
+        return get_user_key(user)
 
 
-def read(user, record):
+def preload(users=()):
+    """
+    Load the params and the keys of users into the keystore, for long running
+    processes that serve many requests for the same users.
+    """
+    get_params()
+    for user in users:
+        get_user_key(user)
+
+
+def read(user, record, fields=None):
     """
     Function to read some public health record, from a given user. Returns
-    all parts of the record.
+    the columns of the record as a mapping that decrypts a column when it is
+    first accessed.
 
     :param user:      User public key that wants to read the health record
     :param record:    Public health record to be read
+    :param fields:    Columns to read, None for all columns
+    """
+
+    # Get the record from the file system
+    with instrumentation.stage('read.load'):
+        data = context.data_helper.load(user, record)
+    columns = {k: v for k, v in data.items() if k != SYMKEY() and (fields is None or k in fields)}
+
+    def open_key():
+        # Load the key and decrypt the symmetric key using the TIPRE key
+        user_key = load_user_key(user)
+        with instrumentation.stage('read.decrypt_key'):
+            sym_crypto_key = decrypt_key(get_params(), user, user_key, data[SYMKEY()])
+
+        # Setup symmetric crypto
+        from charm.toolbox.pairinggroup import extract_key
+        from charm.toolbox.symcrypto import SymmetricCryptoAbstraction
+        key = extract_key(sym_crypto_key)
+        return key, SymmetricCryptoAbstraction(key)
+
+    def decrypt(key, value):
+        with instrumentation.stage('read.decrypt_field'):
+            return decrypt_field(key[0], key[1], value)
+
+    # Decrypt the columns as they are accessed
+    return LazyRecord(columns, open_key, decrypt)
+
+
+def decrypt_records(params, user, user_key, names, fields=None):
     """
+    Load and decrypt records of user with keys that were loaded already. The
+    columns that were encrypted in chunks are left as blob references, see
+    read_all.
 
-    # Get the record from the file system and load the key
-    data = data_helper.load(user, record)
+    :return:    List of (symmetric key, columns) tuples, in the order of names
+    """
+    from charm.toolbox.pairinggroup import extract_key
+    from charm.toolbox.symcrypto import SymmetricCryptoAbstraction
+    decrypted = []
+    for name in names:
+        data = context.data_helper.load(user, name)
+        key = extract_key(decrypt_key(params, user, user_key, data[SYMKEY()]))
+        sym_crypto = SymmetricCryptoAbstraction(key)
+        decrypted.append((key, {k: v if streaming.is_reference(v) else decrypt_field(key, sym_crypto, v)
+                                for k, v in data.items()
+                                if k != SYMKEY() and (fields is None or k in fields)}))
+    return decrypted
+
+
+def read_all(user, fields=None, processes=None, chunk_size=64, **filters):
+    """
+    Read and decrypt all records of a user, or the records that match filters.
+    The keys are loaded once, and the records are decrypted in chunks, in a
+    pool of worker processes when processes is given.
+
+    :param user:        User that reads the records
+    :param fields:      Columns to read, None for all columns
+    :param processes:   Number of worker processes, None to decrypt in this process
+    :param chunk_size:  Number of records a worker decrypts at once
+    :param filters:     Filters of the metadata index, see MetadataIndex.list
+    :return:            Generator of (record, columns), in the order of the
+                        record names as soon as they are decrypted. Columns
+                        that were encrypted in chunks are file-like objects.
+    """
+    records = context.data_helper.list_records(user, **filters)
+    if not records:
+        return
+    names = [m.name for m in records]
     user_key = load_user_key(user)
+    params = get_params()
+    if processes and len(names) > chunk_size:
+        decrypted = parallel.decrypt_records(context.group, params, user, user_key, names, fields, processes,
+                                             chunk_size)
+    else:
+        decrypted = (r for i in range(0, len(names), chunk_size)
+                     for r in decrypt_records(params, user, user_key, names[i:i + chunk_size], fields))
+    for name, (key, columns) in zip(names, decrypted):
+        yield name, {k: decrypt_field(key, None, v) if streaming.is_reference(v) else v for k, v in columns.items()}
 
-    # Decrypt the symmetric key using the TIPRE key
-    sym_crypto_key = pre.decrypt(get_params(), user_key, data[SYMKEY()])
 
-    # Setup symmetric crypto
-    sym_crypto = SymmetricCryptoAbstraction(extract_key(sym_crypto_key))
+def decrypt_key(params, user, user_key, capsule):
+    """
+    Decrypt the symmetric key of a record, with TIPRE or, for records in
+    envelope mode, by unwrapping it with the KEK of its owner, type and epoch
+    """
+    if envelope.is_envelope(capsule):
+        kek = context.keks.open(context.pre, params, user, user_key, capsule['Owner'], capsule['C3'],
+                                capsule['Envelope'])
+        return context.keks.unwrap(kek, capsule['Wrapped'])
+    return context.pre.decrypt(params, user_key, capsule)
 
-    # Attempt to decrypt all columns and return
-    decrypted_record = {k: sym_crypto.decrypt(v) for k, v in data.items() if k != SYMKEY()}
-    return decrypted_record
 
+def rotate_kek(params, user, user_key, type_attribute):
+    """
+    Start a new epoch with a new KEK for the records of user with the given
+    type. The current delegatees get a reencryption key for the new epoch.
 
-def insert(user, data, record, type_attribute):
+    :return:    The new epoch
+    """
+    from charm.toolbox.pairinggroup import GT
+    epoch = context.keks.epoch(user, type_attribute) + 1
+    kek = context.group.random(GT)
+    # A concurrent process that started the same epoch first keeps its KEK,
+    # which is then loaded by KEKStore.open
+    if context.keks.save(user, user, type_attribute, epoch,
+                         context.pre.encrypt(params, user, kek, user_key, envelope.kek_type(type_attribute, epoch))):
+        context.keks.keks[(user, user, type_attribute, epoch)] = kek
+        for to_user in context.delegations.delegatees(user, type_attribute):
+            save_reencryption_key(params, user, user_key, to_user, envelope.kek_type(type_attribute, epoch))
+    context.keks.set_epoch(user, type_attribute, epoch)
+    return epoch
+
+
+def current_kek(params, user, user_key, type_attribute):
+    """
+    The current epoch and KEK of user for the type, the first epoch is started
+    when there is none yet
+    """
+    epoch = context.keks.epoch(user, type_attribute) or rotate_kek(params, user, user_key, type_attribute)
+    return epoch, context.keks.open(context.pre, params, user, user_key, user, type_attribute, epoch)
+
+
+def wraps_keys(user):
+    """
+    Whether the record keys of user are wrapped under a KEK, see envelope.py.
+    Only for users writing their own records: every patient of a hospital or
+    health club is a delegatee of its types, so they would all open the KEK of
+    a type and unwrap each other's records.
+    """
+    return envelope_mode and user.startswith(USER(''))
+
+
+def prepare_keks(params, user, user_key, types):
+    """
+    Start the first epochs of the types in this process, before records are
+    encrypted in worker processes that would otherwise start them concurrently
+    """
+    if wraps_keys(user):
+        for type_attribute in set(types):
+            current_kek(params, user, user_key, type_attribute)
+
+
+def encrypt_field(user, record, key, sym_crypto, value):
+    """
+    Encrypt one column. Large values and file-like objects are encrypted in
+    chunks into a blob, the record then holds a reference to the blob. With
+    PHR_COMPRESSION, values are compressed first, see compression.py.
+    """
+    codec = compression.codec()
+    if not streaming.is_stream(value):
+        compressed = compression.compress(codec, value)
+        if compressed is None:
+            return sym_crypto.encrypt(value)
+        return {'compressed': codec, 'ciphertext': sym_crypto.encrypt(compressed)}
+
+    name = '{}.{}'.format(record, secrets.token_hex(8))
+    with context.data_helper.blobs.create(user, name) as f:
+        size, chunks = streaming.encrypt_stream(key, value, f, codec=codec)
+    reference = {'stream': name, 'owner': user, 'size': size, 'chunks': chunks}
+    if codec is not None:
+        reference['compressed'] = codec
+    return reference
+
+
+def decrypt_field(key, sym_crypto, value):
+    """
+    Decrypt one column. Columns that were encrypted in chunks are returned as
+    a file-like object that decrypts the chunks as they are read.
+    """
+    if streaming.is_reference(value):
+        return streaming.DecryptedStream(key, context.data_helper.blobs.open(value['owner'], value['stream']),
+                                         value.get('compressed'))
+    if compression.is_compressed(value):
+        return compression.decompress(value['compressed'], sym_crypto.decrypt(value['ciphertext']))
+    return sym_crypto.decrypt(value)
+
+
+def discard_blobs(encrypted_data):
+    context.data_helper.discard_blobs(encrypted_data)
+
+
+def delete(user, record):
+    """
+    Delete a record. When it has reencrypted copies, its columns are kept
+    until the last copy is deleted.
+    """
+    context.data_helper.delete(user, record)
+    print("Record \'{}\' of \'{}\' is deleted".format(record, user))
+
+
+def check_insert(data, record):
+    if record is None:
+        sys.exit("Please provide the record")
+    for key in (SYMKEY(), ORIGINAL()):
+        if key in data:
+            sys.exit("Data contains the key {}, please use a different key".format(key))
+
+
+def encrypt_records(params, user, user_key, items):
+    """
+    Encrypt records of one writer. Every record gets a new symmetric key, which
+    is encrypted with TIPRE. Records of the same type share the TIPRE work for
+    (user, type). In envelope mode the key of a user's own record is wrapped
+    under the current KEK of (user, type) instead, see wraps_keys.
+
+    :param params:      Public parameters
+    :param user:        User that writes the records
+    :param user_key:    Secret key of this user
+    :param items:       List of (record, type_attribute, data) tuples
+    :return:            List of encrypted records, in the order of items
+    """
+    from charm.toolbox.pairinggroup import GT, extract_key
+    from charm.toolbox.symcrypto import SymmetricCryptoAbstraction
+    sym_crypto_keys = [context.group.random(GT) for _ in items]
+    encrypted_records = [None] * len(items)
+
+    by_type = {}
+    for idx, (_, type_attribute, _) in enumerate(items):
+        by_type.setdefault(type_attribute, []).append(idx)
+
+    for type_attribute, indices in by_type.items():
+        if wraps_keys(user):
+            epoch, kek = current_kek(params, user, user_key, type_attribute)
+            encrypted_sym_keys = [{'Envelope': epoch, 'Owner': user, 'C3': type_attribute,
+                                   'Wrapped': context.keks.wrap(kek, sym_crypto_keys[i])} for i in indices]
+        else:
+            encrypted_sym_keys = context.pre.encrypt_many(params, user, [sym_crypto_keys[i] for i in indices],
+                                                          user_key, type_attribute)
+        for idx, encrypted_sym_key in zip(indices, encrypted_sym_keys):
+            record, _, data = items[idx]
+            key = extract_key(sym_crypto_keys[idx])
+            sym_crypto = SymmetricCryptoAbstraction(key)
+            encrypted_data = {k: encrypt_field(user, record, key, sym_crypto, v) for k, v in data.items()}
+            encrypted_data[SYMKEY()] = encrypted_sym_key
+            encrypted_records[idx] = encrypted_data
+    return encrypted_records
+
+
+def insert(user, data, record, type_attribute, fan_out=False):
     """
     Insert data into a public health record.
 
@@ -118,34 +459,93 @@ def insert(user, data, record, type_attribute):
     :param data:            Data to be inserted
     :param record:          Public health record in which data is inserted.
     :param type_attribute:  The type for this record
+    :param fan_out:         Reencrypt the record for all delegatees of the user for this type. Only
+                            for users that write their own records: the delegatees of a hospital
+                            or health club of a type are all its patients.
 
     """
 
     # Check if some arguments are correct
-    if record is None:
-        sys.exit("Please provide the record")
-    if SYMKEY() in data:
-        sys.exit("Data contains the key {}, please use a different key".format(SYMKEY()))
+    check_insert(data, record)
 
     # Load the users key
     user_key = load_user_key(user)
 
-    # Create new symmetric key
-    sym_crypto_key = group.random(GT)
-    sym_crypto = SymmetricCryptoAbstraction(extract_key(sym_crypto_key))
-    # Encrypt symmetric key with TIPRE
-    # and the data using the symmetric key
-    encrypted_sym_key = pre.encrypt(get_params(), user, sym_crypto_key, user_key, type_attribute)
-    encrypted_data = {k: sym_crypto.encrypt(v) for k, v in data.items()}
-    encrypted_data[SYMKEY()] = encrypted_sym_key
+    # Encrypt the data with a new symmetric key, and the symmetric key with TIPRE
+    with instrumentation.stage('insert.encrypt'):
+        encrypted_data = encrypt_records(get_params(), user, user_key, [(record, type_attribute, data)])[0]
 
     # Store the data
     try:
-        data_helper.save(user, type_attribute, encrypted_data, record)
+        with instrumentation.stage('insert.save'):
+            context.data_helper.save(user, type_attribute, encrypted_data, record)
         print("Data is inserted into record \'{}\' by \'{}\'".format(record, user))
         print("Data to insert into record:\n{}".format(data))
     except RecordAlreadyExists as e:
+        discard_blobs(encrypted_data)
         print(e)
+        return
+
+    # Give the delegatees of the user for this type access to the new record
+    if fan_out:
+        with instrumentation.stage('insert.reencrypt'):
+            reencrypt_for_delegatees(user, {type_attribute: [record]})
+
+
+def insert_many(user, items, processes=None, fan_out=False):
+    """
+    Insert many records written by one user. The keys are loaded once and the
+    encryption can be spread over a pool of worker processes.
+
+    :param user:        User that wants to insert data
+    :param items:       Iterable of (record, type_attribute, data) tuples
+    :param processes:   Number of worker processes, None to encrypt in this process
+    :param fan_out:     Reencrypt the records for all delegatees of the user for their type, see insert
+    :return:            Names of the inserted records
+    """
+    items = list(items)
+    for record, _, data in items:
+        check_insert(data, record)
+
+    user_key = load_user_key(user)
+    params = get_params()
+    # Streamed columns are read from file-like objects, so they are encrypted in this process
+    streams = any(streaming.is_stream(v) for _, _, data in items for v in data.values())
+    with instrumentation.stage('insert_many.encrypt'):
+        if processes and len(items) > 1 and not streams:
+            prepare_keks(params, user, user_key, [type_attribute for _, type_attribute, _ in items])
+            encrypted_records = parallel.encrypt_records(context.group, params, user, user_key, items, processes)
+        else:
+            encrypted_records = encrypt_records(params, user, user_key, items)
+
+    inserted = []
+    records_by_type = {}
+    with context.data_helper.group_commit():
+        for (record, type_attribute, _), encrypted_data in zip(items, encrypted_records):
+            try:
+                with instrumentation.stage('insert_many.save'):
+                    context.data_helper.save(user, type_attribute, encrypted_data, record)
+                inserted.append(record)
+                records_by_type.setdefault(type_attribute, []).append(record)
+            except RecordAlreadyExists as e:
+                discard_blobs(encrypted_data)
+                print(e)
+    print("{} records are inserted by \'{}\'".format(len(inserted), user))
+    if fan_out:
+        with instrumentation.stage('insert_many.reencrypt'):
+            reencrypt_for_delegatees(user, records_by_type)
+    return inserted
+
+
+def save_reencryption_key(params, user, user_key, to_user, type_attribute):
+    """
+    Create a reencryption key for to_user and store it for the proxy
+    """
+    re_encryption_key = context.pre.rkGen(params, user_key, to_user, type_attribute)
+    path = layout.current().path(reencryption_path, 'from_{}_to_{}_type_{}'.format(user, to_user, type_attribute))
+    path.parent.mkdir(parents=True, exist_ok=True)
+    with path.open(mode='wb') as f:
+        pairing_pickle.dump(context.group, re_encryption_key, f)
 
 
 def allow_access(user, to_user, type_attribute):
@@ -159,11 +559,15 @@ def allow_access(user, to_user, type_attribute):
 
     # Load the users key and create a reencryption key for to_user
     key = load_user_key(user)
-    re_encryption_key = pre.rkGen(get_params(), key, to_user, type_attribute)
+    params = get_params()
+    with instrumentation.stage('allow_access.rkGen'):
+        save_reencryption_key(params, user, key, to_user, type_attribute)
 
-    # Store the reencryption key for the proxy
-    with (reencryption_path / 'from_{}_to_{}_type_{}'.format(user, to_user, type_attribute)).open(mode='wb') as f:
-        pairing_pickle.dump(group, re_encryption_key, f)
+        # and one for the KEK of the current epoch, when there is one
+        epoch = context.keks.epoch(user, type_attribute)
+        if epoch:
+            save_reencryption_key(params, user, key, to_user, envelope.kek_type(type_attribute, epoch))
+    context.delegations.add(user, type_attribute, to_user)
 
     print("{} has provided {} with read access to their Public Health Record".format(user, to_user))
 
@@ -181,25 +585,114 @@ def insert_with_proxy(from_user, to_user, data, record, type_attribute):
 
     """
 
-    # Insert in own record and create reencryption key for the proxy
+    # Insert in own record and create reencryption key for the proxy, unless
+    # to_user already has one for this type. Hospitals and health clubs have
+    # every patient as delegatee of the same types, so the record is only
+    # reencrypted for to_user instead of for all delegatees.
     insert(from_user, data, record, type_attribute)
-    allow_access(from_user, to_user, type_attribute)
+    if not context.delegations.has(from_user, type_attribute, to_user):
+        allow_access(from_user, to_user, type_attribute)
 
     # Call the proxy to reencrypt the just created ciphertext
-    arguments = "python3 proxy.py reencrypt {} {} -r {} -t {}".format(
-        from_user,
-        to_user,
-        record, type_attribute)
-    call(arguments.split(' '))
+    reencrypt_with_proxy(from_user, to_user, record, type_attribute)
 
 
-def select_file(user):
+def reencrypt_with_proxy(from_user, to_user, record, type_attribute):
+    """
+    Let the proxy service reencrypt a record of from_user for to_user. When the
+    proxy service is not running, the reencryption is done in this process.
+    """
+    try:
+        client = proxy_client.ProxyClient()
+        client.connect()
+    except OSError:
+        import proxy
+        try:
+            proxy.reEncrypt(from_user, to_user, record, type_attribute)
+        except RecordAlreadyExists as e:
+            print(e)
+        return
+
+    with client:
+        try:
+            client.reencrypt(from_user, to_user, record, type_attribute)
+        except proxy_client.ProxyError as e:
+            print(e)
+
+
+def reencrypt_for_delegatees(user, records_by_type):
+    """
+    Reencrypt new records of user for all delegatees of their type. Every
+    (type, delegatee) is one batch job for the proxy service, the jobs are sent
+    at once and run in its worker pool. When the proxy service is not running,
+    the batches are reencrypted in this process.
+
+    :param user:            The delegator
+    :param records_by_type: Dict of type to the names of the new records
+    :return:                Dict of delegatee to the names of the reencrypted records
+    """
+    jobs = [(type_attribute, to_user, records) for type_attribute, records in records_by_type.items()
+            for to_user in context.delegations.delegatees(user, type_attribute)]
+    if not jobs:
+        return {}
+
+    reencrypted = {}
+    try:
+        client = proxy_client.ProxyClient()
+        client.connect()
+    except OSError:
+        import proxy
+        for type_attribute, to_user, records in jobs:
+            reencrypted.setdefault(to_user, []).extend(proxy.reEncryptRecords(user, to_user, type_attribute, records))
+    else:
+        with client:
+            for type_attribute, to_user, records in jobs:
+                client.submit('reencrypt-records', from_user=user, to_user=to_user, type=type_attribute,
+                              records=records)
+            for (_, to_user, _), result in zip(jobs, client.results()):
+                if isinstance(result, proxy_client.ProxyError):
+                    print(result)
+                else:
+                    reencrypted.setdefault(to_user, []).extend(result)
+
+    for to_user, records in reencrypted.items():
+        print("{} records of \'{}\' are reencrypted for \'{}\'".format(len(records), user, to_user))
+    return reencrypted
+
+
+def list_records(user, type_attribute=None, writer=None, limit=None, offset=0):
+    """
+    Print the records of a user with their metadata, from the metadata index
+    instead of the records themselves.
+
+    :param user:            The user
+    :param type_attribute:  Only records of this type
+    :param writer:          Only records written by this user
+    :param limit:           Number of records to print, None for all
+    :param offset:          Number of records to skip
+    :return:                List of metadata.Metadata
+    """
+    records = context.data_helper.list_records(user, type_attribute=type_attribute, writer=writer, limit=limit,
+                                               offset=offset)
+    if records is None:
+        print('No data found for this entity')
+        return []
+    total = context.data_helper.metadata.count(user, type_attribute=type_attribute, writer=writer)
+    for m in records:
+        print('{}\t{}\t{}\t{}\t{}\t{}'.format(m.name, m.type, m.writer, m.reencrypted_from or '-', m.size,
+                                              time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(m.created))))
+    print('Records {}-{} of {}'.format(offset + 1 if records else offset, offset + len(records), total))
+    return records
+
+
+def select_file(user, fields=None):
     """
     Let the user select a file in its own records.
 
-    :param user: The user
+    :param user:    The user
+    :param fields:  Columns to read, None for all columns
     """
-    files = data_helper.get_data_files(user)
+    files = context.data_helper.get_data_files(user)
 
     for idx, val in enumerate(files):
         print("{}. {}".format(idx, val))
@@ -207,14 +700,18 @@ def select_file(user):
     if n < 0 or n >= len(files):
         sys.exit("Please enter a correct number")
     print("\nSelected file {}\n".format(files[n]))
-    return read(user, files[n])
+    return read(user, files[n], fields)
 
 
 if __name__ == '__main__':
     arguments = docopt(__doc__, version='0.1')
     if arguments['kgc'] and arguments['masterkey']:
-        kgc_generate_master()
+        kgc_generate_master(arguments['--curve'])
+    elif arguments['kgc'] and arguments['provision']:
+        with open(arguments['<identities>']) as f:
+            kgc_provision((line.strip() for line in f if line.strip()),
+                          int(arguments['--processes']) if arguments['--processes'] else None)
     elif arguments['kgc'] and arguments['userkey'] and arguments['<user_id>']:
         kgc_generate_user(arguments['<user_id>'])
     else:
-        print(__doc__)
\ No newline at end of file
+        print(__doc__)
@@ -0,0 +1,218 @@
+"""
+asyncio API for reading, inserting and delegating records, for services that
+serve many requests from one event loop. The pairing work runs in a pool of
+worker processes and the storage I/O in a pool of threads, so the event loop
+only schedules. Group elements can't be pickled, so they are sent to the
+workers in serialized form (see pairing_pickle) and the workers load the keys
+they need into their own keystore.
+
+Every request holds a slot of a bounded number of requests in flight, and a
+slot of its tenant (by default the user of the request). When all slots are
+taken, new requests wait, so a burst of one tenant can't take all workers.
+The storage calls for one user are serialized, like the requests of one
+process would be.
+"""
+import asyncio
+import threading
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+
+import pairing_pickle
+from charm.toolbox.pairinggroup import extract_key
+from charm.toolbox.symcrypto import SymmetricCryptoAbstraction
+
+import PHR
+import proxy
+
+
+def _decrypt_key(user, capsule):
+    """
+    The symmetric key of a record capsule, as bytes
+    """
+    capsule = pairing_pickle.deserialize(PHR.group, capsule)
+    user_key = PHR.get_user_key(user)
+    return extract_key(PHR.decrypt_key(PHR.get_params(), user, user_key, capsule))
+
+
+def _encrypt_records(user, items):
+    """
+    The records of items encrypted by user, in the binary format
+    """
+    user_key = PHR.get_user_key(user)
+    return [pairing_pickle.dump2(PHR.group, r) for r in PHR.encrypt_records(PHR.get_params(), user, user_key, items)]
+
+
+def _reencrypt_capsule(user, to_user, type_attribute, capsule):
+    """
+    A capsule of user reencrypted for to_user, None when to_user has no access
+    to its epoch
+    """
+    params = PHR.get_params()
+    capsule = pairing_pickle.deserialize(PHR.group, capsule)
+    if PHR.envelope.is_envelope(capsule):
+        if not proxy.reencrypt_kek(params, user, to_user, capsule['C3'], capsule['Envelope']):
+            return None
+        return pairing_pickle.serialize(PHR.group, capsule)
+    re_encryption_key = proxy.load_reencryption_key(user, to_user, type_attribute)
+    return pairing_pickle.serialize(PHR.group, PHR.pre.reEncrypt(params, re_encryption_key, capsule))
+
+
+def _allow_access(user, to_user, type_attribute):
+    PHR.allow_access(user, to_user, type_attribute)
+
+
+class AsyncPHR:
+
+    def __init__(self, processes=None, threads=None, max_requests=256, per_tenant=16, user_locks=64):
+        """
+        :param processes:       Worker processes for the pairing work, defaults to the number of cores
+        :param threads:         Threads for the storage I/O
+        :param max_requests:    Requests in flight, further requests wait
+        :param per_tenant:      Requests in flight per tenant
+        :param user_locks:      Locks the users are spread over to serialize their storage calls
+        """
+        self.processes = ProcessPoolExecutor(processes)
+        self.threads = ThreadPoolExecutor(threads)
+        self.max_requests = max_requests
+        self.per_tenant = per_tenant
+        self._requests = None
+        # Tenant to [semaphore, requests], only for tenants with requests in flight
+        self._tenants = {}
+        self._users = [threading.Lock() for _ in range(user_locks)]
+        self._keks = threading.Lock()
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc):
+        self.close()
+
+    def close(self):
+        self.processes.shutdown()
+        self.threads.shutdown()
+
+    def _slot(self, tenant):
+        if self._requests is None:
+            self._requests = asyncio.Semaphore(self.max_requests)
+        slot = self._tenants.get(tenant)
+        if slot is None:
+            slot = self._tenants[tenant] = [asyncio.Semaphore(self.per_tenant), 0]
+        slot[1] += 1
+        return slot[0]
+
+    def _release(self, tenant):
+        # The semaphore of a tenant is dropped with its last request, so there
+        # is one per tenant with requests in flight instead of one per tenant ever seen
+        slot = self._tenants[tenant]
+        slot[1] -= 1
+        if not slot[1]:
+            del self._tenants[tenant]
+
+    async def _run(self, tenant, pool, function, *args):
+        slot = self._slot(tenant)
+        try:
+            async with slot, self._requests:
+                return await asyncio.get_running_loop().run_in_executor(pool, function, *args)
+        finally:
+            self._release(tenant)
+
+    def _cpu(self, tenant, function, *args):
+        return self._run(tenant, self.processes, function, *args)
+
+    def _io(self, tenant, function, *args):
+        return self._run(tenant, self.threads, function, *args)
+
+    def _locked(self, user, function, *args):
+        with self._users[hash(user) % len(self._users)]:
+            return function(*args)
+
+    def _storage(self, tenant, user, function, *args):
+        """
+        Run a storage call for user in the thread pool, one at a time per user
+        """
+        return self._io(tenant, self._locked, user, function, *args)
+
+    def _prepare_keks(self, user, type_attribute):
+        # Concurrent first inserts of a type would otherwise start its first epoch more than once
+        with self._keks:
+            PHR.prepare_keks(PHR.get_params(), user, PHR.get_user_key(user), [type_attribute])
+
+    async def read(self, user, record, fields=None, tenant=None):
+        """
+        Read and decrypt a record.
+
+        :param user:    User that reads the record
+        :param record:  Name of the record
+        :param fields:  Columns to decrypt, None for all columns
+        :return:        Dict of column to value, streamed columns are file-like objects
+        """
+        tenant = tenant or user
+        data = await self._storage(tenant, user, PHR.data_helper.load, user, record)
+        capsule = pairing_pickle.serialize(PHR.group, data[PHR.SYMKEY()])
+        key = await self._cpu(tenant, _decrypt_key, user, capsule)
+
+        def decrypt():
+            sym_crypto = SymmetricCryptoAbstraction(key)
+            return {k: PHR.decrypt_field(key, sym_crypto, v) for k, v in data.items()
+                    if k != PHR.SYMKEY() and (fields is None or k in fields)}
+
+        return await self._io(tenant, decrypt)
+
+    async def insert(self, user, data, record, type_attribute, fan_out=False, tenant=None):
+        """
+        Encrypt and store a record, and with fan_out reencrypt it for the
+        delegatees of the user for its type (see PHR.insert). Values must be
+        str or bytes.
+
+        :return:    Dict of delegatee to the names of the reencrypted records
+        """
+        tenant = tenant or user
+        if record is None:
+            raise ValueError('Please provide the record')
+        for key in (PHR.SYMKEY(), PHR.ORIGINAL()):
+            if key in data:
+                raise ValueError('Data contains the key {}, please use a different key'.format(key))
+
+        if PHR.wraps_keys(user):
+            await self._storage(tenant, user, self._prepare_keks, user, type_attribute)
+        payload, = await self._cpu(tenant, _encrypt_records, user, [(record, type_attribute, data)])
+        try:
+            await self._storage(tenant, user, PHR.data_helper.write, user, type_attribute, payload, record)
+        except PHR.RecordAlreadyExists:
+            PHR.discard_blobs(pairing_pickle.loadb(None, payload))
+            raise
+        if not fan_out:
+            return {}
+
+        delegatees = await self._io(tenant, PHR.delegations.delegatees, user, type_attribute)
+        results = await asyncio.gather(*(self.reencrypt(user, to_user, record, type_attribute, tenant)
+                                         for to_user in delegatees))
+        return {to_user: [record] for to_user, name in zip(delegatees, results) if name is not None}
+
+    async def allow_access(self, user, to_user, type_attribute, tenant=None):
+        """
+        Create a reencryption key of user for to_user and the type
+        """
+        await self._cpu(tenant or user, _allow_access, user, to_user, type_attribute)
+
+    async def reencrypt(self, user, to_user, record, type_attribute, tenant=None):
+        """
+        Reencrypt a record of user for to_user, like the proxy.
+
+        :return:    Name of the reencrypted record, None when to_user is not a
+                    delegatee of user for the type or has no access to the
+                    epoch of the record
+        """
+        tenant = tenant or user
+        # Before the record is loaded, so a user without a delegation costs no storage or pairing work
+        if not await self._io(tenant, PHR.delegations.has, user, type_attribute, to_user):
+            return None
+        data = await self._storage(tenant, user, PHR.data_helper.load, user, record)
+        capsule = await self._cpu(tenant, _reencrypt_capsule, user, to_user, type_attribute,
+                                  pairing_pickle.serialize(PHR.group, data[PHR.SYMKEY()]))
+        if capsule is None:
+            return None
+        copy = {PHR.SYMKEY(): pairing_pickle.deserialize(PHR.group, capsule),
+                PHR.ORIGINAL(): {'owner': user, 'record': record}}
+        name = proxy.reencryption_name(user, record)
+        await self._storage(tenant, to_user, PHR.data_helper.save, to_user, type_attribute, copy, name, user, record)
+        return name
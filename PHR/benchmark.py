@@ -0,0 +1,241 @@
+"""Benchmarks of the startup, the TIPRE primitives, pairing_pickle and the storage backends
+
+Usage:
+    benchmark.py run [-c <curve>]... [-n <iterations>] [-s <size>]... [-r <records>]... [-b <backend>]... [-k <runs>] [-o <file>] [--baseline <file>] [--threshold <percent>]
+    benchmark.py compare <baseline> <result> [--threshold <percent>]
+    benchmark.py -h|--help
+
+Options:
+    -h --help                   Show this screen.
+    -c <curve>                  Pairing curve to benchmark [default: SS512].
+    -n <iterations>             Iterations of every operation [default: 100].
+    -s <size>                   Record size in bytes [default: 64 4096 1048576].
+    -r <records>                Number of records to store [default: 1 1000].
+    -b <backend>                Storage backend [default: file segment].
+    -k <runs>                   Runs of the cold start benchmarks, in new processes [default: 5].
+    -o <file>                   Write the results as JSON to this file.
+    --baseline <file>           Compare the results with earlier results.
+    --threshold <percent>       Slowdown of the median to report as a regression [default: 10].
+
+Every result has the latency distribution (seconds) and the operations per second. The
+exit status of run --baseline and compare is 1 when there are regressions.
+"""
+import json
+import os
+import platform
+import subprocess
+import sys
+import tempfile
+import time
+
+import pairing_pickle
+import storage
+from charm.toolbox.pairinggroup import GT, PairingGroup, extract_key
+from charm.toolbox.symcrypto import SymmetricCryptoAbstraction
+from context import Context
+from docopt import docopt
+from json_helper import DataHelper
+from type_id_proxy_reencryption import TIPRE
+
+
+def summarize(samples):
+    """
+    Latency distribution and throughput of the durations of an operation
+    """
+    samples = sorted(samples)
+    total = sum(samples)
+
+    def percentile(p):
+        return samples[min(len(samples) - 1, int(p / 100 * len(samples)))]
+
+    return {
+        'count': len(samples),
+        'mean': total / len(samples),
+        'min': samples[0],
+        'p50': percentile(50),
+        'p90': percentile(90),
+        'p99': percentile(99),
+        'max': samples[-1],
+        'ops_per_sec': len(samples) / total if total else None,
+    }
+
+
+def measure(operation, iterations):
+    """
+    Run operation(i) for every iteration i and summarize the durations. The
+    result of the last run is returned as well, for the next benchmarks.
+    """
+    samples = []
+    result = None
+    for i in range(iterations):
+        start = time.perf_counter()
+        result = operation(i)
+        samples.append(time.perf_counter() - start)
+    return summarize(samples), result
+
+
+dir_path = os.path.dirname(os.path.realpath(__file__))
+
+# Builds the group and TIPRE of the curve in argv[1] in a new process
+_COLD_START = '''
+import sys, tempfile
+from pathlib import Path
+from context import Context
+with tempfile.TemporaryDirectory() as path:
+    Context(Path(path), Path(path), sys.argv[1]).pre
+'''
+
+
+def run_process(args):
+    subprocess.run([sys.executable] + args, cwd=dir_path, stdout=subprocess.DEVNULL, check=True)
+
+
+def bench_startup(curve, iterations, runs):
+    """
+    The time to build the group and TIPRE of a curve, in this process and in a
+    new process (including the interpreter and the imports)
+    """
+    results = {}
+    results['context'], _ = measure(lambda i: Context(None, None, curve).pre, iterations)
+    results['process'], _ = measure(lambda i: run_process(['-c', _COLD_START, curve]), runs)
+    return results
+
+
+def bench_tipre(group, iterations):
+    pre = TIPRE(group)
+    results = {}
+    results['setup'], (msk, params) = measure(lambda i: pre.setup(), iterations)
+    results['keyGen'], _ = measure(lambda i: pre.keyGen(msk, 'bench_{}'.format(i)), iterations)
+
+    alice, bob = pre.keyGen(msk, 'alice'), pre.keyGen(msk, 'bob')
+    messages = [group.random(GT) for _ in range(iterations)]
+    results['encrypt'], _ = measure(lambda i: pre.encrypt(params, 'alice', messages[i], alice, 'type'), iterations)
+    ciphertexts = [pre.encrypt(params, 'alice', m, alice, 'type') for m in messages]
+    results['rkGen'], rk = measure(lambda i: pre.rkGen(params, alice, 'bob', 'type'), iterations)
+    results['reEncrypt'], _ = measure(lambda i: pre.reEncrypt(params, rk, ciphertexts[i]), iterations)
+    reencrypted = [pre.reEncrypt(params, rk, c) for c in ciphertexts]
+    results['decrypt'], _ = measure(lambda i: pre.decrypt(params, alice, ciphertexts[i]), iterations)
+    results['decrypt_reencrypted'], _ = measure(lambda i: pre.decrypt(params, bob, reencrypted[i]), iterations)
+    return results, pre, params, alice
+
+
+def encrypted_record(group, pre, params, user_key, size):
+    """
+    A record as PHR.insert stores it, with one column of size bytes
+    """
+    key = group.random(GT)
+    record = {'data': SymmetricCryptoAbstraction(extract_key(key)).encrypt(os.urandom(size))}
+    record['enc_sym_key'] = pre.encrypt(params, 'alice', key, user_key, 'type')
+    return record
+
+
+def bench_pairing_pickle(group, record, iterations):
+    results = {}
+    for name, binary in (('binary', True), ('json', False)):
+        results['dump2/' + name], data = measure(lambda i: pairing_pickle.dump2(group, record, binary), iterations)
+        results['load2/' + name], _ = measure(lambda i: pairing_pickle.load2(group, data), iterations)
+        results['bytes/' + name] = len(data)
+    return results
+
+
+def bench_storage(group, backend_name, record, records, iterations):
+    results = {}
+    with tempfile.TemporaryDirectory() as path:
+        backend = storage.BACKENDS[backend_name]('{}/'.format(path))
+        data_helper = DataHelper(group, backend)
+        results['save'], _ = measure(lambda i: data_helper.save('bench', 'type', record, 'record_{}'.format(i)),
+                                     records)
+        results['list'], _ = measure(lambda i: data_helper.get_data_files('bench'), iterations)
+        results['load'], _ = measure(lambda i: data_helper.load('bench', 'record_{}'.format(i % records)),
+                                     iterations)
+    return results
+
+
+def run(curves, iterations, sizes, counts, backends, runs):
+    results = {}
+    # Commands that don't need the pairing group, like help, don't build it
+    results['startup/help'], _ = measure(lambda i: run_process(['user.py']), runs)
+    for curve in curves:
+        print('Benchmarking the startup on {}'.format(curve), file=sys.stderr)
+        for name, result in bench_startup(curve, min(iterations, 10), runs).items():
+            results['{}/startup/{}'.format(curve, name)] = result
+
+        group = PairingGroup(curve)
+        print('Benchmarking TIPRE on {}'.format(curve), file=sys.stderr)
+        tipre, pre, params, user_key = bench_tipre(group, iterations)
+        for name, result in tipre.items():
+            results['{}/tipre/{}'.format(curve, name)] = result
+
+        for size in sizes:
+            print('Benchmarking records of {} bytes on {}'.format(size, curve), file=sys.stderr)
+            record = encrypted_record(group, pre, params, user_key, size)
+            for name, result in bench_pairing_pickle(group, record, iterations).items():
+                results['{}/pairing_pickle/{}/{}'.format(curve, size, name)] = result
+            for backend in backends:
+                for count in counts:
+                    for name, result in bench_storage(group, backend, record, count, iterations).items():
+                        results['{}/storage/{}/{}/{}/{}'.format(curve, backend, size, count, name)] = result
+    return {
+        'meta': {
+            'time': time.strftime('%Y-%m-%dT%H:%M:%S'),
+            'python': platform.python_version(),
+            'platform': platform.platform(),
+            'iterations': iterations,
+            'cold_start_runs': runs,
+        },
+        'results': results,
+    }
+
+
+def report(results):
+    for name, result in sorted(results['results'].items()):
+        if isinstance(result, dict):
+            print('{:70} {:>12.1f} ops/s  p50 {:>10.3f} ms  p99 {:>10.3f} ms'.format(
+                name, result['ops_per_sec'] or float('inf'), result['p50'] * 1000, result['p99'] * 1000))
+        else:
+            print('{:70} {:>12} bytes'.format(name, result))
+
+
+def compare(baseline, results, threshold):
+    """
+    Compare the medians of results with a baseline.
+
+    :param threshold:   Slowdown in percent from which a result is a regression
+    :return:            Names of the regressed results
+    """
+    regressions = []
+    for name, result in sorted(results['results'].items()):
+        before = baseline['results'].get(name)
+        if not isinstance(result, dict) or not isinstance(before, dict):
+            continue
+        change = (result['p50'] / before['p50'] - 1) * 100 if before['p50'] else 0
+        regressed = change > threshold
+        if regressed:
+            regressions.append(name)
+        print('{:70} {:>10.3f} ms -> {:>10.3f} ms  {:>+7.1f}%{}'.format(
+            name, before['p50'] * 1000, result['p50'] * 1000, change, '  REGRESSION' if regressed else ''))
+    print('{} regressions'.format(len(regressions)))
+    return regressions
+
+
+def load(path):
+    with open(path) as f:
+        return json.load(f)
+
+
+if __name__ == '__main__':
+    arguments = docopt(__doc__, version='0.1')
+    threshold = float(arguments['--threshold'])
+    if arguments['run']:
+        results = run(arguments['-c'], int(arguments['-n']), [int(s) for s in arguments['-s']],
+                      [int(r) for r in arguments['-r']], arguments['-b'], int(arguments['-k']))
+        if arguments['-o']:
+            with open(arguments['-o'], 'w') as f:
+                json.dump(results, f, indent=2)
+        report(results)
+        if arguments['--baseline']:
+            sys.exit(1 if compare(load(arguments['--baseline']), results, threshold) else 0)
+    elif arguments['compare']:
+        sys.exit(1 if compare(load(arguments['<baseline>']), load(arguments['<result>']), threshold) else 0)
+    else:
+        print(__doc__)
@@ -0,0 +1,189 @@
+"""
+Bulk import of records written by a hospital or health club for their
+patients. Rows are read from JSONL or CSV files and go through a pipeline:
+parse, encrypt (and reencrypt for the patient) in a pool of worker processes,
+then write both copies in batches. One reencryption key is used per
+(patient, type).
+
+JSONL rows look like {"patient": ..., "type": ..., "record": ..., "fields": {...}}.
+CSV files have the columns patient, type and record, the other columns are the
+fields of the record.
+"""
+import csv
+import json
+import time
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+
+import parallel
+import proxy
+
+import PHR
+
+# Columns every CSV file has, the other columns are fields
+CSV_COLUMNS = ('patient', 'type', 'record')
+
+
+def read_rows(path):
+    """
+    Yield (patient, type, record, fields) rows of a JSONL or CSV file. Field
+    values that are not strings, like numbers in JSONL, are stored as their
+    JSON text.
+    """
+    with open(path, newline='') as f:
+        if path.endswith('.csv'):
+            reader = csv.DictReader(f)
+            check_header(path, reader.fieldnames)
+            for row in reader:
+                patient, type_attribute, record = row.pop('patient'), row.pop('type'), row.pop('record')
+                fields = {k: v for k, v in row.items() if v}
+                yield patient, type_attribute, record, check_fields(path, reader.line_num, fields)
+        else:
+            for line, text in enumerate(f, 1):
+                if text.strip():
+                    row = json.loads(text)
+                    yield row['patient'], row['type'], row['record'], check_fields(path, line, row['fields'])
+
+
+def check_header(path, header):
+    """
+    Check the header of a CSV file once, before its rows are read
+
+    :raise ValueError:  When the header misses one of CSV_COLUMNS
+    """
+    missing = [column for column in CSV_COLUMNS if column not in (header or [])]
+    if missing:
+        raise ValueError('{}:{}: Header misses the columns {}'.format(path, 1, ', '.join(missing)))
+
+
+def check_headers(files):
+    """
+    Check the headers of the CSV files among files, so a bad file stops the
+    import before any record is written
+    """
+    for path in files:
+        if path.endswith('.csv'):
+            with open(path, newline='') as f:
+                check_header(path, next(csv.reader(f), None))
+
+
+def check_fields(path, line, fields):
+    """
+    The fields of a row, like PHR.check_insert checks the data of a record
+
+    :raise ValueError:  When a field has the name of a key PHR stores in a record
+    """
+    for key in (PHR.SYMKEY(), PHR.ORIGINAL()):
+        if key in fields:
+            raise ValueError('{}:{}: Fields contain the key {}, please use a different key'.format(path, line, key))
+    return {k: v if isinstance(v, str) else json.dumps(v) for k, v in fields.items()}
+
+
+def batches(rows, batch_size):
+    batch = []
+    for row in rows:
+        batch.append(row)
+        if len(batch) == batch_size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+
+def encrypt_rows(params, writer, writer_key, rows, re_encryption_keys):
+    """
+    Encrypt rows for the writer and reencrypt them for the patients.
+
+    :param rows:                List of (record, type_attribute, data, to_user) tuples
+    :param re_encryption_keys:  Dict of (to_user, type_attribute) to reencryption key
+    :return:                    List of (encrypted record, reencrypted copy) tuples
+    """
+    encrypted_records = PHR.encrypt_records(params, writer, writer_key, [row[:3] for row in rows])
+    return [(encrypted, proxy.reencrypted_copy(params, re_encryption_keys[(to_user, type_attribute)], encrypted,
+                                               writer, record))
+            for (record, type_attribute, _, to_user), encrypted in zip(rows, encrypted_records)]
+
+
+def re_encryption_key(writer, to_user, type_attribute):
+    """
+    The reencryption key of writer for (to_user, type), created if it doesn't
+    exist yet. The records of a writer are not in envelope mode (see
+    PHR.wraps_keys), so there is no KEK to reencrypt.
+    """
+    if not PHR.delegations.has(writer, type_attribute, to_user):
+        PHR.allow_access(writer, to_user, type_attribute)
+    return proxy.load_reencryption_key(writer, to_user, type_attribute)
+
+
+def bulk_import(writer, files, processes=None, batch_size=500):
+    """
+    Import the rows of files as records of writer, readable by the patients.
+
+    :param writer:      The hospital or health club, e.g. PHR.HOSPITAL(name)
+    :param files:       JSONL or CSV files
+    :param processes:   Number of worker processes, None to encrypt in this process
+    :param batch_size:  Number of rows per batch
+    :return:            Number of imported records
+    """
+    check_headers(files)
+    start = time.time()
+    params = PHR.get_params()
+    writer_key = PHR.load_user_key(writer)
+    re_encryption_keys = {}
+    pool = ProcessPoolExecutor(processes) if processes else None
+    pending = deque()
+    imported = skipped = 0
+
+    def write(batch, encrypted):
+        nonlocal imported, skipped
+        # One round of fsyncs per batch, see storage.Durability
+        with PHR.data_helper.group_commit():
+            for (record, type_attribute, _, to_user), (encrypted_data, copy) in zip(batch, encrypted):
+                try:
+                    PHR.data_helper.save(writer, type_attribute, encrypted_data, record)
+                except PHR.RecordAlreadyExists:
+                    PHR.discard_blobs(encrypted_data)
+                    skipped += 1
+                    continue
+                try:
+                    PHR.data_helper.save(to_user, type_attribute, copy, proxy.reencryption_name(writer, record),
+                                         writer, record)
+                except PHR.RecordAlreadyExists:
+                    pass
+                imported += 1
+        elapsed = time.time() - start
+        print('{} records imported, {} skipped ({:.1f} records/s)'.format(
+            imported, skipped, imported / elapsed if elapsed else 0))
+
+    try:
+        rows = (row for path in files for row in read_rows(path))
+        for batch in batches(rows, batch_size):
+            batch = [('patient_{}_{}_{}'.format(patient, type_attribute, record), type_attribute, fields,
+                      PHR.USER(patient)) for patient, type_attribute, record, fields in batch]
+            keys = {}
+            for _, type_attribute, _, to_user in batch:
+                if (to_user, type_attribute) not in re_encryption_keys:
+                    re_encryption_keys[(to_user, type_attribute)] = re_encryption_key(writer, to_user, type_attribute)
+                keys[(to_user, type_attribute)] = re_encryption_keys[(to_user, type_attribute)]
+
+            if pool is None:
+                write(batch, encrypt_rows(params, writer, writer_key, batch, keys))
+                continue
+
+            # Encrypt the next batches while the earlier ones are written
+            pending.append((batch, parallel.submit_import(pool, PHR.group, params, writer, writer_key, batch, keys,
+                                                          processes)))
+            while len(pending) > 2:
+                batch, futures = pending.popleft()
+                write(batch, parallel.collect_import(PHR.group, futures))
+        while pending:
+            batch, futures = pending.popleft()
+            write(batch, parallel.collect_import(PHR.group, futures))
+    finally:
+        if pool is not None:
+            pool.shutdown()
+
+    elapsed = time.time() - start
+    print('Imported {} records in {:.1f}s ({:.1f} records/s), skipped {} existing records'.format(
+        imported, elapsed, imported / elapsed if elapsed else 0, skipped))
+    return imported
@@ -0,0 +1,81 @@
+"""
+Compression of record fields before they are encrypted. Clinical notes, JSON
+and lab reports compress well, but not once they are encrypted.
+
+The codec is chosen with the environment variable PHR_COMPRESSION: zlib, lzma
+or zstd (needs the zstandard package). Fields smaller than
+COMPRESSION_THRESHOLD, and fields that don't get smaller, are stored as they
+are. A compressed field is stored as {'compressed': <codec>, 'ciphertext': ...},
+and a streamed field (see streaming.py) that was compressed chunk by chunk has
+the codec in its reference, so records are read with the codec they were
+written with, whatever PHR_COMPRESSION is at that time.
+
+Compression happens inside the symmetric encryption, so reencrypted copies,
+which only get a new capsule, read the same fields.
+"""
+import lzma
+import os
+import zlib
+
+COMPRESSION_THRESHOLD = 1024
+
+
+def _zstd():
+    import zstandard
+    return zstandard
+
+
+_COMPRESS = {
+    'zlib': lambda data: zlib.compress(data, 6),
+    'lzma': lambda data: lzma.compress(data, preset=1),
+    'zstd': lambda data: _zstd().ZstdCompressor(level=3).compress(data),
+}
+_DECOMPRESS = {
+    'zlib': zlib.decompress,
+    'lzma': lzma.decompress,
+    'zstd': lambda data: _zstd().ZstdDecompressor().decompress(data),
+}
+
+
+def codec():
+    """
+    The codec to compress new fields with, None when compression is off
+    """
+    name = os.environ.get('PHR_COMPRESSION') or None
+    if name is not None and name not in _COMPRESS:
+        raise ValueError('Unknown compression codec {}, choose one of {}'.format(name, ', '.join(_COMPRESS)))
+    return name
+
+
+def is_compressed(value):
+    return isinstance(value, dict) and 'compressed' in value
+
+
+def compress(codec, value):
+    """
+    Compress a field value with codec
+
+    :return:    The compressed bytes, None when value is too small or doesn't get smaller
+    """
+    if codec is None or not isinstance(value, (str, bytes)) or len(value) < COMPRESSION_THRESHOLD:
+        return None
+    if isinstance(value, str):
+        value = value.encode('utf-8')
+    compressed = _COMPRESS[codec](value)
+    return compressed if len(compressed) < len(value) else None
+
+
+def compress_chunk(codec, chunk):
+    """
+    Compress a chunk of a streamed field. Chunks are always compressed, so the
+    reader doesn't need to know which were.
+    """
+    return chunk if codec is None else _COMPRESS[codec](chunk)
+
+
+def decompress(codec, data):
+    if codec is None:
+        return data
+    if codec not in _DECOMPRESS:
+        raise ValueError('Unknown compression codec {}'.format(codec))
+    return _DECOMPRESS[codec](data)
@@ -0,0 +1,136 @@
+"""
+The shared state of PHR: the pairing group, the TIPRE instance and the stores
+of records, keys, delegations and KEKs. Everything is built when it is first
+used, so commands that don't encrypt or decrypt (help, listing records) don't
+load the pairing library at all.
+
+The curve of the group is the one recorded in the params of the KGC. Before the
+KGC has params, it is taken from the environment variable PHR_CURVE, or
+SS512. Params written before the curve was recorded are SS512.
+
+With a memo path, the public TIPRE memos (see TIPRE.dump_memo) are loaded when
+TIPRE is built and written back when the process exits, so the next process
+doesn't hash and pair the same identities again.
+"""
+import atexit
+import os
+import pickle
+from functools import cached_property
+from pathlib import Path
+
+import envelope
+import pairing_pickle
+from delegations import DelegationIndex
+from json_helper import DataHelper
+from keystore import KeyStore
+from storage import Segments
+
+DEFAULT_CURVE = 'SS512'
+# Size of the segments of the provisioned user keys
+KEYS_SEGMENT_SIZE = 64 * 1024 * 1024
+
+
+def params_curve(path):
+    """
+    The curve recorded in a params file, without loading its group elements
+
+    :return:    Name of the curve, None when there are no params yet
+    """
+    try:
+        with open(path, 'rb') as f:
+            data = f.read()
+    except FileNotFoundError:
+        return None
+    if not data.startswith(pairing_pickle.MAGIC):
+        return DEFAULT_CURVE
+    return pairing_pickle.loadb(None, data).get('curve', DEFAULT_CURVE)
+
+
+class Context:
+
+    def __init__(self, kgc_path, reencryption_path, curve=None, memo_path=None):
+        """
+        :param kgc_path:            Directory of the params and keys of the KGC
+        :param reencryption_path:   Directory of the reencryption keys
+        :param curve:               Pairing curve, None for the curve of the params
+        :param memo_path:           File to keep the TIPRE memos in between processes, None to not keep them
+        """
+        self.kgc_path = kgc_path
+        self.reencryption_path = reencryption_path
+        self._curve = curve
+        self.memo_path = Path(memo_path) if memo_path is not None else None
+        self._save_memo_at_exit = False
+
+    def configure(self, curve):
+        """
+        Use another curve, the group and everything built on it are built again
+        """
+        for name in ('curve', 'group', 'pre', 'data_helper', 'keystore', 'user_keys', 'keks'):
+            self.__dict__.pop(name, None)
+        self._curve = curve
+
+    @cached_property
+    def curve(self):
+        return self._curve or params_curve(self.kgc_path / 'params') or os.environ.get('PHR_CURVE', DEFAULT_CURVE)
+
+    @cached_property
+    def group(self):
+        from charm.toolbox.pairinggroup import PairingGroup
+        return PairingGroup(self.curve, secparam=1024)
+
+    @cached_property
+    def pre(self):
+        from type_id_proxy_reencryption import TIPRE
+        pre = TIPRE(self.group)
+        if self.memo_path is not None:
+            self._load_memo(pre)
+            if not self._save_memo_at_exit:
+                atexit.register(self.save_memo)
+                self._save_memo_at_exit = True
+        return pre
+
+    def _load_memo(self, pre):
+        try:
+            with self.memo_path.open('rb') as f:
+                # H1(ID) depends on the curve, the memos of another curve aren't used
+                if pickle.load(f) == self.curve:
+                    pre.load_memo(f)
+        except FileNotFoundError:
+            pass
+
+    def save_memo(self):
+        """
+        Write the TIPRE memos to the memo path, if TIPRE was built
+        """
+        pre = self.__dict__.get('pre')
+        if pre is None or self.memo_path is None:
+            return
+        self.memo_path.parent.mkdir(parents=True, exist_ok=True)
+        tmp = self.memo_path.with_name('{}.{}.tmp'.format(self.memo_path.name, os.getpid()))
+        with tmp.open('wb') as f:
+            pickle.dump(self.curve, f)
+            pre.dump_memo(f)
+        os.replace(tmp, self.memo_path)
+
+    @cached_property
+    def data_helper(self):
+        # Listing records doesn't need the group
+        return DataHelper(lambda: self.group)
+
+    @cached_property
+    def keystore(self):
+        return KeyStore(self.group)
+
+    @cached_property
+    def user_keys(self):
+        # The user keys written by PHR.kgc_provision, one append-only log with an index
+        return Segments(self.kgc_path / 'provisioned', KEYS_SEGMENT_SIZE)
+
+    @cached_property
+    def delegations(self):
+        self.reencryption_path.mkdir(parents=True, exist_ok=True)
+        return DelegationIndex(self.reencryption_path / 'index')
+
+    @cached_property
+    def keks(self):
+        return envelope.KEKStore(self.group, self.keystore)
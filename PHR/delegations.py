@@ -0,0 +1,94 @@
+"""
+Index of the delegations made with PHR.allow_access: which delegatees have a
+reencryption key of a delegator for a type. The index is an append-only log of
+'+' (delegation) and '-' (revocation) lines, delegator, type and delegatee
+separated by tabs, kept in memory as a dict of (delegator, type) to delegatees.
+"""
+import re
+
+import layout
+
+_KEY_FILE = re.compile(r'^from_(.+)_to_(.+)_type_(.+)$')
+
+
+class DelegationIndex:
+
+    def __init__(self, path):
+        """
+        :param path:    Path of the index file, next to the reencryption keys.
+                        When it doesn't exist yet, it is built from the names of
+                        the reencryption key files.
+        """
+        self.path = path
+        self.delegations = {}
+        self.position = 0
+        self.signature = None
+        if not self.path.exists():
+            self._build()
+
+    def _build(self):
+        lines = []
+        for f in layout.current().names(self.path.parent):
+            match = _KEY_FILE.match(f)
+            if match:
+                delegator, delegatee, type_attribute = match.groups()
+                lines.append('+\t{}\t{}\t{}\n'.format(delegator, type_attribute, delegatee))
+        with self.path.open('a') as f:
+            f.write(''.join(lines))
+
+    def _refresh(self):
+        """
+        Read the lines that were appended since the last refresh, by this or
+        another process
+        """
+        try:
+            stat = self.path.stat()
+        except FileNotFoundError:
+            return
+        signature = (stat.st_ino, stat.st_size)
+        if signature == self.signature:
+            return
+        if self.signature is not None and signature[0] != self.signature[0]:
+            self.delegations = {}
+            self.position = 0
+        with self.path.open('rb') as f:
+            f.seek(self.position)
+            data = f.read()
+        end = data.rfind(b'\n') + 1
+        for line in data[:end].decode('utf-8').splitlines():
+            op, delegator, type_attribute, delegatee = line.split('\t')
+            delegatees = self.delegations.setdefault((delegator, type_attribute), {})
+            if op == '+':
+                delegatees[delegatee] = True
+            else:
+                delegatees.pop(delegatee, None)
+        self.position += end
+        self.signature = (stat.st_ino, self.position)
+
+    def _append(self, op, delegator, type_attribute, delegatee):
+        with self.path.open('a') as f:
+            f.write('{}\t{}\t{}\t{}\n'.format(op, delegator, type_attribute, delegatee))
+        self._refresh()
+
+    def add(self, delegator, type_attribute, delegatee):
+        if not self.has(delegator, type_attribute, delegatee):
+            self._append('+', delegator, type_attribute, delegatee)
+
+    def remove(self, delegator, type_attribute, delegatee):
+        if self.has(delegator, type_attribute, delegatee):
+            self._append('-', delegator, type_attribute, delegatee)
+
+    def has(self, delegator, type_attribute, delegatee):
+        """
+        Whether delegatee is a delegatee of delegator for records of type_attribute
+        """
+        self._refresh()
+        return delegatee in self.delegations.get((delegator, type_attribute), ())
+
+    def delegatees(self, delegator, type_attribute):
+        """
+        The delegatees of delegator for records of type_attribute, in the order
+        they were added
+        """
+        self._refresh()
+        return list(self.delegations.get((delegator, type_attribute), ()))
@@ -0,0 +1,142 @@
+"""
+Envelope mode for record keys. Instead of encrypting every record key with
+TIPRE, an owner keeps one key-encryption key (KEK) per type and epoch. The KEK
+is encrypted with TIPRE and the record keys are wrapped under it with
+symmetric encryption, so opening many records of one type costs one pairing
+based decryption, and the proxy reencrypts one KEK per type and epoch instead
+of every record key.
+
+A KEK is encrypted with the type '<type>#<epoch>', so a reencryption key only
+opens the KEKs of the epoch it was made for. Rotating the KEK of a type starts
+a new epoch; delegations made later do not open the KEKs of earlier epochs.
+
+The KEKs are stored as keys/kek/<holder>/from_<owner>_type_<type>_epoch_<epoch>,
+where the holder is the owner or a delegatee with a reencrypted KEK. The
+directory of the holder is placed by layout.py.
+"""
+import json
+import os
+import threading
+from pathlib import Path
+
+import layout
+import pairing_pickle
+import storage
+
+dir_path = os.path.dirname(os.path.realpath(__file__))
+
+
+def kek_type(type_attribute, epoch):
+    """
+    The TIPRE type of the KEK of type_attribute in epoch
+    """
+    return '{}#{}'.format(type_attribute, epoch)
+
+
+def is_envelope(capsule):
+    return 'Envelope' in capsule
+
+
+class KEKStore:
+
+    def __init__(self, group, keystore, path=Path('{}/keys/kek'.format(dir_path))):
+        """
+        :param group:       Pairing group of the KEKs
+        :param keystore:    KeyStore to load the encrypted KEKs with
+        :param path:        Directory of the encrypted KEKs
+        """
+        self.group = group
+        self.keystore = keystore
+        self.path = path
+        self.keks = {}
+
+    def _name(self, owner, type_attribute, epoch):
+        return 'from_{}_type_{}_epoch_{}'.format(owner, type_attribute, epoch)
+
+    def _path(self, holder, owner, type_attribute, epoch):
+        return layout.current().find(self.path, holder, self._name(owner, type_attribute, epoch))
+
+    def _epochs(self, owner):
+        try:
+            with layout.current().find(self.path, owner, 'epochs').open() as f:
+                return json.load(f)
+        except FileNotFoundError:
+            return {}
+
+    def epoch(self, owner, type_attribute):
+        """
+        The current epoch of the KEK of owner for type_attribute, 0 if there is none
+        """
+        return self._epochs(owner).get(type_attribute, 0)
+
+    def set_epoch(self, owner, type_attribute, epoch):
+        """
+        Make epoch the current epoch of type_attribute, unless a concurrent
+        rotation already went further
+        """
+        path = layout.current().path(self.path, owner) / 'epochs'
+        path.parent.mkdir(parents=True, exist_ok=True)
+        with storage.locked(layout.lock_path(self.path, owner, 'epochs')):
+            epochs = self._epochs(owner)
+            epochs[type_attribute] = max(epochs.get(type_attribute, 0), epoch)
+            tmp = path.with_name('epochs.tmp')
+            with tmp.open('w') as f:
+                json.dump(epochs, f)
+            os.replace(tmp, path)
+
+    def exists(self, holder, owner, type_attribute, epoch):
+        return self._path(holder, owner, type_attribute, epoch).exists()
+
+    def save(self, holder, owner, type_attribute, epoch, capsule):
+        """
+        Store an encrypted KEK, unless there is one already. The KEK of an epoch
+        never changes, so when a concurrent process stored one first, that one
+        is kept and has to be used instead.
+
+        :return:    False when the KEK already existed
+        """
+        if self.exists(holder, owner, type_attribute, epoch):
+            return False
+        path = layout.current().path(self.path, holder) / self._name(owner, type_attribute, epoch)
+        path.parent.mkdir(parents=True, exist_ok=True)
+        tmp = path.with_name('{}.{}.{}.tmp'.format(path.name, os.getpid(), threading.get_ident()))
+        try:
+            with tmp.open('wb') as f:
+                pairing_pickle.dump(self.group, capsule, f)
+            try:
+                os.link(tmp, path)
+            except FileExistsError:
+                return False
+        finally:
+            tmp.unlink()
+        return True
+
+    def load(self, holder, owner, type_attribute, epoch):
+        """
+        The encrypted KEK of owner for type_attribute and epoch, as held by holder
+        """
+        return self.keystore.load(self._path(holder, owner, type_attribute, epoch))
+
+    def open(self, pre, params, holder, holder_key, owner, type_attribute, epoch):
+        """
+        The decrypted KEK. A KEK never changes, so it is decrypted once and then
+        kept in memory.
+        """
+        name = (holder, owner, type_attribute, epoch)
+        kek = self.keks.get(name)
+        if kek is None:
+            kek = self.keks[name] = pre.decrypt(params, holder_key, self.load(*name))
+        return kek
+
+    def wrap(self, kek, key):
+        """
+        Encrypt a GT record key under a KEK
+        """
+        from charm.toolbox.pairinggroup import extract_key
+        from charm.toolbox.symcrypto import SymmetricCryptoAbstraction
+        return SymmetricCryptoAbstraction(extract_key(kek)).encrypt(self.group.serialize(key))
+
+    def unwrap(self, kek, wrapped):
+        from charm.toolbox.pairinggroup import extract_key
+        from charm.toolbox.symcrypto import SymmetricCryptoAbstraction
+        return self.group.deserialize(SymmetricCryptoAbstraction(extract_key(kek)).decrypt(wrapped))
@@ -2,12 +2,20 @@
 
 Usage:
     healtclub.py
-    healtclub.py new <healtclub>
-    healtclub.py read [-z <healtclub>] [-r <record>]
-    healtclub.py read [-z <healtclub>]
-    healtclub.py insert [-d <data>] [-z <healtclub>] [-p  <patient>] [-t <type>] [-r <record>]
-    healtclub.py new-patient <healtclub> <patient> -g <gender> -d <date> -a <address>
+    healtclub.py new <healtclub> [--profile=<format>]
+    healtclub.py read [-z <healtclub>] [-r <record>] [--profile=<format>]
+    healtclub.py read [-z <healtclub>] [--profile=<format>]
+    healtclub.py insert [-d <data>] [-z <healtclub>] [-p  <patient>] [-t <type>] [-r <record>] [--profile=<format>]
+    healtclub.py new-patient <healtclub> <patient> -g <gender> -d <date> -a <address> [--profile=<format>]
+    healtclub.py bulk-import <healtclub> <file>... [-w <workers>] [-b <batch>] [--profile=<format>]
+
+Options:
+    -w <workers>          Number of worker processes to encrypt with, by default none.
+    -b <batch>            Number of records per batch [default: 500].
+    --profile=<format>    Print operation counts and stage timings to stderr, as json or prometheus.
 """
+import bulk_import
+import instrumentation
 from docopt import docopt
 
 import PHR
@@ -27,23 +35,27 @@ def new_patient(healtclub, patient, gender, date, address):
 
 if __name__ == '__main__':
     arguments = docopt(__doc__, version='0.1')
-    if arguments['read'] and arguments['<healtclub>']:
-        if arguments['<record>'] is None:
-            print(PHR.select_file(PHR.HEALTHCLUB(arguments['<healtclub>'])))
+    with instrumentation.cli_profile(arguments['--profile'], lambda: PHR.group):
+        if arguments['read'] and arguments['<healtclub>']:
+            if arguments['<record>'] is None:
+                print(PHR.select_file(PHR.HEALTHCLUB(arguments['<healtclub>'])))
+            else:
+                read(arguments['<healtclub>'], arguments['<record>'])
+        elif arguments['insert']:
+            PHR.insert_with_proxy(
+                PHR.HEALTHCLUB(arguments['<healtclub>']),
+                PHR.USER(arguments['<patient>']),
+                {'data': arguments['<data>']},
+                'patient_{}_{}_{}'.format(arguments['<patient>'], arguments['<type>'], arguments['<record>']),
+                arguments['<type>'])
+        elif arguments['new']:
+            print('Creating new healtclub {}'.format(arguments['<healtclub>']))
+            PHR.kgc_generate_user(PHR.HEALTHCLUB(arguments['<healtclub>']))
+        elif arguments['new-patient']:
+            new_patient(arguments['<healtclub>'], arguments['<patient>'], arguments['<gender>'], arguments['<date>'],
+                        arguments['<address>'])
+        elif arguments['bulk-import']:
+            bulk_import.bulk_import(PHR.HEALTHCLUB(arguments['<healtclub>']), arguments['<file>'],
+                                    int(arguments['-w']) if arguments['-w'] else None, int(arguments['-b']))
         else:
-            read(arguments['<healtclub>'], arguments['<record>'])
-    elif arguments['insert']:
-        PHR.insert_with_proxy(
-            PHR.HEALTHCLUB(arguments['<healtclub>']),
-            PHR.USER(arguments['<patient>']),
-            {'data': arguments['<data>']},
-            'patient_{}_{}_{}'.format(arguments['<patient>'], arguments['<type>'], arguments['<record>']),
-            arguments['<type>'])
-    elif arguments['new']:
-        print('Creating new healtclub {}'.format(arguments['<healtclub>']))
-        PHR.kgc_generate_user(PHR.HEALTHCLUB(arguments['<healtclub>']))
-    elif arguments['new-patient']:
-        new_patient(arguments['<healtclub>'], arguments['<patient>'], arguments['<gender>'], arguments['<date>'],
-                    arguments['<address>'])
-    else:
-        print(__doc__)
+            print(__doc__)
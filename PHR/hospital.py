@@ -2,13 +2,21 @@
 
 Usage:
     hospital.py
-    hospital.py new <hospital>
-    hospital.py read [-z <hospital>] [-r <record>]
-    hospital.py read [-z <hospital>]
-    hospital.py insert [-d <data>] [-z <hospital>] [-p  <patient>] [-t <type>] [-r <record>]
-    hospital.py new-patient <hospital> <patient> -g <gender> -d <date> -a <address>
+    hospital.py new <hospital> [--profile=<format>]
+    hospital.py read [-z <hospital>] [-r <record>] [--profile=<format>]
+    hospital.py read [-z <hospital>] [--profile=<format>]
+    hospital.py insert [-d <data>] [-z <hospital>] [-p  <patient>] [-t <type>] [-r <record>] [--profile=<format>]
+    hospital.py new-patient <hospital> <patient> -g <gender> -d <date> -a <address> [--profile=<format>]
+    hospital.py bulk-import <hospital> <file>... [-w <workers>] [-b <batch>] [--profile=<format>]
+
+Options:
+    -w <workers>          Number of worker processes to encrypt with, by default none.
+    -b <batch>            Number of records per batch [default: 500].
+    --profile=<format>    Print operation counts and stage timings to stderr, as json or prometheus.
 """
 
+import bulk_import
+import instrumentation
 from docopt import docopt
 
 import PHR
@@ -28,23 +36,27 @@ def new_patient(hospital, patient, gender, date, address):
 
 if __name__ == '__main__':
     arguments = docopt(__doc__, version='0.1')
-    if arguments['read'] and arguments['<hospital>']:
-        if arguments['<record>'] is None:
-            print(PHR.select_file(PHR.HOSPITAL(arguments['<hospital>'])))
+    with instrumentation.cli_profile(arguments['--profile'], lambda: PHR.group):
+        if arguments['read'] and arguments['<hospital>']:
+            if arguments['<record>'] is None:
+                print(PHR.select_file(PHR.HOSPITAL(arguments['<hospital>'])))
+            else:
+                read(arguments['<hospital>'], arguments['<record>'])
+        elif arguments['insert']:
+            PHR.insert_with_proxy(
+                PHR.HOSPITAL(arguments['<hospital>']),
+                PHR.USER(arguments['<patient>']),
+                {'data': arguments['<data>']},
+                'patient_{}_{}_{}'.format(arguments['<patient>'], arguments['<type>'], arguments['<record>']),
+                arguments['<type>'])
+        elif arguments['new']:
+            print('Creating new hospital {}'.format(arguments['<hospital>']))
+            PHR.kgc_generate_user(PHR.HOSPITAL(arguments['<hospital>']))
+        elif arguments['new-patient']:
+            new_patient(arguments['<hospital>'], arguments['<patient>'], arguments['<gender>'], arguments['<date>'],
+                        arguments['<address>'])
+        elif arguments['bulk-import']:
+            bulk_import.bulk_import(PHR.HOSPITAL(arguments['<hospital>']), arguments['<file>'],
+                                    int(arguments['-w']) if arguments['-w'] else None, int(arguments['-b']))
         else:
-            read(arguments['<hospital>'], arguments['<record>'])
-    elif arguments['insert']:
-        PHR.insert_with_proxy(
-            PHR.HOSPITAL(arguments['<hospital>']),
-            PHR.USER(arguments['<patient>']),
-            {'data': arguments['<data>']},
-            'patient_{}_{}_{}'.format(arguments['<patient>'], arguments['<type>'], arguments['<record>']),
-            arguments['<type>'])
-    elif arguments['new']:
-        print('Creating new hospital {}'.format(arguments['<hospital>']))
-        PHR.kgc_generate_user(PHR.HOSPITAL(arguments['<hospital>']))
-    elif arguments['new-patient']:
-        new_patient(arguments['<hospital>'], arguments['<patient>'], arguments['<gender>'], arguments['<date>'],
-                    arguments['<address>'])
-    else:
-        print(__doc__)
+            print(__doc__)
@@ -0,0 +1,150 @@
+"""
+Opt-in instrumentation of the hot paths. Within instrumentation.profile() the
+pairings, multiplications and exponentiations of the pairing group are counted
+by the benchmark of charm, and the code of TIPRE, pairing_pickle, DataHelper and
+PHR counts hashes to the group, (de)serialized elements, bytes read and written
+and the wall time of the stages of an operation.
+
+When no profile is running, the counting sites only check the module global
+enabled, so the overhead is a boolean test per site. Work done in worker
+processes (parallel.py, the proxy service) is not counted.
+"""
+import json
+import sys
+import time
+from collections import Counter
+from contextlib import contextmanager
+
+enabled = False
+_counters = Counter()
+_stages = {}
+_depth = 0
+
+_GROUP_OPERATIONS = ['Pair', 'Exp', 'Mul', 'Div', 'Granular']
+
+
+def count(name, n=1):
+    """
+    Count an event, only call when enabled is set
+    """
+    _counters[name] += n
+
+
+@contextmanager
+def stage(name):
+    """
+    Measure the wall time of a stage of an operation, when a profile is running
+    """
+    if not enabled:
+        yield
+        return
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        calls, seconds = _stages.get(name, (0, 0.0))
+        _stages[name] = (calls + 1, seconds + time.perf_counter() - start)
+
+
+class Profile:
+    """
+    The counts and stage timings of a profile(), filled when it ends
+    """
+
+    def __init__(self):
+        self.operations = {}
+        self.counters = {}
+        self.stages = {}
+
+    def as_dict(self):
+        return {
+            'operations': self.operations,
+            'counters': self.counters,
+            'stages': {name: {'calls': calls, 'seconds': seconds} for name, (calls, seconds) in self.stages.items()},
+        }
+
+    def to_json(self):
+        return json.dumps(self.as_dict(), indent=2, sort_keys=True)
+
+    def to_prometheus(self):
+        """
+        The profile in the Prometheus text exposition format
+        """
+        lines = ['# TYPE phr_group_operations_total counter']
+        for operation, value in sorted(self.operations.items()):
+            if isinstance(value, dict):
+                for element, n in sorted(value.items()):
+                    lines.append('phr_group_operations_total{{operation="{}",group="{}"}} {}'.format(
+                        operation, element, n))
+            else:
+                lines.append('phr_group_operations_total{{operation="{}"}} {}'.format(operation, value))
+        lines.append('# TYPE phr_events_total counter')
+        for name, n in sorted(self.counters.items()):
+            lines.append('phr_events_total{{event="{}"}} {}'.format(name, n))
+        lines.append('# TYPE phr_stage_calls_total counter')
+        for name, (calls, _) in sorted(self.stages.items()):
+            lines.append('phr_stage_calls_total{{stage="{}"}} {}'.format(name, calls))
+        lines.append('# TYPE phr_stage_seconds_total counter')
+        for name, (_, seconds) in sorted(self.stages.items()):
+            lines.append('phr_stage_seconds_total{{stage="{}"}} {:.6f}'.format(name, seconds))
+        return '\n'.join(lines) + '\n'
+
+    def dump(self, outfile, format='json'):
+        outfile.write(self.to_prometheus() if format == 'prometheus' else self.to_json() + '\n')
+
+
+@contextmanager
+def profile(group=None):
+    """
+    Count the work done in the block. Profiles can be nested; the pairing
+    group operations are only counted by the outermost profile, as charm has
+    one benchmark per group.
+
+    :param group:   Pairing group of which to count the operations
+    :return:        A Profile, filled when the block ends
+    """
+    global enabled, _depth
+    result = Profile()
+    counters = Counter(_counters)
+    stages = dict(_stages)
+    benchmark = group is not None and _depth == 0
+    if benchmark:
+        group.InitBenchmark()
+        group.StartBenchmark(_GROUP_OPERATIONS)
+    _depth += 1
+    enabled = True
+    try:
+        yield result
+    finally:
+        _depth -= 1
+        enabled = _depth > 0
+        if benchmark:
+            group.EndBenchmark()
+            result.operations = dict(group.GetGeneralBenchmarks())
+            result.operations.update({'{}_by_group'.format(k): v for k, v in group.GetGranularBenchmarks().items()})
+        result.counters = dict(Counter(_counters) - counters)
+        result.stages = {name: (calls - stages.get(name, (0, 0.0))[0], seconds - stages.get(name, (0, 0.0))[1])
+                         for name, (calls, seconds) in _stages.items() if (calls, seconds) != stages.get(name)}
+
+
+@contextmanager
+def cli_profile(format, group=None):
+    """
+    Profile a CLI command when --profile=<format> is given (json or
+    prometheus), and print the profile to stderr at the end
+
+    :param group:   Function that returns the pairing group, only called when profiling
+    """
+    if format is None:
+        yield
+        return
+    if format not in ('json', 'prometheus'):
+        sys.exit('Unknown profile format {}, use json or prometheus'.format(format))
+    result = None
+    try:
+        with profile(group() if group is not None else None) as result:
+            yield
+    finally:
+        # Also when the command exits early
+        if result is not None:
+            result.dump(sys.stderr, format)
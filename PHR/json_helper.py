@@ -1,52 +1,255 @@
 import os
-from os import listdir
-from os.path import isfile, join
-from pathlib import Path
+from contextlib import nullcontext
 
+import instrumentation
 import pairing_pickle
+import storage
+import streaming
+from metadata import Metadata, MetadataIndex
+from storage import RecordAlreadyExists  # noqa: F401, importable from here as before
 
-
-class RecordAlreadyExists(Exception):
-    def __init__(self, message):
-        self.message = message
+# Key of the encrypted symmetric key in a record, PHR.SYMKEY()
+SYMKEY = 'enc_sym_key'
+# Key of the reference of a reencrypted copy to its original, PHR.ORIGINAL()
+ORIGINAL = 'original_record'
+# Prefix of the names of reencrypted copies, see proxy.reencryption_name
+REENCRYPTION_PREFIX = 'reencryption_from_'
 
 
 class DataHelper:
 
-    def __init__(self, group):
+    def __init__(self, group, backend=None, metadata=None):
+        """
+        :param group:       Pairing group of the records, or a function that
+                            returns it when a record is first saved or loaded
+        :param backend:     Storage backend (see storage.py), by default the
+                            one named by $PHR_STORAGE or one file per record
+        :param metadata:    MetadataIndex of the records, by default
+                            metadata.sqlite next to the records of the backend
+        """
         self.dir_path = os.path.dirname(os.path.realpath(__file__))
-        self.data_path = '{}/data/'.format(self.dir_path)
-        self.create_folder(self.data_path)
-        self.group = group
+        self._group = group
+        self.backend = backend if backend is not None else storage.open_backend()
+        self.blobs = storage.BlobStore(durability=self.backend.durability)
+        self.metadata = metadata if metadata is not None else MetadataIndex(
+            '{}metadata.sqlite'.format(self.backend.data_path))
+        self._indexed = set()
 
-    def create_folder(self, path):
-        try:
-            Path(path).mkdir(parents=True)
-        except:
-            pass
+    @property
+    def group(self):
+        if callable(self._group):
+            self._group = self._group()
+        return self._group
 
-    def save(self, user, type_attribute, data, file_name):
-        self.create_folder('{}{}'.format(self.data_path, user))
-        path = Path('{}{}/{}'.format(self.data_path, user, '{}.json'.format(file_name)))
+    def save(self, user, type_attribute, data, file_name, writer=None, reencrypted_from=None):
+        """
+        :param writer:              User that encrypted the record, by default user
+        :param reencrypted_from:    Name of the record of writer this is a reencrypted copy of
+        """
+        self.write(user, type_attribute, pairing_pickle.dump2(self.group, data), file_name, writer, reencrypted_from)
 
-        if path.exists():
-            raise RecordAlreadyExists('Record with this name already exists, choose a different name')
-        else:
-            with open(path, 'w') as outfile:
-                outfile.write(pairing_pickle.dump2(self.group, data))
+    def write(self, user, type_attribute, payload, file_name, writer=None, reencrypted_from=None):
+        """
+        Store a record that was serialized already, see save
+        """
+        self._ensure_indexed(user)
+        if instrumentation.enabled:
+            instrumentation.count('records_written')
+            instrumentation.count('bytes_written', len(payload))
+        # A copy is counted under the lock of the owner of its original, so the original isn't deleted meanwhile
+        with self.backend.lock(writer) if reencrypted_from is not None else nullcontext():
+            if reencrypted_from is not None and not self.backend.exists(writer, reencrypted_from):
+                raise FileNotFoundError('{} of {} is deleted'.format(reencrypted_from, writer))
+            self.backend.write(user, file_name, payload)
+            self.metadata.add(user, file_name, type_attribute, writer or user, reencrypted_from, len(payload))
+
+    def group_commit(self):
+        """
+        Write the records and blobs of a batch without waiting for the disk,
+        and fsync them all at once when the block ends, see storage.Durability
+        """
+        return self.backend.durability.group()
+
+    def _read(self, user, file_name):
+        payload = self.backend.read(user, file_name)
+        if instrumentation.enabled:
+            instrumentation.count('records_read')
+            instrumentation.count('bytes_read', len(payload))
+        return payload
 
     def load(self, user, file_name):
-        self.create_folder('{}{}'.format(self.data_path, user))
-        path = '{}{}/{}'.format(self.data_path, user, '{}.json'.format(file_name))
-        with open(path, 'r') as infile:
-            data = pairing_pickle.load2(self.group, infile.read())
+        """
+        Load a record. A reencrypted copy only holds its capsule and a
+        reference to its original, it is returned with the columns of the
+        original.
+        """
+        data = pairing_pickle.load2(self.group, self._read(user, file_name))
+        original = data.pop(ORIGINAL, None)
+        if original is not None:
+            # The capsule of the original isn't needed, so its elements aren't deserialized
+            columns = pairing_pickle.load2(None, self._read(original['owner'], original['record']))
+            columns[SYMKEY] = data[SYMKEY]
+            data = columns
         return data
 
+    def discard_blobs(self, data):
+        """
+        Delete the blobs of the streamed columns of a record
+        """
+        for v in data.values():
+            if streaming.is_reference(v):
+                self.blobs.delete(v['owner'], v['stream'])
+
+    def delete(self, user, file_name):
+        """
+        Delete a record. The columns of a record that has reencrypted copies
+        are kept until its last copy is deleted.
+        """
+        data = pairing_pickle.load2(None, self.backend.read(user, file_name))
+        # Only the users whose counts change are indexed: the owner, and the owner of the original of a copy
+        self._ensure_indexed(user)
+        original = data.get(ORIGINAL)
+        if original is not None:
+            self._ensure_indexed(original['owner'])
+            # The lock of the owner of the original keeps the count of its copies and its orphan mark consistent
+            with self.backend.lock(original['owner']):
+                self.metadata.remove(user, file_name)
+                self.backend.delete(user, file_name)
+                # The last copy of an orphan takes the orphan with it
+                if self.metadata.references(original['owner'], original['record']) == 0 and \
+                        self.metadata.remove_orphan(original['owner'], original['record']):
+                    self._delete_stored(original['owner'], original['record'])
+            return
+
+        self._index_all()
+        with self.backend.lock(user):
+            self.metadata.remove(user, file_name)
+            if self.metadata.references(user, file_name):
+                self.metadata.add_orphan(user, file_name)
+            else:
+                self._delete_stored(user, file_name, data)
+
+    def _index_all(self):
+        """
+        Index the users that aren't indexed yet, once, so the copies of a
+        record are counted by one query on the index. Copies are written to
+        indexed users, so these only have records stored before the index or
+        without it (see MetadataIndex.forget).
+        """
+        if self.metadata.complete():
+            return
+        for other in self.backend.users():
+            self._ensure_indexed(other)
+        self.metadata.set_complete()
+
+    def _delete_stored(self, user, file_name, data=None):
+        if data is None:
+            data = pairing_pickle.load2(None, self.backend.read(user, file_name))
+        self.backend.delete(user, file_name)
+        self.discard_blobs(data)
+
     def get_data_files(self, user):
-        path = Path("{}/{}/".format(self.data_path, user))
+        files = self.list_records(user)
 
-        if path.exists():
-            return [f[:-5] for f in listdir(path) if isfile(join(path, f))]
+        if files is not None:
+            return [m.name for m in files]
         else:
             print('No data found for this entity')
             exit(0)
+
+    def list_records(self, user, **filters):
+        """
+        Metadata of the records of user, without reading the records. See
+        MetadataIndex.list for the filters and pagination.
+
+        :return:    List of Metadata, None if user has no records
+        """
+        if not self._ensure_indexed(user):
+            return None
+        return self.metadata.list(user, **filters)
+
+    def get_metadata(self, user, file_name):
+        """
+        Metadata of a record, without reading the record
+
+        :return:    Metadata, None if the record doesn't exist
+        """
+        if not self._ensure_indexed(user):
+            return None
+        return self.metadata.get(user, file_name)
+
+    def _ensure_indexed(self, user):
+        """
+        Build the metadata of user from the stored records, the first time
+        the user is seen by a process and the index doesn't have them
+
+        :return:    False if user has no records
+        """
+        if user in self._indexed:
+            return True
+        if not self.metadata.indexed(user) and not self.rebuild_metadata(user):
+            return False
+        self._indexed.add(user)
+        return True
+
+    def rebuild_metadata(self, user):
+        """
+        Replace the metadata of user by the metadata of the stored records.
+        Records are read but not decrypted: the type is in the capsule, and the
+        writer and original of a reencrypted copy are in its name. The time a
+        record was saved is the modification time the backend has for it.
+
+        :return:    False if user has no records
+        """
+        names = self.backend.list(user)
+        if names is None:
+            return False
+        users = set(self.backend.users())
+        orphans = self.metadata.orphans(user)
+        self.metadata.replace(user, [self._stored_metadata(user, name, users) for name in names
+                                     if name not in orphans])
+        self._indexed.add(user)
+        return True
+
+    def _stored_metadata(self, user, name, users):
+        payload = self.backend.read(user, name)
+        data = pairing_pickle.load2(None, payload)
+        capsule = data.get(SYMKEY, {})
+        writer, source = user, None
+        if ORIGINAL in data:
+            writer, source = data[ORIGINAL]['owner'], data[ORIGINAL]['record']
+        elif name.startswith(REENCRYPTION_PREFIX):
+            writer, source = self._original(name[len(REENCRYPTION_PREFIX):], capsule, users)
+        type_attribute = capsule.get('C3')
+        if not isinstance(type_attribute, str):
+            # A reencrypted capsule doesn't have the type, its original has
+            type_attribute = self._stored_type(writer, source)
+        return Metadata(user, name, type_attribute, writer, source, len(payload), self.backend.mtime(user, name))
+
+    def _original(self, name, capsule, users):
+        """
+        Writer and name of the original of a reencrypted copy, from the
+        <writer>_<record> part of its name. Both can contain underscores, so
+        the split is the one of which the original exists.
+        """
+        owner = capsule.get('Owner')
+        if owner is not None and name.startswith(owner + '_'):
+            return owner, name[len(owner) + 1:]
+        parts = name.split('_')
+        for i in range(1, len(parts)):
+            writer, record = '_'.join(parts[:i]), '_'.join(parts[i:])
+            if writer in users and self.backend.exists(writer, record):
+                return writer, record
+        return None, None
+
+    def _stored_type(self, user, name):
+        if user is None:
+            return None
+        known = self.metadata.get(user, name)
+        if known is not None:
+            return known.type
+        try:
+            type_attribute = pairing_pickle.load2(None, self.backend.read(user, name))[SYMKEY].get('C3')
+        except (FileNotFoundError, KeyError):
+            return None
+        return type_attribute if isinstance(type_attribute, str) else None
@@ -0,0 +1,93 @@
+import os
+from collections import OrderedDict
+
+import pairing_pickle
+
+
+class KeyStore:
+    """
+    In-memory LRU cache of the keys and params pickled by pairing_pickle.dump.
+    A cached key is only used while its file has the same inode, size and
+    modification time, so keys that are written again are loaded again.
+    """
+
+    def __init__(self, group, maxsize=1024):
+        self.group = group
+        self.maxsize = maxsize
+        self.hits = 0
+        self.loads = 0
+        self._entries = OrderedDict()
+
+    def _signature(self, path):
+        st = os.stat(path)
+        return st.st_ino, st.st_size, st.st_mtime_ns
+
+    def load(self, path):
+        """
+        Load the key at path, from memory if the file did not change
+
+        :param path:    Path of a file written by pairing_pickle.dump
+        """
+        path = str(path)
+        signature = self._signature(path)
+        entry = self._entries.get(path)
+        if entry is not None and entry[0] == signature:
+            self.hits += 1
+            self._entries.move_to_end(path)
+            return entry[1]
+
+        with open(path, 'rb') as f:
+            key = pairing_pickle.load(self.group, f)
+        self.loads += 1
+        self._entries[path] = (signature, key)
+        self._entries.move_to_end(path)
+        while len(self._entries) > self.maxsize:
+            self._entries.popitem(last=False)
+        return key
+
+    def load_entry(self, segments, name):
+        """
+        Load the key stored as name in a storage.Segments log, from memory if
+        its entry did not change
+
+        :param segments:    Log of payloads written by pairing_pickle.dump2
+        """
+        if not segments.exists(name):
+            raise FileNotFoundError('{}: {}'.format(segments.path, name))
+        path = '{}#{}'.format(segments.path, name)
+        signature = segments.entries[name]
+        entry = self._entries.get(path)
+        if entry is not None and entry[0] == signature:
+            self.hits += 1
+            self._entries.move_to_end(path)
+            return entry[1]
+
+        key = pairing_pickle.load2(self.group, segments.read(name))
+        self.loads += 1
+        self._entries[path] = (signature, key)
+        self._entries.move_to_end(path)
+        while len(self._entries) > self.maxsize:
+            self._entries.popitem(last=False)
+        return key
+
+    def preload(self, paths):
+        """
+        Load keys ahead of time, for long running processes
+        """
+        for path in paths:
+            self.load(path)
+
+    def invalidate(self, path=None):
+        """
+        Drop a key from memory, or all keys when no path is given
+        """
+        if path is None:
+            self._entries.clear()
+        else:
+            self._entries.pop(str(path), None)
+
+    def stats(self):
+        """
+        Number of loads from disk, and number of loads that were avoided (hits)
+        """
+        return {'hits': self.hits, 'loads': self.loads, 'size': len(self._entries), 'maxsize': self.maxsize}
@@ -0,0 +1,369 @@
+"""Sharded layout of the directories of users and the key files
+
+Usage:
+    layout.py show
+    layout.py migrate [--depth=<depth>] [--root=<root>]...
+    layout.py add-root <root>...
+    layout.py resume
+    layout.py -h|--help
+
+Options:
+    -h --help               Show this screen.
+    --depth=<depth>         Levels of buckets [default: 2].
+    --root=<root>           Storage root, the package directory by default. Repeat for more roots.
+
+The records (data/, segments/), blobs (blobs/), user keys (keys/kgc/),
+reencryption keys (keys/reencryption/) and KEKs (keys/kek/) of an identity are
+stored under one of the roots, in nested buckets of the hash of its name:
+<root>/data/@3f/@a2/<user>/. A root holds the same tree as the package directory.
+The prefix tells buckets apart from names; layouts configured before it was
+added keep their bare buckets (<root>/data/3f/a2/<user>/) until they are
+migrated.
+The root of a name is chosen by rendezvous hashing, so adding a root only
+moves the names that the new root wins. Finding a name costs a hash per root
+and a stat, whatever the number of identities.
+
+The layout is configured in layout.json; without it every name is stored flat
+under the package directory, as before. migrate and add-root move everything
+to the new layout while PHR keeps running: until they are done, names that
+are not in the new layout yet are looked up in the previous one, and new
+files are written in the new layout. Other processes pick up a new layout
+within RELOAD_INTERVAL seconds. Segment logs are moved as a whole; moving one
+to another root copies it, so its user should not be written to meanwhile.
+
+The lock files of the names are not laid out: they are in <base>/.locks/ in
+every layout (see lock_path), so processes that see different layouts during a
+migration still lock the same file.
+"""
+import hashlib
+import json
+import os
+import shutil
+import time
+from pathlib import Path
+
+dir_path = os.path.dirname(os.path.realpath(__file__))
+
+CONFIG = '{}/layout.json'.format(dir_path)
+RELOAD_INTERVAL = 1.0
+BUCKET_PREFIX = '@'
+LOCKS = '.locks'
+_BUCKET_WIDTH = 2
+
+# Directories of the package that are laid out: whether their names are
+# directories or files, whether a directory is moved as a whole, and the
+# names that always stay in the directory itself
+BASES = {
+    'data': ('dir', False, ()),
+    'segments': ('dir', True, ()),
+    'blobs': ('dir', False, ()),
+    'keys/kek': ('dir', False, ()),
+    'keys/kgc': ('file', False, ('params', 'master_key', 'provisioned')),
+    'keys/reencryption': ('file', False, ('index',)),
+}
+
+
+def _is_bucket(name, prefixes):
+    return any(len(name) == len(prefix) + _BUCKET_WIDTH and name.startswith(prefix) and
+               all(c in '0123456789abcdef' for c in name[len(prefix):]) for prefix in prefixes)
+
+
+def _is_lock(name):
+    # Lock files of the flat layout before the locks moved to LOCKS
+    return name in ('.lock', 'lock') or name.endswith('.lock')
+
+
+def lock_path(base, name, kind='lock'):
+    """
+    Path of a lock file of name in base, the same in every layout:
+    <base>/.locks/<bucket>/<name>.<kind>. The parent directory is created.
+    """
+    digest = hashlib.sha1(name.encode('utf-8')).hexdigest()
+    path = Path(base, LOCKS, digest[:_BUCKET_WIDTH], '{}.{}'.format(name, kind))
+    path.parent.mkdir(parents=True, exist_ok=True)
+    return path
+
+
+class Layout:
+
+    def __init__(self, roots=None, depth=0, previous=None, prefix=BUCKET_PREFIX):
+        """
+        :param roots:       Storage roots, by default the package directory
+        :param depth:       Levels of buckets, 0 for the flat layout
+        :param previous:    Layout that is being migrated from
+        :param prefix:      Prefix of the names of the buckets, '' for layouts
+                            configured before buckets had a prefix
+        """
+        self.roots = [os.path.abspath(r) for r in roots] if roots else [dir_path]
+        self.depth = depth
+        self.previous = previous
+        self.prefix = prefix
+
+    def as_dict(self):
+        return {'roots': self.roots, 'depth': self.depth, 'prefix': self.prefix,
+                'previous': self.previous.as_dict() if self.previous is not None else None}
+
+    @classmethod
+    def from_dict(cls, d):
+        previous = d.get('previous')
+        return cls(d['roots'], d['depth'], cls.from_dict(previous) if previous else None, d.get('prefix', ''))
+
+    def bucket(self, name):
+        digest = hashlib.sha1(name.encode('utf-8')).hexdigest()
+        return [self.prefix + digest[i * _BUCKET_WIDTH:(i + 1) * _BUCKET_WIDTH] for i in range(self.depth)]
+
+    def prefixes(self):
+        """
+        Prefixes of the buckets of this layout and the previous one, which are
+        not names in a flat layout
+        """
+        layouts = [self] if self.previous is None else [self, self.previous]
+        return {BUCKET_PREFIX} | {layout.prefix for layout in layouts if layout.depth}
+
+    def root(self, name):
+        if len(self.roots) == 1:
+            return self.roots[0]
+        return max(self.roots, key=lambda root: hashlib.sha1('{}\0{}'.format(root, name).encode('utf-8')).digest())
+
+    def _base(self, base, root):
+        # Directories outside the package directory (benchmarks) are not spread over the roots
+        relative = os.path.relpath(base, dir_path)
+        if relative.startswith('..'):
+            return Path(base)
+        return Path(root, relative)
+
+    def path(self, base, name):
+        """
+        Path of name in base (a directory of the package, like keys/kgc) in
+        this layout. New files are written here.
+        """
+        return self._base(base, self.root(name)).joinpath(*self.bucket(name), name)
+
+    def candidates(self, base, name):
+        """
+        Paths where name can be while a migration runs: in this layout and in
+        the previous one
+        """
+        path = self.path(base, name)
+        if self.previous is None:
+            return [path]
+        previous = self.previous.path(base, name)
+        return [path] if previous == path else [path, previous]
+
+    def find(self, base, name, *parts):
+        """
+        Path of name, or of parts inside the directory of name, in this layout
+        or, while a migration runs, in the previous one. The path in this
+        layout when it doesn't exist.
+        """
+        paths = [path.joinpath(*parts) for path in self.candidates(base, name)]
+        if len(paths) == 1:
+            return paths[0]
+        # The new path once more, in case it was moved in the meantime
+        for path in paths + paths[:1]:
+            if path.exists():
+                return path
+        return paths[0]
+
+    def _entries(self, path, depth, prefixes):
+        if not path.is_dir():
+            return
+        for entry in os.scandir(path):
+            if depth > 0:
+                if _is_bucket(entry.name, [self.prefix]) and entry.is_dir():
+                    yield from self._entries(Path(entry.path), depth - 1, prefixes)
+            elif not _is_bucket(entry.name, prefixes) and not entry.name.startswith('.') and \
+                    not entry.name.endswith('.tmp'):
+                yield Path(entry.path)
+
+    def entries(self, base, prefixes=None):
+        """
+        Paths of the names in base in this layout, on all roots
+
+        :param prefixes:    Prefixes of the buckets that are not names, by default see prefixes
+        """
+        prefixes = self.prefixes() if prefixes is None else prefixes
+        for root in self.roots:
+            yield from self._entries(self._base(base, root), self.depth, prefixes)
+
+    def names(self, base, directories=False):
+        """
+        Names in base, in this layout and the previous one
+
+        :param directories:     Only the names that are directories
+        """
+        layouts = [self] if self.previous is None else [self, self.previous]
+        prefixes = self.prefixes()
+        return sorted({path.name for layout in layouts for path in layout.entries(base, prefixes)
+                       if not directories or path.is_dir()})
+
+
+def load(path=CONFIG):
+    try:
+        with open(path) as f:
+            return Layout.from_dict(json.load(f))
+    except FileNotFoundError:
+        return Layout()
+
+
+def save(layout, path=CONFIG):
+    tmp = '{}.tmp'.format(path)
+    with open(tmp, 'w') as f:
+        json.dump(layout.as_dict(), f, indent=2)
+    os.replace(tmp, path)
+
+
+_current = None
+_signature = None
+_checked = 0.0
+
+
+def current():
+    """
+    The configured layout. layout.json is checked for changes at most every
+    RELOAD_INTERVAL seconds.
+    """
+    global _current, _signature, _checked
+    now = time.monotonic()
+    if _current is not None and now - _checked < RELOAD_INTERVAL:
+        return _current
+    _checked = now
+    try:
+        st = os.stat(CONFIG)
+        signature = st.st_ino, st.st_size, st.st_mtime_ns
+    except FileNotFoundError:
+        signature = None
+    if _current is None or signature != _signature:
+        _current, _signature = load(), signature
+    return _current
+
+
+def _move_file(source, target):
+    """
+    Move a file, by copying it when the target is on another file system.
+    Files that are in the new place already are newer, the old one is dropped.
+    """
+    if not target.exists():
+        target.parent.mkdir(parents=True, exist_ok=True)
+        try:
+            os.rename(source, target)
+            return
+        except OSError:
+            tmp = target.with_name(target.name + '.tmp')
+            shutil.copy2(source, tmp)
+            os.replace(tmp, target)
+    source.unlink()
+
+
+def _move_tree(source, target):
+    """
+    :return:    False when the target exists already
+    """
+    if target.exists():
+        print('Not moving {}, {} exists already'.format(source, target))
+        return False
+    target.parent.mkdir(parents=True, exist_ok=True)
+    try:
+        os.rename(source, target)
+    except OSError:
+        tmp = target.with_name(target.name + '.tmp')
+        shutil.copytree(source, tmp, ignore=lambda directory, names: [n for n in names if _is_lock(n)])
+        os.replace(tmp, target)
+        shutil.rmtree(source)
+    return True
+
+
+def _prune(path, depth):
+    """
+    Remove the buckets of path that are left empty
+    """
+    for parent in list(path.parents)[:depth]:
+        try:
+            parent.rmdir()
+        except OSError:
+            return
+
+
+def _move(layout, base, kind, whole, fixed):
+    """
+    Move the names of base from the previous layout to layout
+
+    :return:    Number of moved names
+    """
+    moved = 0
+    for source in list(layout.previous.entries(base, layout.prefixes())):
+        if source.name in fixed or (kind == 'dir') != source.is_dir():
+            continue
+        target = layout.path(base, source.name)
+        if target == source:
+            continue
+        if kind == 'file':
+            _move_file(source, target)
+        elif whole:
+            if not _move_tree(source, target):
+                continue
+        else:
+            # File by file, new files are written in the target meanwhile.
+            # Lock files of the layout before LOCKS are not used anymore.
+            target.mkdir(parents=True, exist_ok=True)
+            for f in list(source.iterdir()):
+                if _is_lock(f.name):
+                    f.unlink()
+                else:
+                    _move_file(f, target / f.name)
+            source.rmdir()
+        _prune(source, layout.previous.depth)
+        moved += 1
+    return moved
+
+
+def migrate(layout):
+    """
+    Move everything to layout, while PHR keeps running. An interrupted
+    migration is continued by migrating to the same layout again.
+
+    :return:    Number of moved names
+    """
+    configured = load()
+    if configured.previous is not None and \
+            (configured.roots, configured.depth, configured.prefix) != (layout.roots, layout.depth, layout.prefix):
+        raise ValueError('Another migration is running, resume it first')
+    layout.previous = configured.previous or configured
+    save(layout)
+    # Let the other processes look in both layouts before anything moves
+    time.sleep(2 * RELOAD_INTERVAL)
+
+    moved = 0
+    while True:
+        moved_in_pass = sum(_move(layout, '{}/{}'.format(dir_path, base), *spec) for base, spec in BASES.items())
+        moved += moved_in_pass
+        if not moved_in_pass:
+            break
+    layout.previous = None
+    save(layout)
+    return moved
+
+
+if __name__ == '__main__':
+    from docopt import docopt
+
+    arguments = docopt(__doc__, version='0.1')
+    configured = load()
+    try:
+        if arguments['show']:
+            print(json.dumps(configured.as_dict(), indent=2))
+        elif arguments['migrate']:
+            print('Moved {}'.format(migrate(Layout(arguments['--root'] or configured.roots,
+                                                   int(arguments['--depth'])))))
+        elif arguments['add-root']:
+            print('Moved {}'.format(migrate(Layout(configured.roots + arguments['<root>'], configured.depth))))
+        elif arguments['resume']:
+            if configured.previous is None:
+                print('No migration to resume')
+            else:
+                print('Moved {}'.format(migrate(Layout(configured.roots, configured.depth,
+                                                       prefix=configured.prefix))))
+        else:
+            print(__doc__)
+    except ValueError as e:
+        print(e)
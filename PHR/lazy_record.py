@@ -0,0 +1,41 @@
+from collections.abc import Mapping
+
+
+class LazyRecord(Mapping):
+    """
+    Read-only mapping of the columns of an encrypted record. A column is only
+    decrypted when it is first accessed, and then kept. The record key is
+    opened once, on the first access, and shared by all columns.
+    """
+
+    def __init__(self, columns, open_key, decrypt):
+        """
+        :param columns:     Dict of column name to encrypted value
+        :param open_key:    Function without arguments that returns the record key
+        :param decrypt:     Function (record key, encrypted value) -> value
+        """
+        self._columns = columns
+        self._open_key = open_key
+        self._decrypt = decrypt
+        self._key = None
+        self._decrypted = {}
+
+    def __getitem__(self, column):
+        try:
+            return self._decrypted[column]
+        except KeyError:
+            pass
+        encrypted = self._columns[column]
+        if self._key is None:
+            self._key = self._open_key()
+        value = self._decrypted[column] = self._decrypt(self._key, encrypted)
+        return value
+
+    def __iter__(self):
+        return iter(self._columns)
+
+    def __len__(self):
+        return len(self._columns)
+
+    def __repr__(self):
+        return repr(dict(self))
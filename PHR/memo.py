@@ -0,0 +1,67 @@
+import pickle
+from collections import OrderedDict
+
+
+class LRUMemo:
+    """
+    Bounded least-recently-used memo table with hit/miss counters. Keys are
+    plain (picklable) values, values are pairing group elements.
+    """
+
+    def __init__(self, maxsize=1024):
+        self.maxsize = maxsize
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def get(self, key, compute):
+        """
+        Return the memoized value for key, calling compute() to fill it on a miss.
+
+        :param key:       Hashable key
+        :param compute:   Function without arguments that computes the value
+        """
+        try:
+            value = self._entries[key]
+        except KeyError:
+            self.misses += 1
+            value = compute()
+            self.put(key, value)
+            return value
+        self.hits += 1
+        self._entries.move_to_end(key)
+        return value
+
+    def put(self, key, value):
+        self._entries[key] = value
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.maxsize:
+            self._entries.popitem(last=False)
+
+    def values(self):
+        return self._entries.values()
+
+    def clear(self):
+        self._entries.clear()
+        self.hits = 0
+        self.misses = 0
+
+    def stats(self):
+        return {'hits': self.hits, 'misses': self.misses, 'size': len(self._entries), 'maxsize': self.maxsize}
+
+    def dump(self, group, outfile):
+        """
+        Pickle the memo entries, serializing the group elements
+        """
+        entries = [(k, group.serialize(v)) for k, v in self._entries.items()]
+        pickle.dump(entries, outfile)
+
+    def load(self, group, infile):
+        """
+        Unpickle memo entries written by dump and add them to this memo
+        """
+        for k, v in pickle.load(infile):
+            self.put(k, group.deserialize(v))
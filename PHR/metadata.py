@@ -0,0 +1,186 @@
+"""
+Plaintext metadata of the records in a SQLite index, so records can be listed
+and filtered without reading or decrypting them: the owner (the user the record
+is stored for), the name, the type, the writer, the record it was reencrypted
+from, the size of the stored record and the time it was saved.
+
+DataHelper keeps the index next to the records of its backend, as
+metadata.sqlite. The index knows which users it has all records of. For other
+users, like users of data that was written before the index, it is built from
+the stored records once (see DataHelper.rebuild_metadata).
+
+The copies of a record that are reencrypted for others refer to it (see
+DataHelper.load), so the rows of the copies count the references to it. A
+deleted record that still has copies becomes an orphan: it isn't listed, but
+is kept until its last copy is deleted. Before the first delete, the users
+that aren't indexed yet are indexed once, and the index is marked complete,
+so that the copies of every record are counted by one query.
+"""
+import os
+import sqlite3
+import threading
+import time
+from collections import namedtuple
+
+Metadata = namedtuple('Metadata', ['owner', 'name', 'type', 'writer', 'reencrypted_from', 'size', 'created'])
+
+_SCHEMA = '''
+CREATE TABLE IF NOT EXISTS records (
+    owner TEXT NOT NULL,
+    name TEXT NOT NULL,
+    type TEXT,
+    writer TEXT,
+    reencrypted_from TEXT,
+    size INTEGER,
+    created REAL,
+    PRIMARY KEY (owner, name)
+);
+CREATE INDEX IF NOT EXISTS records_type ON records (owner, type);
+CREATE INDEX IF NOT EXISTS records_writer ON records (owner, writer);
+CREATE INDEX IF NOT EXISTS records_original ON records (writer, reencrypted_from);
+CREATE TABLE IF NOT EXISTS indexed (owner TEXT PRIMARY KEY);
+CREATE TABLE IF NOT EXISTS orphans (owner TEXT NOT NULL, name TEXT NOT NULL, PRIMARY KEY (owner, name));
+CREATE TABLE IF NOT EXISTS flags (name TEXT PRIMARY KEY);
+'''
+
+
+class MetadataIndex:
+
+    def __init__(self, path):
+        """
+        :param path:    Path of the SQLite database, created when it doesn't exist
+        """
+        self.path = str(path)
+        self._lock = threading.Lock()
+        self._connection = None
+        self._pid = None
+
+    def _connect(self):
+        # A connection can't be shared with forked worker processes
+        if self._connection is None or self._pid != os.getpid():
+            connection = sqlite3.connect(self.path, timeout=30, check_same_thread=False, isolation_level=None)
+            connection.execute('PRAGMA journal_mode=WAL')
+            connection.execute('PRAGMA synchronous=NORMAL')
+            connection.executescript(_SCHEMA)
+            self._connection, self._pid = connection, os.getpid()
+        return self._connection
+
+    def _execute(self, sql, args=()):
+        with self._lock:
+            return self._connect().execute(sql, args).fetchall()
+
+    def add(self, owner, name, type_attribute, writer, reencrypted_from=None, size=None, created=None):
+        self._execute('INSERT OR REPLACE INTO records VALUES (?, ?, ?, ?, ?, ?, ?)',
+                      (owner, name, type_attribute, writer, reencrypted_from, size,
+                       created if created is not None else time.time()))
+
+    def remove(self, owner, name):
+        self._execute('DELETE FROM records WHERE owner = ? AND name = ?', (owner, name))
+
+    def get(self, owner, name):
+        rows = self._execute('SELECT * FROM records WHERE owner = ? AND name = ?', (owner, name))
+        return Metadata(*rows[0]) if rows else None
+
+    def indexed(self, owner):
+        """
+        Whether the index has all records of owner
+        """
+        return bool(self._execute('SELECT 1 FROM indexed WHERE owner = ?', (owner,)))
+
+    def replace(self, owner, records):
+        """
+        Replace the metadata of owner by records, and mark owner as indexed
+
+        :param records:     Iterable of Metadata
+        """
+        with self._lock:
+            connection = self._connect()
+            connection.execute('BEGIN IMMEDIATE')
+            try:
+                connection.execute('DELETE FROM records WHERE owner = ?', (owner,))
+                connection.executemany('INSERT INTO records VALUES (?, ?, ?, ?, ?, ?, ?)', records)
+                connection.execute('INSERT OR REPLACE INTO indexed VALUES (?)', (owner,))
+                connection.execute('COMMIT')
+            except BaseException:
+                connection.execute('ROLLBACK')
+                raise
+
+    def complete(self):
+        """
+        Whether the index has the records of all owners, see set_complete
+        """
+        return bool(self._execute("SELECT 1 FROM flags WHERE name = 'complete'"))
+
+    def set_complete(self):
+        """
+        Mark that the index has the records of all owners. Records written
+        later are added as they are written.
+        """
+        self._execute("INSERT OR REPLACE INTO flags VALUES ('complete')")
+
+    def references(self, owner, name):
+        """
+        Number of reencrypted copies of the record, of all owners when the
+        index is complete
+        """
+        return self._execute('SELECT COUNT(*) FROM records WHERE writer = ? AND reencrypted_from = ?',
+                             (owner, name))[0][0]
+
+    def add_orphan(self, owner, name):
+        self._execute('INSERT OR REPLACE INTO orphans VALUES (?, ?)', (owner, name))
+
+    def remove_orphan(self, owner, name):
+        """
+        :return:    Whether the record was an orphan
+        """
+        with self._lock:
+            return self._connect().execute('DELETE FROM orphans WHERE owner = ? AND name = ?',
+                                           (owner, name)).rowcount > 0
+
+    def orphans(self, owner):
+        return {name for name, in self._execute('SELECT name FROM orphans WHERE owner = ?', (owner,))}
+
+    def forget(self, owners):
+        """
+        Let the records of owners be indexed again, after they were written
+        without the index (e.g. by storage.migrate)
+        """
+        for owner in owners:
+            self._execute('DELETE FROM indexed WHERE owner = ?', (owner,))
+        self._execute("DELETE FROM flags WHERE name = 'complete'")
+
+    def _where(self, owner, type_attribute, writer, reencrypted_from, since, until):
+        clauses, args = ['owner = ?'], [owner]
+        for column, value in (('type', type_attribute), ('writer', writer), ('reencrypted_from', reencrypted_from)):
+            if value is not None:
+                clauses.append('{} = ?'.format(column))
+                args.append(value)
+        if since is not None:
+            clauses.append('created >= ?')
+            args.append(since)
+        if until is not None:
+            clauses.append('created < ?')
+            args.append(until)
+        return ' AND '.join(clauses), args
+
+    def list(self, owner, type_attribute=None, writer=None, reencrypted_from=None, since=None, until=None,
+             limit=None, offset=0):
+        """
+        Metadata of the records of owner that match the filters, ordered by name
+
+        :param type_attribute:      Only records of this type
+        :param writer:              Only records written by this user
+        :param reencrypted_from:    Only copies of this record
+        :param since:               Only records saved at or after this time (seconds since the epoch)
+        :param until:               Only records saved before this time
+        :param limit:               Page size, None for all records
+        :param offset:              Records to skip
+        """
+        where, args = self._where(owner, type_attribute, writer, reencrypted_from, since, until)
+        rows = self._execute('SELECT * FROM records WHERE {} ORDER BY name LIMIT ? OFFSET ?'.format(where),
+                             args + [-1 if limit is None else limit, offset])
+        return [Metadata(*row) for row in rows]
+
+    def count(self, owner, type_attribute=None, writer=None, reencrypted_from=None, since=None, until=None):
+        where, args = self._where(owner, type_attribute, writer, reencrypted_from, since, until)
+        return self._execute('SELECT COUNT(*) FROM records WHERE {}'.format(where), args)[0][0]
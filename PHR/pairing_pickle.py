@@ -1,28 +1,36 @@
+import json
 import pickle
+import struct
+import sys
+from base64 import b64decode, b64encode
 
+import instrumentation
 import jsonpickle
-from charm.toolbox.pairinggroup import pc_element
 
+# Binary format: MAGIC followed by one tagged value. Group elements are stored
+# as their raw compressed bytes and symmetric ciphertexts as raw IV and
+# ciphertext, instead of base64 inside JSON.
+MAGIC = b'PHRB\x01'
+_LENGTH = struct.Struct('>I')
+_INT = struct.Struct('>q')
+_FLOAT = struct.Struct('>d')
+_SYMCIPHER = struct.Struct('>BBB')
 
-def _dump(group, obj):
+
+def _is_element(obj):
     """
-    Recursive helper function to pickle a dict of group objects or a single group object
+    Whether obj is a group element. Only a loaded pairing library can have made
+    one, so this module doesn't load it itself.
     """
-
-    if isinstance(obj, dict):
-        return dict((k, _dump(group, v)) for k, v in obj.items())
-    elif isinstance(obj, pc_element):
-        return group.serialize(obj)
-    else:
-        return obj
-        # raise TypeError('Not a dict or pairing group object')
+    pairing = sys.modules.get('charm.core.math.pairing')
+    return pairing is not None and isinstance(obj, pairing.pc_element)
 
 
 def dump(group, obj, outfile):
     """
     Recursively pickle a serialized dict of group objects or a single group object
     """
-    pickle.dump(_dump(group, obj), outfile)
+    outfile.write(dumpb(group, obj))
 
 
 def _load(group, obj):
@@ -44,39 +52,51 @@ def load(group, infile):
     Recursively UNpickle a serialized dict of group objects or a single group object
     """
 
-    root = pickle.load(infile)
+    data = infile.read()
+    if data.startswith(MAGIC):
+        return loadb(group, data)
+    root = pickle.loads(data)
     return _load(group, root)
 
 
-def _dump2(group, obj):
+def serialize(group, obj):
     """
-    Recursive helper function to pickle a dict of group objects or a single group object
+    Recursively serialize the group elements of a dict, or a single group element.
+    The result can be pickled, e.g. to send it to a worker process.
     """
 
     if isinstance(obj, dict):
-        return dict((k, _dump2(group, v)) for k, v in obj.items())
-    elif isinstance(obj, pc_element):
+        return dict((k, serialize(group, v)) for k, v in obj.items())
+    elif _is_element(obj):
+        if instrumentation.enabled:
+            instrumentation.count('serialize')
         return group.serialize(obj)
     else:
         return obj
         # raise TypeError('Not a dict or pairing group object {}'.format(type(obj)))
 
 
-def dump2(group, obj):
+def dump2(group, obj, binary=True):
     """
-    Recursively pickle a serialized dict of group objects or a single group object
+    Recursively pickle a serialized dict of group objects or a single group object,
+    in the binary format (bytes) or as JSON (str)
     """
-    return jsonpickle.encode(_dump2(group, obj))
+    if binary:
+        return dumpb(group, obj)
+    return jsonpickle.encode(serialize(group, obj))
 
 
-def _load2(group, obj):
+def deserialize(group, obj):
     """
-    Recursive helper function to unpickle a dict of group objects or a single group object
+    Recursively deserialize the group elements of a dict serialized with serialize,
+    or a single group element
     """
 
     if isinstance(obj, dict):
-        return dict((k, _load2(group, v)) for k, v in obj.items())
-    elif isinstance(obj, bytes):
+        return dict((k, deserialize(group, v)) for k, v in obj.items())
+    elif isinstance(obj, bytes) and group is not None:
+        if instrumentation.enabled:
+            instrumentation.count('deserialize')
         return group.deserialize(obj)
     else:
         return obj
@@ -85,8 +105,150 @@ def _load2(group, obj):
 
 def load2(group, infile):
     """
-    Recursively UNpickle a serialized dict of group objects or a single group object
+    Recursively UNpickle a serialized dict of group objects or a single group object,
+    from the binary format or JSON (str, bytes or memoryview). Without a group, the
+    group elements are returned in their charm serialized form.
     """
 
+    if not isinstance(infile, str):
+        if infile[:len(MAGIC)] == MAGIC:
+            return loadb(group, infile)
+        infile = str(infile, 'utf-8')
     root = jsonpickle.decode(infile)
-    return _load2(group, root)
+    return deserialize(group, root)
+
+
+def _symcipher(obj):
+    """
+    The ALG, MODE, IV and CipherText of a SymmetricCryptoAbstraction ciphertext,
+    or None if obj is a different string
+    """
+    if not obj.startswith('{"ALG": '):
+        return None
+    try:
+        ct = json.loads(obj)
+        if list(ct) != ['ALG', 'MODE', 'IV', 'CipherText'] or json.dumps(ct) != obj:
+            return None
+        iv = b64decode(ct['IV'])
+        return _SYMCIPHER.pack(ct['ALG'], ct['MODE'], len(iv)) + iv, b64decode(ct['CipherText'])
+    except (ValueError, TypeError, struct.error):
+        return None
+
+
+def _dumpb(group, obj, out):
+    if isinstance(obj, dict):
+        out += b'd' + _LENGTH.pack(len(obj))
+        for k, v in obj.items():
+            _dumpb(group, k, out)
+            _dumpb(group, v, out)
+    elif _is_element(obj):
+        if instrumentation.enabled:
+            instrumentation.count('serialize')
+        serialized = group.serialize(obj)
+        raw = b64decode(serialized[2:])
+        out += b'e' + serialized[:1] + _LENGTH.pack(len(raw)) + raw
+    elif isinstance(obj, str):
+        symcipher = _symcipher(obj)
+        if symcipher is not None:
+            header, ct = symcipher
+            out += b'c' + header + _LENGTH.pack(len(ct)) + ct
+        else:
+            encoded = obj.encode('utf-8')
+            out += b's' + _LENGTH.pack(len(encoded)) + encoded
+    elif isinstance(obj, (bytes, bytearray, memoryview)):
+        out += b'b' + _LENGTH.pack(len(obj)) + obj
+    elif obj is None:
+        out += b'N'
+    elif obj is True:
+        out += b'T'
+    elif obj is False:
+        out += b'F'
+    elif isinstance(obj, int) and -2 ** 63 <= obj < 2 ** 63:
+        out += b'i' + _INT.pack(obj)
+    elif isinstance(obj, float):
+        out += b'f' + _FLOAT.pack(obj)
+    elif isinstance(obj, (list, tuple)):
+        out += b'l' + _LENGTH.pack(len(obj))
+        for v in obj:
+            _dumpb(group, v, out)
+    else:
+        raise TypeError('Cannot serialize {} in the binary format'.format(type(obj)))
+
+
+def dumpb(group, obj):
+    """
+    Serialize a dict of group objects (or a single group object) to the binary format
+    """
+    out = bytearray(MAGIC)
+    _dumpb(group, obj, out)
+    return bytes(out)
+
+
+def _loadb(group, buf, offset):
+    tag = buf[offset]
+    offset += 1
+    if tag == 0x64:  # d
+        n, = _LENGTH.unpack_from(buf, offset)
+        offset += _LENGTH.size
+        obj = {}
+        for _ in range(n):
+            k, offset = _loadb(group, buf, offset)
+            obj[k], offset = _loadb(group, buf, offset)
+        return obj, offset
+    elif tag == 0x65:  # e
+        element_type = buf[offset:offset + 1]
+        n, = _LENGTH.unpack_from(buf, offset + 1)
+        offset += 1 + _LENGTH.size
+        serialized = bytes(element_type) + b':' + b64encode(buf[offset:offset + n])
+        if instrumentation.enabled and group is not None:
+            instrumentation.count('deserialize')
+        return group.deserialize(serialized) if group is not None else serialized, offset + n
+    elif tag == 0x73:  # s
+        n, = _LENGTH.unpack_from(buf, offset)
+        offset += _LENGTH.size
+        return str(buf[offset:offset + n], 'utf-8'), offset + n
+    elif tag == 0x63:  # c
+        alg, mode, n_iv = _SYMCIPHER.unpack_from(buf, offset)
+        offset += _SYMCIPHER.size
+        iv = b64encode(buf[offset:offset + n_iv]).decode('utf-8')
+        offset += n_iv
+        n, = _LENGTH.unpack_from(buf, offset)
+        offset += _LENGTH.size
+        ct = b64encode(buf[offset:offset + n]).decode('utf-8')
+        return json.dumps({'ALG': alg, 'MODE': mode, 'IV': iv, 'CipherText': ct}), offset + n
+    elif tag == 0x62:  # b
+        n, = _LENGTH.unpack_from(buf, offset)
+        offset += _LENGTH.size
+        return bytes(buf[offset:offset + n]), offset + n
+    elif tag == 0x4e:  # N
+        return None, offset
+    elif tag == 0x54:  # T
+        return True, offset
+    elif tag == 0x46:  # F
+        return False, offset
+    elif tag == 0x69:  # i
+        return _INT.unpack_from(buf, offset)[0], offset + _INT.size
+    elif tag == 0x66:  # f
+        return _FLOAT.unpack_from(buf, offset)[0], offset + _FLOAT.size
+    elif tag == 0x6c:  # l
+        n, = _LENGTH.unpack_from(buf, offset)
+        offset += _LENGTH.size
+        obj = []
+        for _ in range(n):
+            v, offset = _loadb(group, buf, offset)
+            obj.append(v)
+        return obj, offset
+    raise ValueError('Unknown tag {} in binary data'.format(tag))
+
+
+def loadb(group, data):
+    """
+    Deserialize the binary format. data can be bytes, a memoryview or an mmap,
+    and is read in place. Without a group, the group elements are returned in
+    their charm serialized form.
+    """
+    buf = memoryview(data)
+    if buf[:len(MAGIC)] != MAGIC:
+        raise ValueError('Not in the binary format')
+    obj, _ = _loadb(group, buf, len(MAGIC))
+    return obj
@@ -0,0 +1,147 @@
+"""
+Process pool helpers. Pairing group elements can't be pickled, so work is sent
+to the worker processes in serialized form (see pairing_pickle) and each worker
+uses the group and TIPRE instance of its own PHR module.
+"""
+import math
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+
+import pairing_pickle
+
+
+def chunks(items, processes, per_process=4):
+    """
+    Split items in about per_process chunks for every worker process
+    """
+    size = max(1, math.ceil(len(items) / (processes * per_process)))
+    return [items[i:i + size] for i in range(0, len(items), size)]
+
+
+def _encrypt_records(params, user, user_key, items):
+    import PHR
+    records = PHR.encrypt_records(pairing_pickle.deserialize(PHR.group, params), user,
+                                  pairing_pickle.deserialize(PHR.group, user_key), items)
+    return [pairing_pickle.serialize(PHR.group, r) for r in records]
+
+
+def encrypt_records(group, params, user, user_key, items, processes):
+    """
+    Run PHR.encrypt_records for the items in a pool of worker processes.
+
+    :param group:       Pairing group of the caller
+    :param params:      Public parameters
+    :param user:        The writer
+    :param user_key:    Secret key of the writer
+    :param items:       List of (record, type_attribute, data) tuples
+    :param processes:   Number of worker processes
+    :return:            The encrypted records, in the order of items
+    """
+    params = pairing_pickle.serialize(group, params)
+    user_key = pairing_pickle.serialize(group, user_key)
+    with ProcessPoolExecutor(processes) as pool:
+        futures = [pool.submit(_encrypt_records, params, user, user_key, chunk)
+                   for chunk in chunks(items, processes)]
+        return [pairing_pickle.deserialize(group, r) for f in futures for r in f.result()]
+
+
+def _reencrypt_records(re_encryption_key, user, to_user, type_attribute, records):
+    import PHR
+    import proxy
+    return proxy.reencrypt_records(PHR.get_params(), pairing_pickle.deserialize(PHR.group, re_encryption_key), user,
+                                   to_user, type_attribute, records)
+
+
+def reencrypt_records(group, re_encryption_key, user, to_user, type_attribute, records, processes):
+    """
+    Run proxy.reencrypt_records in a pool of worker processes. The workers load
+    and store the records themselves, only the record names are sent to them.
+
+    :return:    Names of the reencrypted records
+    """
+    re_encryption_key = pairing_pickle.serialize(group, re_encryption_key)
+    with ProcessPoolExecutor(processes) as pool:
+        futures = [pool.submit(_reencrypt_records, re_encryption_key, user, to_user, type_attribute, chunk)
+                   for chunk in chunks(records, processes)]
+        return [r for f in futures for r in f.result()]
+
+
+def _decrypt_records(params, user, user_key, names, fields):
+    import PHR
+    return PHR.decrypt_records(pairing_pickle.deserialize(PHR.group, params), user,
+                               pairing_pickle.deserialize(PHR.group, user_key), names, fields)
+
+
+def decrypt_records(group, params, user, user_key, names, fields, processes, chunk_size=64):
+    """
+    Run PHR.decrypt_records for chunks of names in a pool of worker processes.
+    The workers load the records themselves. At most two chunks per worker are
+    in flight, so a slow consumer doesn't keep every record in memory.
+
+    :return:    Generator of the results of PHR.decrypt_records, in the order of names
+    """
+    params = pairing_pickle.serialize(group, params)
+    user_key = pairing_pickle.serialize(group, user_key)
+    with ProcessPoolExecutor(processes) as pool:
+        pending = deque()
+        for i in range(0, len(names), chunk_size):
+            pending.append(pool.submit(_decrypt_records, params, user, user_key, names[i:i + chunk_size], fields))
+            if len(pending) >= 2 * processes:
+                yield from pending.popleft().result()
+        while pending:
+            yield from pending.popleft().result()
+
+
+def _generate_user_keys(master_key, identities):
+    import PHR
+    return PHR.generate_user_keys(pairing_pickle.deserialize(PHR.group, master_key), identities)
+
+
+def generate_user_keys(group, master_key, chunks_of_identities, processes):
+    """
+    Run PHR.generate_user_keys for chunks of identities in a pool of worker
+    processes, with at most two chunks per worker in flight.
+
+    :param chunks_of_identities:    Iterable of lists of identities
+    :return:                        Generator of (identity, key) tuples, the keys in the binary format
+    """
+    master_key = pairing_pickle.serialize(group, master_key)
+    with ProcessPoolExecutor(processes) as pool:
+        pending = deque()
+        for chunk in chunks_of_identities:
+            pending.append(pool.submit(_generate_user_keys, master_key, chunk))
+            if len(pending) >= 2 * processes:
+                yield from pending.popleft().result()
+        while pending:
+            yield from pending.popleft().result()
+
+
+def _import_rows(params, writer, writer_key, rows, re_encryption_keys):
+    import bulk_import
+    import PHR
+    records = bulk_import.encrypt_rows(pairing_pickle.deserialize(PHR.group, params), writer,
+                                       pairing_pickle.deserialize(PHR.group, writer_key), rows,
+                                       pairing_pickle.deserialize(PHR.group, re_encryption_keys))
+    return [(pairing_pickle.serialize(PHR.group, r), pairing_pickle.serialize(PHR.group, c)) for r, c in records]
+
+
+def submit_import(pool, group, params, writer, writer_key, rows, re_encryption_keys, processes):
+    """
+    Submit bulk_import.encrypt_rows for rows to a pool of worker processes,
+    without waiting for the result (see collect_import).
+
+    :return:    The futures of the chunks of rows
+    """
+    params = pairing_pickle.serialize(group, params)
+    writer_key = pairing_pickle.serialize(group, writer_key)
+    re_encryption_keys = pairing_pickle.serialize(group, re_encryption_keys)
+    return [pool.submit(_import_rows, params, writer, writer_key, chunk, re_encryption_keys)
+            for chunk in chunks(rows, processes)]
+
+
+def collect_import(group, futures):
+    """
+    :return:    The (encrypted record, reencrypted copy) tuples of futures, in order
+    """
+    return [(pairing_pickle.deserialize(group, r), pairing_pickle.deserialize(group, c))
+            for f in futures for r, c in f.result()]
@@ -2,57 +2,269 @@
 
 Usage:
     proxy.py
-    proxy.py reencrypt <from-user> <to-user> -r <record> -t <type> 
+    proxy.py reencrypt <from-user> <to-user> -r <record> -t <type> [--profile=<format>]
+    proxy.py reencrypt-all <from-user> <to-user> -t <type> [-p <processes>] [--profile=<format>]
+    proxy.py serve [-s <socket>] [-p <processes>]
     proxy.py -h|--help
     proxy.py -v|--version
 Options:
     -h --help                       Show this screen.
     -v --version                    Show version.
+    --profile=<format>              Print operation counts and stage timings to stderr, as json or prometheus.
 """
 
+import json
 import os
-from pathlib import Path
+import queue
+import socketserver
+import threading
+from concurrent.futures import ProcessPoolExecutor
 
-import pairing_pickle
-from charm.toolbox.pairinggroup import PairingGroup
+import envelope
+import instrumentation
+import parallel
+import proxy_client
 from docopt import docopt
-from json_helper import DataHelper
-from type_id_proxy_reencryption import TIPRE
+from storage import RecordAlreadyExists
 
 import PHR
 
-dir_path = os.path.dirname(os.path.realpath(__file__))
 
-kgc_path = Path('{}/keys/kgc'.format(dir_path))
-reencryption_path = Path('{}/keys/reencryption'.format(dir_path))
-group = PairingGroup('SS512', secparam=1024)
-pre = TIPRE(group)
-data_helper = DataHelper(group)
+def get_params():
+    return PHR.get_params()
 
 
-def get_params():
-    with (kgc_path / 'params').open(mode='rb') as f:
-        return pairing_pickle.load(group, f)
+def load_reencryption_key(user, to_user, type_attribute):
+    return PHR.keystore.load(PHR.reencryption_key_path(user, to_user, type_attribute))
 
 
-def reEncrypt(user, to_user, record, type_attribute):
-    ciphertext = data_helper.load(user, record)
+def reencryption_name(user, record):
+    return "reencryption_from_{}_{}".format(user, record)
+
+
+def reencrypted_copy(params, re_encryption_key, ciphertext, user, record):
+    """
+    Copy of an encrypted record of user with its capsule reencrypted. The copy
+    only holds the capsule and a reference to the record, of which the columns
+    are stored once (see DataHelper.load). The capsule of a record in envelope
+    mode stays the same, its KEK is reencrypted instead (see reencrypt_kek).
+    """
+    capsule = ciphertext[PHR.SYMKEY()]
+    if not envelope.is_envelope(capsule):
+        capsule = PHR.pre.reEncrypt(params, re_encryption_key, capsule)
+    return {PHR.SYMKEY(): capsule, PHR.ORIGINAL(): {'owner': user, 'record': record}}
+
+
+def reencrypt_kek(params, user, to_user, type_attribute, epoch):
+    """
+    Reencrypt the KEK of user for the type and epoch for to_user, once.
+
+    :return:    False when to_user has no access to this epoch
+    """
+    if PHR.keks.exists(to_user, user, type_attribute, epoch):
+        return True
+    try:
+        re_encryption_key = load_reencryption_key(user, to_user, envelope.kek_type(type_attribute, epoch))
+    except FileNotFoundError:
+        return False
+    capsule = PHR.pre.reEncrypt(params, re_encryption_key, PHR.keks.load(user, user, type_attribute, epoch))
+    PHR.keks.save(to_user, user, type_attribute, epoch, capsule)
+    return True
+
+
+def reencrypt_record(params, re_encryption_key, user, to_user, record, type_attribute, ciphertext=None):
+    """
+    Reencrypt a record of user for to_user
+
+    :return:    The reencrypted capsule, None when to_user has no access to
+                the epoch of a record in envelope mode
+    """
+    if ciphertext is None:
+        ciphertext = PHR.data_helper.load(user, record)
 
+    capsule = ciphertext[PHR.SYMKEY()]
+    if envelope.is_envelope(capsule) and not reencrypt_kek(params, user, to_user, capsule['C3'],
+                                                           capsule['Envelope']):
+        return None
+
+    # Reencrypt the data
+    with instrumentation.stage('proxy.reencrypt'):
+        ciphertext = reencrypted_copy(params, re_encryption_key, ciphertext, user, record)
+    PHR.data_helper.save(to_user, type_attribute, ciphertext, reencryption_name(user, record), user, record)
+    return ciphertext[PHR.SYMKEY()]
+
+
+def reEncrypt(user, to_user, record, type_attribute):
     # Retrieve the reencryption key
-    with (reencryption_path / 'from_{}_to_{}_type_{}'.format(user, to_user, type_attribute)).open(mode='rb') as f:
-        re_encryption_key = pairing_pickle.load(group, f)
+    re_encryption_key = load_reencryption_key(user, to_user, type_attribute)
+    return reencrypt_record(get_params(), re_encryption_key, user, to_user, record, type_attribute)
+
+
+def own_records(user, type_attribute, records=None):
+    """
+    Names of the records of user with the given type that user wrote, from the
+    metadata index. Records of other types and copies that were reencrypted for
+    user are left out without reading them.
+
+    :param records:     Only these records, None for all records of user
+    """
+    if records is None:
+        return [m.name for m in PHR.data_helper.list_records(user, type_attribute=type_attribute, writer=user) or []]
+    metadata = (PHR.data_helper.get_metadata(user, record) for record in records)
+    return [m.name for m in metadata if m is not None and m.type == type_attribute and m.writer == user]
+
+
+def reencrypt_records(params, re_encryption_key, user, to_user, type_attribute, records):
+    """
+    Reencrypt records of user with the given type (see own_records), skipping
+    records of epochs to_user has no access to and records that to_user
+    already has.
+
+    :return:    Names of the reencrypted records
+    """
+    reencrypted = []
+    with PHR.data_helper.group_commit():
+        for record in records:
+            try:
+                if reencrypt_record(params, re_encryption_key, user, to_user, record, type_attribute) is not None:
+                    reencrypted.append(record)
+            except RecordAlreadyExists:
+                pass
+    return reencrypted
 
-        # Reencrypt the data
-    cipher = pre.reEncrypt(get_params(), re_encryption_key, ciphertext[PHR.SYMKEY()])
-    ciphertext[PHR.SYMKEY()] = cipher
-    data_helper.save(to_user, type_attribute, ciphertext, "reencryption_from_{}_{}".format(user, record))
-    return cipher
+
+def reEncryptRecords(user, to_user, type_attribute, records):
+    """
+    Reencrypt the given records of user with the given type for to_user, with
+    one load of the reencryption key.
+
+    :return:    Names of the reencrypted records
+    """
+    re_encryption_key = load_reencryption_key(user, to_user, type_attribute)
+    return reencrypt_records(get_params(), re_encryption_key, user, to_user, type_attribute,
+                             own_records(user, type_attribute, records))
+
+
+def reEncryptAll(user, to_user, type_attribute, processes=None):
+    """
+    Reencrypt every record of user with the given type for to_user. The
+    reencryption key is loaded once and the records are spread over a pool
+    of worker processes.
+
+    :param user:            The delegator
+    :param to_user:         The delegatee
+    :param type_attribute:  Type of the records to reencrypt
+    :param processes:       Number of worker processes, None to reencrypt in this process
+    :return:                Names of the reencrypted records
+    """
+    re_encryption_key = load_reencryption_key(user, to_user, type_attribute)
+    records = own_records(user, type_attribute)
+    if processes and len(records) > 1:
+        reencrypted = parallel.reencrypt_records(PHR.group, re_encryption_key, user, to_user, type_attribute, records,
+                                                 processes)
+    else:
+        reencrypted = reencrypt_records(get_params(), re_encryption_key, user, to_user, type_attribute, records)
+    print("Reencrypted {} records of {} with type {} for {}".format(len(reencrypted), user, type_attribute, to_user))
+    return reencrypted
+
+
+def run_job(job):
+    """
+    Run a job of the proxy service
+    """
+    if job['op'] == 'reencrypt':
+        reEncrypt(job['from_user'], job['to_user'], job['record'], job['type'])
+        return reencryption_name(job['from_user'], job['record'])
+    elif job['op'] == 'reencrypt-records':
+        return reEncryptRecords(job['from_user'], job['to_user'], job['type'], job['records'])
+    elif job['op'] == 'reencrypt-all':
+        return reEncryptAll(job['from_user'], job['to_user'], job['type'])
+    elif job['op'] == 'ping':
+        return 'pong'
+    else:
+        raise ValueError('Unknown operation {}'.format(job['op']))
+
+
+class ProxyHandler(socketserver.StreamRequestHandler):
+    """
+    Handles one client connection. Jobs are read as JSON lines and run in the
+    worker pool as soon as they arrive, the results are written back in order.
+    """
+
+    def handle(self):
+        responses = queue.Queue()
+        writer = threading.Thread(target=self.respond, args=(responses,))
+        writer.start()
+        try:
+            for line in self.rfile:
+                try:
+                    responses.put(self.server.pool.submit(run_job, json.loads(line.decode('utf-8'))))
+                except ValueError as e:
+                    responses.put(e)
+        finally:
+            responses.put(None)
+            writer.join()
+
+    def respond(self, responses):
+        while True:
+            job = responses.get()
+            if job is None:
+                return
+            try:
+                if isinstance(job, Exception):
+                    raise job
+                response = {'ok': True, 'result': job.result()}
+            except Exception as e:
+                response = {'ok': False, 'error': type(e).__name__, 'message': str(getattr(e, 'message', e))}
+            try:
+                self.wfile.write(json.dumps(response).encode('utf-8') + b'\n')
+                self.wfile.flush()
+            except OSError:
+                pass
+
+
+class ProxyServer(socketserver.ThreadingUnixStreamServer):
+    daemon_threads = True
+
+    def __init__(self, socket_path, processes=None):
+        if os.path.exists(socket_path):
+            os.unlink(socket_path)
+        super().__init__(socket_path, ProxyHandler)
+        self.pool = ProcessPoolExecutor(processes)
+
+    def server_close(self):
+        super().server_close()
+        self.pool.shutdown()
+        os.unlink(self.server_address)
+
+
+def serve(socket_path=proxy_client.SOCKET_PATH, processes=None):
+    """
+    Run the proxy as a service on a Unix socket. The worker processes keep the
+    params and reencryption keys they loaded in their keystore between jobs.
+
+    :param socket_path:     Path of the Unix socket
+    :param processes:       Number of worker processes, defaults to the number of cores
+    """
+    with ProxyServer(socket_path, processes) as server:
+        print('Proxy listening on {}'.format(socket_path))
+        try:
+            server.serve_forever()
+        except KeyboardInterrupt:
+            pass
 
 
 if __name__ == '__main__':
     arguments = docopt(__doc__, version='0.1')
-    if arguments['reencrypt'] and arguments['<from-user>'] and arguments['<to-user>'] and arguments['<record>'] and \
-            arguments['<type>']:
-        reEncrypt(arguments['<from-user>'], arguments['<to-user>'], arguments['<record>'], arguments['<type>'])
-    else:
-        print(__doc__)
+    with instrumentation.cli_profile(arguments['--profile'], lambda: PHR.group):
+        if arguments['reencrypt'] and arguments['<from-user>'] and arguments['<to-user>'] and \
+                arguments['<record>'] and arguments['<type>']:
+            reEncrypt(arguments['<from-user>'], arguments['<to-user>'], arguments['<record>'], arguments['<type>'])
+        elif arguments['reencrypt-all'] and arguments['<from-user>'] and arguments['<to-user>'] and arguments['<type>']:
+            reEncryptAll(arguments['<from-user>'], arguments['<to-user>'], arguments['<type>'],
+                         int(arguments['<processes>'] or os.cpu_count()))
+        elif arguments['serve']:
+            serve(arguments['<socket>'] or proxy_client.SOCKET_PATH,
+                  int(arguments['<processes>']) if arguments['<processes>'] else None)
+        else:
+            print(__doc__)
@@ -0,0 +1,103 @@
+"""
+Client for the proxy service (proxy.py serve). Jobs are sent as JSON lines over
+a Unix socket and may be pipelined: the service answers them in order.
+"""
+import json
+import os
+import socket
+
+dir_path = os.path.dirname(os.path.realpath(__file__))
+
+SOCKET_PATH = os.environ.get('PHR_PROXY_SOCKET', '{}/proxy.sock'.format(dir_path))
+
+
+class ProxyError(Exception):
+    def __init__(self, error, message):
+        self.error = error
+        self.message = message
+
+    def __str__(self):
+        return self.message
+
+
+class ProxyClient:
+
+    def __init__(self, socket_path=SOCKET_PATH):
+        self.socket_path = socket_path
+        self.sock = None
+        self.rfile = None
+        self.pending = 0
+
+    def __enter__(self):
+        self.connect()
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def connect(self):
+        """
+        Connect to the proxy service, raises an OSError when it is not running
+        """
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        try:
+            self.sock.connect(str(self.socket_path))
+        except OSError:
+            self.sock.close()
+            self.sock = None
+            raise
+        self.rfile = self.sock.makefile('rb')
+
+    def close(self):
+        if self.sock is not None:
+            self.rfile.close()
+            self.sock.close()
+            self.sock = None
+
+    def submit(self, op, **job):
+        """
+        Send a job without waiting for its result
+        """
+        job['op'] = op
+        self.sock.sendall(json.dumps(job).encode('utf-8') + b'\n')
+        self.pending += 1
+
+    def result(self):
+        """
+        Wait for the result of the oldest submitted job
+        """
+        line = self.rfile.readline()
+        if not line:
+            raise ProxyError('ConnectionError', 'Proxy service closed the connection')
+        self.pending -= 1
+        response = json.loads(line.decode('utf-8'))
+        if not response['ok']:
+            raise ProxyError(response['error'], response['message'])
+        return response['result']
+
+    def results(self):
+        """
+        Wait for the results of all submitted jobs, in order. Failed jobs give
+        a ProxyError instead of a result.
+        """
+        results = []
+        while self.pending:
+            try:
+                results.append(self.result())
+            except ProxyError as e:
+                if e.error == 'ConnectionError':
+                    raise
+                results.append(e)
+        return results
+
+    def reencrypt(self, from_user, to_user, record, type_attribute):
+        self.submit('reencrypt', from_user=from_user, to_user=to_user, record=record, type=type_attribute)
+        return self.result()
+
+    def reencrypt_records(self, from_user, to_user, type_attribute, records):
+        self.submit('reencrypt-records', from_user=from_user, to_user=to_user, type=type_attribute, records=records)
+        return self.result()
+
+    def reencrypt_all(self, from_user, to_user, type_attribute):
+        self.submit('reencrypt-all', from_user=from_user, to_user=to_user, type=type_attribute)
+        return self.result()
@@ -0,0 +1,638 @@
+"""Storage backends for the records of DataHelper
+
+Usage:
+    storage.py migrate <from-backend> <to-backend> [<user>...]
+    storage.py compact [<user>...]
+    storage.py -h|--help
+Options:
+    -h --help                       Show this screen.
+
+Backends: file (one file per record) and segment (append-only segment log per user).
+
+Several processes can write to the same backend. A record only appears under
+its name once it is completely written, and of concurrent writers of one name
+only the first succeeds, the others get RecordAlreadyExists. Records are not
+fsynced by default: set PHR_FSYNC=1 to fsync every record, or write a batch in
+a group commit (see Durability).
+"""
+import fcntl
+import mmap
+import os
+import struct
+import threading
+from contextlib import contextmanager
+from os import listdir
+from os.path import isfile, join
+from pathlib import Path
+
+import layout
+
+dir_path = os.path.dirname(os.path.realpath(__file__))
+
+
+class RecordAlreadyExists(Exception):
+    def __init__(self, message):
+        super().__init__(message)
+        self.message = message
+
+
+def create_folder(path):
+    Path(path).mkdir(parents=True, exist_ok=True)
+
+
+@contextmanager
+def locked(path):
+    """
+    Hold an exclusive advisory lock on the file path, created when it doesn't
+    exist. The lock is between processes as well as between threads.
+    """
+    fd = os.open(path, os.O_RDWR | os.O_CREAT, 0o644)
+    try:
+        fcntl.flock(fd, fcntl.LOCK_EX)
+        yield
+    finally:
+        os.close(fd)
+
+
+def fsync_path(path):
+    fd = os.open(path, os.O_RDONLY)
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+
+class Durability:
+    """
+    When the files of a backend are fsynced: never (the default), after every
+    write (sync, or PHR_FSYNC=1), or all at once at the end of a group commit.
+    A group commit lets a batch writer pay for one round of fsyncs per batch;
+    records of a group that is not committed yet can be lost by a crash.
+    """
+
+    def __init__(self, sync=None):
+        self.sync = sync if sync is not None else os.environ.get('PHR_FSYNC') == '1'
+        self.pending = None
+        self._lock = threading.Lock()
+
+    def file(self, f, path):
+        """
+        A file was written, before it is made visible under path
+        """
+        with self._lock:
+            if self.pending is not None:
+                self.pending.add(str(path))
+                return
+        if self.sync:
+            f.flush()
+            os.fsync(f.fileno())
+
+    def directory(self, path):
+        """
+        A file was created in, renamed in or linked into the directory path
+        """
+        with self._lock:
+            if self.pending is not None:
+                self.pending.add(str(path))
+                return
+        if self.sync:
+            fsync_path(path)
+
+    @contextmanager
+    def group(self):
+        """
+        Defer the fsyncs of the files written inside the block to its end.
+        Nested groups are committed with the outermost one. Without sync,
+        there is nothing to defer.
+        """
+        if not self.sync:
+            yield
+            return
+        with self._lock:
+            outer = self.pending is None
+            if outer:
+                self.pending = set()
+        try:
+            yield
+        finally:
+            if outer:
+                with self._lock:
+                    pending, self.pending = self.pending, None
+                for path in sorted(pending):
+                    try:
+                        fsync_path(path)
+                    except FileNotFoundError:
+                        # Deleted or compacted meanwhile
+                        pass
+
+
+class FileBackend:
+    """
+    Stores every record in its own file, data/<user>/<record>.rec, where
+    the directory of the user is placed by layout.py. Records that were
+    written as data/<user>/<record>.json are still read.
+    """
+    SUFFIXES = ('.rec', '.json')
+
+    def __init__(self, data_path='{}/data/'.format(dir_path), durability=None):
+        self.data_path = data_path
+        self.durability = durability if durability is not None else Durability()
+        create_folder(self.data_path)
+
+    def _path(self, user, name, suffix='.rec'):
+        return layout.current().path(self.data_path, user) / '{}{}'.format(name, suffix)
+
+    def _existing(self, user, name):
+        for directory in layout.current().candidates(self.data_path, user):
+            for suffix in self.SUFFIXES:
+                path = directory / '{}{}'.format(name, suffix)
+                if path.exists():
+                    return path
+        return None
+
+    def exists(self, user, name):
+        return self._existing(user, name) is not None
+
+    def write(self, user, name, payload):
+        path = self._path(user, name)
+        create_folder(path.parent)
+
+        if self.exists(user, name):
+            raise RecordAlreadyExists('Record with this name already exists, choose a different name')
+        # The record is written to a temporary file and then linked to its
+        # name, which fails when a concurrent writer was first
+        tmp = path.with_name('{}.{}.{}.tmp'.format(path.name, os.getpid(), threading.get_ident()))
+        try:
+            with open(tmp, 'wb') as outfile:
+                outfile.write(payload)
+                self.durability.file(outfile, path)
+            try:
+                os.link(tmp, path)
+            except FileExistsError:
+                raise RecordAlreadyExists('Record with this name already exists, choose a different name')
+        finally:
+            tmp.unlink()
+        self.durability.directory(path.parent)
+
+    def read(self, user, name):
+        path = self._existing(user, name)
+        if path is None:
+            raise FileNotFoundError(self._path(user, name))
+        with open(path, 'rb') as infile:
+            return infile.read()
+
+    def delete(self, user, name):
+        path = self._existing(user, name)
+        if path is None:
+            raise FileNotFoundError(self._path(user, name))
+        path.unlink()
+
+    def mtime(self, user, name):
+        """
+        Time the record was written, in seconds since the epoch
+        """
+        path = self._existing(user, name)
+        if path is None:
+            raise FileNotFoundError(self._path(user, name))
+        return path.stat().st_mtime
+
+    def list(self, user):
+        """
+        Names of the records of user, or None if user has no records
+        """
+        paths = [path for path in layout.current().candidates(self.data_path, user) if path.exists()]
+
+        if paths:
+            # While a migration runs, the records can be in both directories
+            return sorted({os.path.splitext(f)[0] for path in paths for f in listdir(path)
+                           if isfile(join(path, f)) and os.path.splitext(f)[1] in self.SUFFIXES})
+        else:
+            return None
+
+    def users(self):
+        return layout.current().names(self.data_path, directories=True)
+
+    def lock(self, user):
+        """
+        Advisory lock of the records of user, see locked. Its file is not
+        moved by a layout migration, see layout.lock_path.
+        """
+        return locked(layout.lock_path(self.data_path, user))
+
+    def compact(self, user):
+        pass
+
+
+class Segments:
+    """
+    Append-only segment log of one user, with an offset index on disk.
+
+    A segment is a file with a magic header followed by entries:
+    name length (2 bytes), payload length (4 bytes), name, payload. A payload
+    length of TOMBSTONE marks a deleted record. Every entry is also appended
+    to the index as a line 'name segment offset length'. When the index
+    misses entries at the end (a crash between the two writes), they are
+    recovered by scanning the last segment.
+
+    Writers of the log, in any process, hold its lock file while they append,
+    and readers pick up their entries from the index. Within a process, the
+    entries are read and updated under a thread lock.
+    """
+    MAGIC = b'PHRSEG01'
+    ENTRY = struct.Struct('>HI')
+    TOMBSTONE = 0xFFFFFFFF
+
+    def __init__(self, path, segment_size, durability=None, lock_path=None):
+        """
+        :param lock_path:   Lock file of the log, by default the file lock in the log
+        """
+        self.path = Path(path)
+        self.lock_path = Path(lock_path) if lock_path is not None else self.path / 'lock'
+        self.segment_size = segment_size
+        self.durability = durability if durability is not None else Durability()
+        self._lock = threading.RLock()
+        self._reset()
+        if self.path.exists():
+            with self.locked():
+                self._refresh()
+                self._recover()
+
+    def _reset(self):
+        self.entries = {}
+        self.ends = {}
+        self.index_position = 0
+        self.index_inode = None
+        self.maps = {}
+
+    @contextmanager
+    def locked(self):
+        """
+        Hold the lock of the log, between threads and between processes
+        """
+        create_folder(self.path)
+        with self._lock, locked(self.lock_path):
+            yield
+
+    def _segment_path(self, segment):
+        return self.path / '{:08d}.seg'.format(segment)
+
+    def _segments(self):
+        if not self.path.exists():
+            return []
+        return sorted(int(f[:-4]) for f in listdir(self.path) if f.endswith('.seg'))
+
+    def _apply(self, name, segment, offset, length):
+        self.entries.pop(name, None)
+        if length != self.TOMBSTONE:
+            self.entries[name] = (segment, offset, length)
+        else:
+            length = 0
+        self.ends[segment] = max(self.ends.get(segment, 0), offset + length)
+
+    def _refresh(self):
+        """
+        Read the index lines that were appended since the last refresh
+        """
+        index = self.path / 'index'
+        try:
+            f = index.open('rb')
+        except FileNotFoundError:
+            return
+        with f:
+            # The log was compacted by another process
+            inode = os.fstat(f.fileno()).st_ino
+            if inode != self.index_inode:
+                if self.index_inode is not None:
+                    self._reset()
+                self.index_inode = inode
+            f.seek(self.index_position)
+            data = f.read()
+        end = data.rfind(b'\n') + 1
+        for line in data[:end].splitlines():
+            name, segment, offset, length = line.rsplit(b' ', 3)
+            self._apply(name.decode('utf-8'), int(segment), int(offset), int(length))
+        self.index_position += end
+
+    def _recover(self):
+        """
+        Index the entries at the end of the log that are missing from the index
+        """
+        last = max(self.ends) if self.ends else 0
+        for segment in self._segments():
+            if segment < last:
+                continue
+            data = self._segment_path(segment).read_bytes()
+            offset = self.ends.get(segment, len(self.MAGIC))
+            while offset + self.ENTRY.size <= len(data):
+                name_length, length = self.ENTRY.unpack_from(data, offset)
+                payload = offset + self.ENTRY.size + name_length
+                end = payload + (0 if length == self.TOMBSTONE else length)
+                if end > len(data):
+                    break
+                name = data[offset + self.ENTRY.size:payload].decode('utf-8')
+                self._append_index(name, segment, payload, length)
+                self._apply(name, segment, payload, length)
+                offset = end
+
+    @property
+    def segment(self):
+        return max(self.ends) if self.ends else 1
+
+    def _append_index(self, name, segment, offset, length):
+        path = self.path / 'index'
+        with path.open('ab') as f:
+            if self.index_inode is None:
+                self.index_inode = os.fstat(f.fileno()).st_ino
+            f.write('{} {} {} {}\n'.format(name, segment, offset, length).encode('utf-8'))
+            self.index_position = f.tell()
+            self.durability.file(f, path)
+
+    def _append(self, name, payload, length):
+        # Called with the lock held and the index refreshed
+        segment = self.segment
+        path = self._segment_path(segment)
+        if path.exists() and path.stat().st_size >= self.segment_size:
+            segment += 1
+            path = self._segment_path(segment)
+        encoded = name.encode('utf-8')
+        with path.open('ab') as f:
+            created = f.tell() == 0
+            if created:
+                f.write(self.MAGIC)
+            offset = f.tell() + self.ENTRY.size + len(encoded)
+            f.write(self.ENTRY.pack(len(encoded), length) + encoded + payload)
+            self.durability.file(f, path)
+        self._append_index(name, segment, offset, length)
+        self._apply(name, segment, offset, length)
+        if created:
+            self.durability.directory(self.path)
+
+    def exists(self, name):
+        with self._lock:
+            if name not in self.entries:
+                self._refresh()
+            return name in self.entries
+
+    def write(self, name, payload):
+        with self.locked():
+            self._refresh()
+            if name in self.entries:
+                raise RecordAlreadyExists('Record with this name already exists, choose a different name')
+            self._append(name, payload, len(payload))
+
+    def delete(self, name):
+        with self.locked():
+            self._refresh()
+            if name not in self.entries:
+                raise FileNotFoundError(name)
+            self._append(name, b'', self.TOMBSTONE)
+
+    def read(self, name):
+        """
+        The payload of a record, as a memoryview on the memory mapped segment
+        """
+        with self._lock:
+            if not self.exists(name):
+                raise FileNotFoundError(name)
+            try:
+                return self._read(name)
+            except FileNotFoundError:
+                # The segment was dropped by a compaction in another process
+                self._reset()
+                self._refresh()
+                if name not in self.entries:
+                    raise
+                return self._read(name)
+
+    def _read(self, name):
+        segment, offset, length = self.entries[name]
+        mm = self.maps.get(segment)
+        if mm is None or len(mm) < offset + length:
+            with self._segment_path(segment).open('rb') as f:
+                mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            self.maps[segment] = mm
+        return memoryview(mm)[offset:offset + length]
+
+    def list(self):
+        with self._lock:
+            self._refresh()
+            return list(self.entries)
+
+    def mtime(self, name):
+        """
+        Modification time of the segment of a record. Entries have no time of
+        their own, so this is the time of the last append to the segment, at
+        or after the record was written.
+        """
+        with self._lock:
+            if not self.exists(name):
+                raise FileNotFoundError(name)
+            return self._segment_path(self.entries[name][0]).stat().st_mtime
+
+    def compact(self):
+        """
+        Rewrite the live records into new segments and drop the old segments,
+        reclaiming the space of deleted records.
+        """
+        with self.locked():
+            self._compact()
+
+    def _compact(self):
+        self._refresh()
+        old = self._segments()
+        if not old:
+            return
+        segment = old[-1] + 1
+        f = self._segment_path(segment).open('wb')
+        f.write(self.MAGIC)
+        lines = []
+        # The new segments keep the latest modification time of the segments their records come from
+        mtimes, old_mtimes = {}, {s: self._segment_path(s).stat().st_mtime for s in old}
+        for name in list(self.entries):
+            payload = self.read(name)
+            mtime = old_mtimes[self.entries[name][0]]
+            if f.tell() >= self.segment_size:
+                f.flush()
+                os.fsync(f.fileno())
+                f.close()
+                segment += 1
+                f = self._segment_path(segment).open('wb')
+                f.write(self.MAGIC)
+            encoded = name.encode('utf-8')
+            offset = f.tell() + self.ENTRY.size + len(encoded)
+            f.write(self.ENTRY.pack(len(encoded), len(payload)) + encoded)
+            f.write(payload)
+            lines.append('{} {} {} {}\n'.format(name, segment, offset, len(payload)))
+            mtimes[segment] = max(mtimes.get(segment, 0), mtime)
+        f.flush()
+        os.fsync(f.fileno())
+        f.close()
+        for s, mtime in mtimes.items():
+            os.utime(self._segment_path(s), (mtime, mtime))
+
+        self.maps = {}
+        self.entries = {}
+        self.ends = {}
+        for line in lines:
+            name, s, offset, length = line.rsplit(' ', 3)
+            self._apply(name, int(s), int(offset), int(length))
+        self.ends[segment] = max(self.ends.get(segment, len(self.MAGIC)), self._segment_path(segment).stat().st_size)
+
+        with (self.path / 'index.tmp').open('wb') as f:
+            f.write(''.join(lines).encode('utf-8'))
+            f.flush()
+            os.fsync(f.fileno())
+            self.index_position = f.tell()
+        os.replace(self.path / 'index.tmp', self.path / 'index')
+        self.index_inode = os.stat(self.path / 'index').st_ino
+        fsync_path(self.path)
+        for s in old:
+            self._segment_path(s).unlink()
+
+
+class SegmentBackend:
+    """
+    Stores the records of every user in an append-only segment log,
+    segments/<user>/<n>.seg, with an offset index segments/<user>/index. The
+    directory of the user is placed by layout.py.
+    """
+
+    def __init__(self, data_path='{}/segments/'.format(dir_path), segment_size=64 * 1024 * 1024, durability=None):
+        self.data_path = data_path
+        self.segment_size = segment_size
+        self.durability = durability if durability is not None else Durability()
+        self.logs = {}
+        self._lock = threading.Lock()
+        create_folder(self.data_path)
+
+    def _log(self, user):
+        # Logs are kept by path, a migration moves a log to a new one
+        path = layout.current().find(self.data_path, user)
+        with self._lock:
+            log = self.logs.get(path)
+            if log is None:
+                log = self.logs[path] = Segments(path, self.segment_size, self.durability,
+                                                 layout.lock_path(self.data_path, user, 'log'))
+        return log
+
+    def exists(self, user, name):
+        return self._log(user).exists(name)
+
+    def write(self, user, name, payload):
+        self._log(user).write(name, payload)
+
+    def read(self, user, name):
+        return self._log(user).read(name)
+
+    def delete(self, user, name):
+        self._log(user).delete(name)
+
+    def list(self, user):
+        """
+        Names of the records of user, or None if user has no records
+        """
+        if not layout.current().find(self.data_path, user).exists():
+            return None
+        return self._log(user).list()
+
+    def mtime(self, user, name):
+        return self._log(user).mtime(name)
+
+    def users(self):
+        return layout.current().names(self.data_path, directories=True)
+
+    def lock(self, user):
+        """
+        Advisory lock of the records of user, see locked. It is not the lock
+        of the log, which is only held while appending. Neither is moved by a
+        layout migration, see layout.lock_path.
+        """
+        return locked(layout.lock_path(self.data_path, user))
+
+    def compact(self, user):
+        self._log(user).compact()
+
+
+class BlobStore:
+    """
+    Stores the chunked encrypted fields of records (see streaming.py) as
+    blobs/<user>/<name>, whatever the backend of the records is. The
+    directory of the user is placed by layout.py.
+    """
+
+    def __init__(self, path='{}/blobs/'.format(dir_path), durability=None):
+        self.path = path
+        self.durability = durability if durability is not None else Durability()
+
+    def _path(self, user, name):
+        return layout.current().find(self.path, user, name)
+
+    @contextmanager
+    def create(self, user, name):
+        """
+        Open a new blob for writing. The blob only appears under its name once
+        it is completely written.
+        """
+        path = layout.current().path(self.path, user) / name
+        create_folder(path.parent)
+        tmp = path.with_name(path.name + '.tmp')
+        try:
+            with open(tmp, 'wb') as f:
+                yield f
+                self.durability.file(f, path)
+            os.replace(tmp, path)
+            self.durability.directory(path.parent)
+        finally:
+            if tmp.exists():
+                tmp.unlink()
+
+    def open(self, user, name):
+        return open(self._path(user, name), 'rb')
+
+    def delete(self, user, name):
+        self._path(user, name).unlink()
+
+
+BACKENDS = {'file': FileBackend, 'segment': SegmentBackend}
+
+
+def open_backend(name=None):
+    """
+    Create the storage backend with the given name, by default the one named
+    by the PHR_STORAGE environment variable, or 'file'
+    """
+    return BACKENDS[name or os.environ.get('PHR_STORAGE', 'file')]()
+
+
+def migrate(source, target, users=None):
+    """
+    Copy the records of users (by default all users) from one backend to
+    another. Records that the target already has are skipped.
+
+    :return:    Number of copied records
+    """
+    copied = 0
+    for user in users or source.users():
+        for name in source.list(user) or []:
+            if not target.exists(user, name):
+                target.write(user, name, bytes(source.read(user, name)))
+                copied += 1
+    return copied
+
+
+if __name__ == '__main__':
+    from docopt import docopt
+
+    arguments = docopt(__doc__, version='0.1')
+    if arguments['migrate']:
+        source = open_backend(arguments['<from-backend>'])
+        target = open_backend(arguments['<to-backend>'])
+        print('Copied {} records'.format(migrate(source, target, arguments['<user>'])))
+        from metadata import MetadataIndex
+        MetadataIndex('{}metadata.sqlite'.format(target.data_path)).forget(arguments['<user>'] or source.users())
+    elif arguments['compact']:
+        backend = open_backend()
+        for user in arguments['<user>'] or backend.users():
+            backend.compact(user)
+    else:
+        print(__doc__)
@@ -0,0 +1,138 @@
+"""
+Chunked encryption of large record fields. A streamed field is encrypted in
+fixed-size chunks with AuthenticatedCryptoAbstraction and written to a blob
+(see storage.BlobStore) as it is read, so only one chunk is in memory at a
+time. The record itself only holds a reference to the blob.
+
+Every chunk starts with its index and a flag for the last chunk before it is
+encrypted, so reordered, dropped or truncated chunks fail to decrypt. With a
+codec (see compression.py), every chunk is compressed before it is encrypted.
+"""
+import io
+import struct
+
+import compression
+import pairing_pickle
+
+CHUNK_SIZE = 64 * 1024
+STREAM_THRESHOLD = 1024 * 1024
+
+_LENGTH = struct.Struct('>I')
+_HEADER = struct.Struct('>Q?')
+
+
+def is_stream(value):
+    """
+    Whether a field value is encrypted in chunks: file-like objects and
+    values larger than STREAM_THRESHOLD
+    """
+    return hasattr(value, 'read') or (isinstance(value, (str, bytes)) and len(value) > STREAM_THRESHOLD)
+
+
+def is_reference(value):
+    return isinstance(value, dict) and 'stream' in value
+
+
+def _chunks(value, chunk_size):
+    if isinstance(value, str):
+        value = value.encode('utf-8')
+    if isinstance(value, bytes):
+        value = io.BytesIO(value)
+    while True:
+        chunk = value.read(chunk_size)
+        if not chunk:
+            return
+        yield chunk.encode('utf-8') if isinstance(chunk, str) else chunk
+
+
+def encrypt_stream(key, value, outfile, chunk_size=CHUNK_SIZE, codec=None):
+    """
+    Encrypt value chunk by chunk into outfile.
+
+    :param key:         Symmetric key (extract_key of the GT record key)
+    :param value:       File-like object, str or bytes
+    :param outfile:     Binary file to write the encrypted chunks to
+    :param chunk_size:  Number of plaintext bytes per chunk
+    :param codec:       Codec to compress the chunks with, None to not compress them
+    :return:            Number of plaintext bytes and chunks
+    """
+    from charm.toolbox.symcrypto import AuthenticatedCryptoAbstraction
+    cipher = AuthenticatedCryptoAbstraction(key)
+    size = index = 0
+    chunks = _chunks(value, chunk_size)
+    chunk = next(chunks, b'')
+    while True:
+        following = next(chunks, None)
+        ct = cipher.encrypt(_HEADER.pack(index, following is None) + compression.compress_chunk(codec, chunk))
+        blob = pairing_pickle.dumpb(None, ct)
+        outfile.write(_LENGTH.pack(len(blob)) + blob)
+        size += len(chunk)
+        index += 1
+        if following is None:
+            return size, index
+        chunk = following
+
+
+class DecryptedStream(io.RawIOBase):
+    """
+    Read-only file-like object that decrypts an encrypted stream one chunk at
+    a time. Iterating over it gives the decrypted chunks.
+    """
+
+    def __init__(self, key, infile, codec=None):
+        """
+        :param codec:   Codec the chunks were compressed with, None if they weren't
+        """
+        from charm.toolbox.symcrypto import AuthenticatedCryptoAbstraction
+        self.cipher = AuthenticatedCryptoAbstraction(key)
+        self.infile = infile
+        self.codec = codec
+        self.index = 0
+        self.done = False
+        self.buffer = b''
+
+    def readable(self):
+        return True
+
+    def next_chunk(self):
+        if self.done:
+            return None
+        length = self.infile.read(_LENGTH.size)
+        if len(length) < _LENGTH.size:
+            raise ValueError('Encrypted stream is truncated')
+        length, = _LENGTH.unpack(length)
+        blob = self.infile.read(length)
+        if len(blob) < length:
+            raise ValueError('Encrypted stream is truncated')
+        plain = self.cipher.decrypt(pairing_pickle.loadb(None, blob))
+        index, last = _HEADER.unpack_from(plain)
+        if index != self.index:
+            raise ValueError('Encrypted stream chunks are out of order')
+        self.index += 1
+        self.done = last
+        return compression.decompress(self.codec, plain[_HEADER.size:])
+
+    def __iter__(self):
+        if self.buffer:
+            yield self.buffer
+            self.buffer = b''
+        while True:
+            chunk = self.next_chunk()
+            if chunk is None:
+                return
+            yield chunk
+
+    def readinto(self, b):
+        while not self.buffer:
+            chunk = self.next_chunk()
+            if chunk is None:
+                return 0
+            self.buffer = chunk
+        n = min(len(b), len(self.buffer))
+        b[:n] = self.buffer[:n]
+        self.buffer = self.buffer[n:]
+        return n
+
+    def close(self):
+        self.infile.close()
+        super().close()
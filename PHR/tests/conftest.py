@@ -0,0 +1,35 @@
+import os
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.realpath(__file__))))
+# Imported before pytest puts the directory above on sys.path, where PHR is the package
+import PHR  # noqa: E402
+
+
+@pytest.fixture
+def phr(tmp_path, monkeypatch):
+    """
+    The PHR module with a KGC, records, blobs and keys in tmp_path instead of
+    the package directory, and without the proxy service
+    """
+    pytest.importorskip('charm')
+    import envelope
+    import proxy_client
+    import storage
+    from context import Context
+    from json_helper import DataHelper
+
+    monkeypatch.setattr(PHR, 'kgc_path', tmp_path / 'keys' / 'kgc')
+    monkeypatch.setattr(PHR, 'reencryption_path', tmp_path / 'keys' / 'reencryption')
+    monkeypatch.setattr(PHR, 'envelope_mode', False)
+    monkeypatch.setattr(proxy_client.ProxyClient.__init__, '__defaults__', (str(tmp_path / 'proxy.sock'),))
+    context = Context(PHR.kgc_path, PHR.reencryption_path)
+    monkeypatch.setattr(PHR, 'context', context)
+    # Generating the master key builds the group and the stores again, so they are replaced afterwards
+    PHR.kgc_generate_master()
+    context.data_helper = DataHelper(lambda: context.group, storage.FileBackend('{}/data/'.format(tmp_path)))
+    context.data_helper.blobs = storage.BlobStore('{}/blobs/'.format(tmp_path))
+    context.keks = envelope.KEKStore(context.group, context.keystore, tmp_path / 'keys' / 'kek')
+    return PHR
@@ -0,0 +1,54 @@
+import asyncio
+import threading
+import time
+
+import pytest
+
+pytest.importorskip('charm')
+from async_phr import AsyncPHR  # noqa: E402
+
+
+def test_tenants_are_dropped_without_requests_in_flight():
+    async def run():
+        async with AsyncPHR(processes=1, threads=4, per_tenant=2) as phr:
+            await asyncio.gather(*(phr._io('tenant{}'.format(i % 10), time.sleep, 0.001) for i in range(100)))
+            return phr._tenants
+
+    assert asyncio.run(run()) == {}
+
+
+def test_storage_calls_of_a_user_are_serialized():
+    running, overlaps = {}, []
+    lock = threading.Lock()
+
+    def storage_call(user):
+        with lock:
+            running[user] = running.get(user, 0) + 1
+            if running[user] > 1:
+                overlaps.append(user)
+        time.sleep(0.001)
+        with lock:
+            running[user] -= 1
+
+    async def run():
+        async with AsyncPHR(processes=1, threads=8) as phr:
+            await asyncio.gather(*(phr._storage(user, user, storage_call, user)
+                                   for user in ['alice', 'bob'] * 50))
+
+    asyncio.run(run())
+    assert overlaps == []
+
+
+def test_insert_fans_out_to_delegatees_only(phr):
+    alice, insurer, bob = phr.USER('alice'), phr.USER('insurer'), phr.USER('bob')
+    for user in (alice, insurer, bob):
+        phr.kgc_generate_user(user)
+    phr.allow_access(alice, insurer, 'medical')
+
+    async def run():
+        async with AsyncPHR(processes=1, threads=4) as async_phr:
+            copies = await async_phr.insert(alice, {'data': 'claim'}, 'claim', 'medical', fan_out=True)
+            return copies, await async_phr.reencrypt(alice, bob, 'claim', 'medical')
+
+    assert asyncio.run(run()) == ({insurer: ['claim']}, None)
+    assert phr.read(insurer, 'reencryption_from_user_alice_claim')['data'] == b'claim'
@@ -0,0 +1,61 @@
+import json
+
+import pytest
+
+import bulk_import
+
+
+def write_jsonl(path, rows):
+    path.write_text(''.join(json.dumps(row) + '\n' for row in rows))
+    return str(path)
+
+
+def test_reserved_field_names_are_rejected(tmp_path):
+    for key in ('enc_sym_key', 'original_record'):
+        path = write_jsonl(tmp_path / 'rows.jsonl', [
+            {'patient': 'alice', 'type': 'lab', 'record': 'r1', 'fields': {'data': 'fine'}},
+            {'patient': 'alice', 'type': 'lab', 'record': 'r2', 'fields': {key: 'x'}},
+        ])
+        with pytest.raises(ValueError, match='rows.jsonl:2: .*{}'.format(key)):
+            list(bulk_import.read_rows(path))
+
+    path = tmp_path / 'rows.csv'
+    path.write_text('patient,type,record,original_record\nalice,lab,r1,x\n')
+    with pytest.raises(ValueError, match='rows.csv:2: .*original_record'):
+        list(bulk_import.read_rows(str(path)))
+
+
+def test_csv_header_is_checked_before_the_import(phr, tmp_path):
+    good, bad = tmp_path / 'good.csv', tmp_path / 'bad.csv'
+    good.write_text('patient,type,record,data\nalice,lab,r1,x\n')
+    bad.write_text('patient,kind,data\nalice,lab,x\n')
+
+    with pytest.raises(ValueError, match='bad.csv:1: .*type, record'):
+        list(bulk_import.read_rows(str(bad)))
+    with pytest.raises(ValueError, match='bad.csv:1: .*type, record'):
+        bulk_import.bulk_import(phr.HOSPITAL('h'), [str(good), str(bad)])
+    assert phr.data_helper.backend.users() == []
+
+
+def test_values_that_are_not_strings_are_stored_as_json(tmp_path):
+    path = write_jsonl(tmp_path / 'rows.jsonl', [
+        {'patient': 'alice', 'type': 'lab', 'record': 'r1',
+         'fields': {'text': 'ok', 'count': 3, 'value': 1.5, 'fasting': True, 'flags': ['a']}},
+    ])
+
+    (_, _, _, fields), = bulk_import.read_rows(path)
+
+    assert fields == {'text': 'ok', 'count': '3', 'value': '1.5', 'fasting': 'true', 'flags': '["a"]'}
+
+
+def test_bulk_import_with_numbers(phr, tmp_path):
+    hospital = phr.HOSPITAL('h')
+    for user in (hospital, phr.USER('alice')):
+        phr.kgc_generate_user(user)
+    path = write_jsonl(tmp_path / 'rows.jsonl', [
+        {'patient': 'alice', 'type': 'lab', 'record': 'r1', 'fields': {'glucose': 5.4, 'fasting': True}},
+    ])
+
+    assert bulk_import.bulk_import(hospital, [path]) == 1
+    record = phr.read(phr.USER('alice'), 'reencryption_from_hospital_h_patient_alice_lab_r1')
+    assert (record['glucose'], record['fasting']) == (b'5.4', b'true')
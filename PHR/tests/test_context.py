@@ -0,0 +1,31 @@
+import pytest
+
+from context import Context
+
+
+def test_tipre_memos_are_kept_between_contexts(tmp_path):
+    pytest.importorskip('charm')
+    from charm.toolbox.pairinggroup import GT
+    memo_path = tmp_path / 'memo'
+    context = Context(tmp_path, tmp_path, 'SS512', memo_path)
+    _, params = context.pre.setup()
+    h1 = context.pre._H1('user_alice')
+    context.pre.encrypt1(params, context.group.random(GT), 'user_alice')
+    context.save_memo()
+
+    pre = Context(tmp_path, tmp_path, 'SS512', memo_path).pre
+    assert pre._H1('user_alice') == h1
+    assert pre.memo['H1'].stats()['hits'] == 1
+    assert len(pre.memo['pair']) == 1
+
+    # H1 is another function on another curve
+    assert len(Context(tmp_path, tmp_path, 'MNT224', memo_path).pre.memo['H1']) == 0
+
+
+def test_without_memo_path_nothing_is_written(tmp_path):
+    pytest.importorskip('charm')
+    context = Context(tmp_path, tmp_path, 'SS512')
+    context.pre._H1('user_alice')
+    context.save_memo()
+
+    assert list(tmp_path.iterdir()) == []
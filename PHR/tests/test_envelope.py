@@ -0,0 +1,44 @@
+import envelope
+
+
+def test_writer_records_for_patients_are_not_wrapped(phr, monkeypatch):
+    monkeypatch.setattr(phr, 'envelope_mode', True)
+    hospital, alice, bob = phr.HOSPITAL('h'), phr.USER('alice'), phr.USER('bob')
+    for user in (hospital, alice, bob):
+        phr.kgc_generate_user(user)
+
+    phr.insert_with_proxy(hospital, alice, {'data': 'for alice'}, 'record_alice', 'medical')
+    phr.insert_with_proxy(hospital, bob, {'data': 'for bob'}, 'record_bob', 'medical')
+
+    assert not envelope.is_envelope(phr.data_helper.load(hospital, 'record_bob')[phr.SYMKEY()])
+    assert phr.keks.epoch(hospital, 'medical') == 0
+    assert not phr.keks.exists(alice, hospital, 'medical', 1)
+    assert phr.read(bob, 'reencryption_from_hospital_h_record_bob')['data'] == b'for bob'
+
+
+def test_own_records_are_wrapped(phr, monkeypatch):
+    monkeypatch.setattr(phr, 'envelope_mode', True)
+    alice, insurer = phr.USER('alice'), phr.USER('insurer')
+    for user in (alice, insurer):
+        phr.kgc_generate_user(user)
+    phr.allow_access(alice, insurer, 'medical')
+
+    phr.insert(alice, {'data': 'claim'}, 'claim', 'medical', fan_out=True)
+
+    assert envelope.is_envelope(phr.data_helper.load(alice, 'claim')[phr.SYMKEY()])
+    assert phr.read(insurer, 'reencryption_from_user_alice_claim')['data'] == b'claim'
+
+
+def test_concurrently_started_epoch_uses_the_stored_kek(phr, monkeypatch):
+    monkeypatch.setattr(phr, 'envelope_mode', True)
+    alice = phr.USER('alice')
+    phr.kgc_generate_user(alice)
+    params, key = phr.get_params(), phr.load_user_key(alice)
+    epoch, kek = phr.current_kek(params, alice, key, 'medical')
+
+    # Another process that didn't see epoch 1 yet starts it as well
+    phr.keks.keks.clear()
+    with monkeypatch.context() as m:
+        m.setattr(phr.keks, 'epoch', lambda owner, type_attribute: 0)
+        assert phr.current_kek(params, alice, key, 'medical') == (epoch, kek)
+    assert phr.keks.epoch(alice, 'medical') == 1
@@ -0,0 +1,58 @@
+import proxy
+from delegations import DelegationIndex
+
+
+def test_hospital_insert_is_only_reencrypted_for_its_patient(phr):
+    hospital, alice, bob = phr.HOSPITAL('h'), phr.USER('alice'), phr.USER('bob')
+    for user in (hospital, alice, bob):
+        phr.kgc_generate_user(user)
+
+    phr.insert_with_proxy(hospital, bob, {'data': 'for bob'}, 'record_bob', 'medical')
+    phr.insert_with_proxy(hospital, alice, {'data': 'for alice'}, 'record_alice', 'medical')
+    phr.insert_many(hospital, [('record_alice_2', 'medical', {'data': 'for alice'})])
+
+    assert phr.data_helper.backend.list(bob) == ['reencryption_from_hospital_h_record_bob']
+    assert 'reencryption_from_hospital_h_record_alice' in phr.data_helper.backend.list(alice)
+    assert phr.read(alice, 'reencryption_from_hospital_h_record_alice')['data'] == b'for alice'
+
+
+def test_patient_insert_fans_out_to_their_delegatees(phr):
+    alice, insurer = phr.USER('alice'), phr.USER('insurer')
+    for user in (alice, insurer):
+        phr.kgc_generate_user(user)
+    phr.allow_access(alice, insurer, 'medical')
+
+    phr.insert(alice, {'data': 'claim'}, 'claim', 'medical', fan_out=True)
+
+    assert phr.read(insurer, 'reencryption_from_user_alice_claim')['data'] == b'claim'
+
+
+def test_delegation_index_sees_revocations_of_other_processes(phr):
+    alice, insurer = phr.USER('alice'), phr.USER('insurer')
+    for user in (alice, insurer):
+        phr.kgc_generate_user(user)
+    phr.allow_access(alice, insurer, 'medical')
+    other = DelegationIndex(phr.delegations.path)
+
+    assert phr.delegations.has(alice, 'medical', insurer)
+    other.remove(alice, 'medical', insurer)
+    assert not phr.delegations.has(alice, 'medical', insurer)
+    assert not phr.delegations.has(alice, 'lab', insurer)
+
+
+def test_reencrypt_all_reads_only_the_own_records_of_the_type(phr, monkeypatch):
+    alice, insurer = phr.USER('alice'), phr.USER('insurer')
+    for user in (alice, insurer):
+        phr.kgc_generate_user(user)
+    phr.insert(alice, {'data': 'claim'}, 'claim', 'medical')
+    phr.insert(alice, {'data': 'glucose'}, 'glucose', 'lab')
+    phr.allow_access(alice, insurer, 'medical')
+    phr.allow_access(insurer, alice, 'medical')
+    phr.insert(insurer, {'data': 'policy'}, 'policy', 'medical', fan_out=True)
+    loaded = []
+    load = phr.data_helper.load
+    monkeypatch.setattr(phr.data_helper, 'load', lambda user, record: loaded.append(record) or load(user, record))
+
+    assert proxy.reEncryptAll(alice, insurer, 'medical') == ['claim']
+    assert proxy.reEncryptRecords(alice, insurer, 'medical', ['glucose', 'reencryption_from_user_insurer_policy']) == []
+    assert loaded == ['claim']
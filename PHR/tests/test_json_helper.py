@@ -0,0 +1,56 @@
+import os
+
+import pairing_pickle
+import storage
+from json_helper import ORIGINAL, SYMKEY, DataHelper
+from metadata import MetadataIndex
+
+
+def data_helper(tmp_path):
+    backend = storage.FileBackend('{}/data/'.format(tmp_path))
+    return DataHelper(None, backend, MetadataIndex('{}/metadata.sqlite'.format(tmp_path)))
+
+
+def store(helper, user, name, data):
+    # Stored without the metadata, like records written before the index
+    helper.backend.write(user, name, pairing_pickle.dump2(None, data))
+
+
+def test_users_are_indexed_once_for_deletes(tmp_path, monkeypatch):
+    helper = data_helper(tmp_path)
+    store(helper, 'user_alice', 'record', {SYMKEY: {'C3': 'medical'}, 'data': b'a'})
+    store(helper, 'user_alice', 'other', {SYMKEY: {'C3': 'medical'}, 'data': b'b'})
+    store(helper, 'user_carol', 'other', {SYMKEY: {'C3': 'medical'}, 'data': b'c'})
+
+    helper.delete('user_alice', 'record')
+    assert helper.metadata.indexed('user_carol')
+    assert not helper.backend.exists('user_alice', 'record')
+
+    # The copies of later deletes, also of other processes, are counted on the index alone
+    helper = data_helper(tmp_path)
+    monkeypatch.setattr(helper.backend, 'users', None)
+    helper.delete('user_alice', 'other')
+    assert not helper.backend.exists('user_alice', 'other')
+
+
+def test_original_is_kept_for_a_copy_stored_before_the_index(tmp_path):
+    helper = data_helper(tmp_path)
+    store(helper, 'user_alice', 'record', {SYMKEY: {'C3': 'medical'}, 'data': b'a'})
+    store(helper, 'user_bob', 'reencryption_from_user_alice_record',
+          {SYMKEY: {}, ORIGINAL: {'owner': 'user_alice', 'record': 'record'}})
+    store(helper, 'user_carol', 'other', {SYMKEY: {'C3': 'medical'}, 'data': b'c'})
+
+    helper.delete('user_alice', 'record')
+    assert helper.backend.exists('user_alice', 'record')
+
+    helper.delete('user_bob', 'reencryption_from_user_alice_record')
+    assert not helper.backend.exists('user_alice', 'record')
+
+
+def test_rebuilt_metadata_has_the_time_of_the_stored_record(tmp_path):
+    helper = data_helper(tmp_path)
+    store(helper, 'user_alice', 'record', {SYMKEY: {'C3': 'medical'}, 'data': b'a'})
+    os.utime(helper.backend._existing('user_alice', 'record'), (1000, 1000))
+
+    metadata, = helper.list_records('user_alice')
+    assert metadata.created == 1000
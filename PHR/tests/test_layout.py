@@ -0,0 +1,35 @@
+import layout
+from layout import Layout
+
+
+def test_names_that_look_like_buckets_are_names(tmp_path):
+    base = tmp_path / 'data'
+    flat, bucketed = Layout(), Layout(depth=2, previous=Layout())
+    for name in ('3f', 'user_alice'):
+        flat.path(base, name).mkdir(parents=True)
+    bucketed.path(base, 'user_bob').mkdir(parents=True)
+
+    assert bucketed.names(base) == ['3f', 'user_alice', 'user_bob']
+    assert Layout(depth=2).names(base) == ['user_bob']
+
+
+def test_layouts_configured_before_the_prefix_keep_their_buckets():
+    legacy = Layout.from_dict({'roots': ['/data'], 'depth': 2, 'previous': None})
+    assert [len(bucket) for bucket in legacy.bucket('user_alice')] == [2, 2]
+    assert [len(bucket) for bucket in Layout(depth=2).bucket('user_alice')] == [3, 3]
+
+
+def test_lock_files_are_not_moved(tmp_path):
+    base = tmp_path / 'data'
+    user = Layout().path(base, 'user_alice')
+    user.mkdir(parents=True)
+    (user / 'record.rec').write_bytes(b'record')
+    (user / '.lock').touch()
+    lock = layout.lock_path(base, 'user_alice')
+    target = Layout(depth=2, previous=Layout())
+
+    assert layout._move(target, base, 'dir', False, ()) == 1
+    assert sorted(f.name for f in target.path(base, 'user_alice').iterdir()) == ['record.rec']
+    assert not user.exists()
+    assert layout.lock_path(base, 'user_alice') == lock and lock.parent.exists()
+    assert target.names(base) == ['user_alice']
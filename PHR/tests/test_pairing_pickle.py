@@ -0,0 +1,30 @@
+import math
+
+import pytest
+
+import pairing_pickle
+
+
+@pytest.mark.parametrize('value', [0.0, -1.5, 3.141592653589793, 1e308, math.inf])
+def test_floats_round_trip_in_the_binary_format(value):
+    obj = {'value': value, 'values': [value, 1, 'one']}
+
+    assert pairing_pickle.loadb(None, pairing_pickle.dumpb(None, obj)) == obj
+    assert pairing_pickle.load2(None, pairing_pickle.dump2(None, obj)) == obj
+
+
+def test_integers_beyond_64_bits_are_rejected():
+    with pytest.raises(TypeError):
+        pairing_pickle.dumpb(None, {'value': 2 ** 64})
+
+
+def test_serialized_elements_round_trip():
+    pytest.importorskip('charm')
+    from charm.toolbox.pairinggroup import G1, GT, PairingGroup
+    group = PairingGroup('SS512')
+    obj = {'C1': group.random(G1), 'C2': group.random(GT), 'C3': 'medical'}
+
+    serialized = pairing_pickle.serialize(group, obj)
+
+    assert all(isinstance(serialized[k], bytes) for k in ('C1', 'C2'))
+    assert pairing_pickle.deserialize(group, serialized) == obj
@@ -0,0 +1,33 @@
+import threading
+
+import pytest
+
+import proxy
+from proxy_client import ProxyClient, ProxyError
+
+
+@pytest.fixture
+def socket_path(tmp_path):
+    path = str(tmp_path / 'proxy.sock')
+    server = proxy.ProxyServer(path, processes=1)
+    thread = threading.Thread(target=server.serve_forever)
+    thread.start()
+    yield path
+    server.shutdown()
+    thread.join()
+    server.server_close()
+
+
+def test_pipelined_jobs_are_answered_in_order(socket_path):
+    with ProxyClient(socket_path) as client:
+        for op in ('ping', 'unknown', 'ping'):
+            client.submit(op)
+        first, error, last = client.results()
+
+    assert first == last == 'pong'
+    assert isinstance(error, ProxyError) and error.error == 'ValueError'
+
+
+def test_client_raises_when_the_service_is_not_running(tmp_path):
+    with pytest.raises(OSError):
+        ProxyClient(str(tmp_path / 'proxy.sock')).connect()
@@ -0,0 +1,108 @@
+import multiprocessing
+import os
+import threading
+import time
+
+import pytest
+
+import storage
+from storage import Segments
+
+
+@pytest.mark.parametrize('backend', [storage.FileBackend, storage.SegmentBackend])
+def test_backend_roundtrip(tmp_path, backend):
+    store = backend('{}/'.format(tmp_path))
+    store.write('alice', 'r1', b'one')
+    store.write('alice', 'r2', b'two')
+    with pytest.raises(storage.RecordAlreadyExists):
+        store.write('alice', 'r1', b'again')
+    store.delete('alice', 'r2')
+
+    assert bytes(store.read('alice', 'r1')) == b'one'
+    assert not store.exists('alice', 'r2')
+    assert store.list('alice') == ['r1']
+    assert store.list('bob') is None
+    assert store.users() == ['alice']
+
+
+def test_compact_keeps_the_live_records(tmp_path):
+    log = Segments(tmp_path / 'log', 64)
+    for i in range(10):
+        log.write('record{}'.format(i), 'payload{}'.format(i).encode() * 4)
+    for i in range(0, 10, 2):
+        log.delete('record{}'.format(i))
+    log.compact()
+
+    reopened = Segments(tmp_path / 'log', 64)
+    assert sorted(reopened.list()) == ['record{}'.format(i) for i in range(1, 10, 2)]
+    assert bytes(reopened.read('record3')) == b'payload3' * 4
+
+
+def test_compact_keeps_the_modification_times(tmp_path):
+    log = Segments(tmp_path / 'log', 64 * 1024)
+    log.write('record', b'payload')
+    log.write('deleted', b'payload')
+    log.delete('deleted')
+    os.utime(tmp_path / 'log' / '00000001.seg', (1000, 1000))
+    log.compact()
+
+    assert Segments(tmp_path / 'log', 64 * 1024).mtime('record') == 1000
+
+
+def test_migrate_copies_the_missing_records(tmp_path):
+    source = storage.FileBackend('{}/file/'.format(tmp_path))
+    target = storage.SegmentBackend('{}/segment/'.format(tmp_path))
+    source.write('alice', 'r1', b'one')
+    source.write('alice', 'r2', b'two')
+    target.write('alice', 'r1', b'one')
+
+    assert storage.migrate(source, target) == 1
+    assert bytes(target.read('alice', 'r2')) == b'two'
+
+
+def _write(path, count):
+    writer = Segments(path, 64 * 1024)
+    for i in range(count):
+        writer.write('record{}'.format(i), 'payload{}'.format(i).encode())
+
+
+def test_segments_read_by_threads_while_another_process_appends(tmp_path):
+    path, count = tmp_path / 'log', 2000
+    log = Segments(path, 64 * 1024)
+    writer = multiprocessing.get_context('fork').Process(target=_write, args=(path, count))
+    errors = []
+
+    def read():
+        try:
+            while writer.is_alive():
+                for name in log.list()[-20:]:
+                    assert log.exists(name)
+                    assert bytes(log.read(name)) == 'payload{}'.format(name[6:]).encode()
+                # Leave the writer some CPU time
+                time.sleep(0.001)
+        except Exception as e:
+            errors.append(e)
+
+    writer.start()
+    threads = [threading.Thread(target=read) for _ in range(8)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    writer.join()
+
+    assert writer.exitcode == 0
+    assert errors == []
+    assert sorted(log.list()) == sorted('record{}'.format(i) for i in range(count))
+
+
+@pytest.mark.parametrize('sync', [False, True])
+def test_group_commit_only_fsyncs_with_sync(tmp_path, monkeypatch, sync):
+    fsynced = []
+    monkeypatch.setattr(storage, 'fsync_path', fsynced.append)
+    backend = storage.FileBackend('{}/data/'.format(tmp_path), storage.Durability(sync))
+
+    with backend.durability.group():
+        backend.write('user_alice', 'record', b'payload')
+
+    assert bool(fsynced) == sync
@@ -0,0 +1,50 @@
+import pytest
+
+pytest.importorskip('charm')
+from charm.toolbox.pairinggroup import GT, PairingGroup, pair  # noqa: E402
+
+import type_id_proxy_reencryption  # noqa: E402
+from type_id_proxy_reencryption import TIPRE  # noqa: E402
+
+
+@pytest.fixture(params=['SS512', 'MNT224'])
+def tipre(request):
+    group = PairingGroup(request.param)
+    pre = TIPRE(group)
+    msk, params = pre.setup()
+    return group, pre, params, pre.keyGen(msk, 'Alice'), pre.keyGen(msk, 'Bob')
+
+
+def original_decrypt(group, params, skid, c):
+    """
+    The decryption of the paper: a direct ciphertext raises e(C1, skid) to
+    h(skid || t) in GT, a re-encrypted one decrypts x from R3 first
+    """
+    if 'Reencrypted' not in c:
+        return c['C2'] / (pair(c['C1'], skid['skid']) ** type_id_proxy_reencryption.h.hashToZr(skid['skid'], c['C3']))
+    x = c['C3']['C2'] / pair(c['C3']['C1'], skid['skid'])
+    return c['C2'] / pair(c['C1'], group.hash(x, type_id_proxy_reencryption.hash_group))
+
+
+def test_direct_decrypt_matches_the_original_formula(tipre):
+    group, pre, params, alice, _ = tipre
+    keys = [group.random(GT) for _ in range(3)]
+    ciphertexts = [pre.encrypt(params, 'Alice', key, alice, 'medical') for key in keys]
+    ciphertexts += pre.encrypt_many(params, 'Alice', keys, alice, 'medical')
+
+    # The second round decrypts with the memoized skid ^ h
+    for _ in range(2):
+        for key, ciphertext in zip(keys * 2, ciphertexts):
+            assert pre.decrypt(params, alice, ciphertext) == original_decrypt(group, params, alice, ciphertext) == key
+
+
+def test_reencrypted_decrypt_matches_the_original_formula(tipre):
+    group, pre, params, alice, bob = tipre
+    re_encryption_keys = [pre.rkGen(params, alice, 'Bob', 'medical') for _ in range(2)]
+    keys = [group.random(GT) for _ in range(3)]
+
+    # Every ciphertext after the first of a re-encryption key uses the memoized H2(x) of its R3
+    for re_encryption_key in re_encryption_keys:
+        for key in keys:
+            ciphertext = pre.reEncrypt(params, re_encryption_key, pre.encrypt(params, 'Alice', key, alice, 'medical'))
+            assert pre.decrypt(params, bob, ciphertext) == original_decrypt(group, params, bob, ciphertext) == key
@@ -0,0 +1,19 @@
+import pytest
+from docopt import docopt
+
+import user
+
+
+@pytest.mark.parametrize('argv, record, columns', [
+    (['read', '-u', 'bob', '-c', 'a'], None, ['a']),
+    (['read', 'health_data', '-u', 'bob', '-c', 'a', '-c', 'b'], 'health_data', ['a', 'b']),
+    (['read', 'health_data', '-u', 'bob', '--column=a'], 'health_data', ['a']),
+    (['read', '--all', '-u', 'bob', '-c', 'a', '-c', 'b', '--type=req2'], None, ['a', 'b']),
+    (['read', '-u', 'bob'], None, []),
+])
+def test_read_columns(argv, record, columns):
+    arguments = docopt(user.__doc__, argv=argv)
+
+    assert arguments['<user>'] == 'bob'
+    assert arguments['<record>'] == record
+    assert arguments['--column'] == columns
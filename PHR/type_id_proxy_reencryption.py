@@ -13,7 +13,10 @@ https://github.com/nikosft/IB-PRE/blob/master/pre_mg07a.py
 | Available from: http://link.springer.com/chapter/10.1007%2F978-3-540-72738-5_19
 
 * type:           proxy encryption (identity-based)
-* setting:        bilinear groups (symmetric)
+* setting:        bilinear groups (symmetric or asymmetric)
+
+On asymmetric curves the identities and x are hashed to G2, g is in G1 and
+every pairing takes its G1 argument first.
 
 :Authors:    N. Fotiou
 :Date:       7/2016
@@ -21,60 +24,189 @@ https://github.com/nikosft/IB-PRE/blob/master/pre_mg07a.py
 
 from charm.adapters.pkenc_adapt_hybrid import HybridEnc
 from charm.toolbox.hash_module import Hash
-from charm.toolbox.pairinggroup import GT, ZR, G1, pair
+from charm.toolbox.pairinggroup import GT, ZR, G1, G2, pair, pc_element
+import instrumentation
+from memo import LRUMemo
 
 debug = False
 
+# Curves of which G1 and G2 are the same group
+SYMMETRIC_CURVES = ('SS512', 'SS1024')
+
+
+def _hash_to_group(x):
+    if instrumentation.enabled:
+        instrumentation.count('hash_to_G1' if hash_group == G1 else 'hash_to_G2')
+    return group.hash(x, hash_group)
+
+
+def _hash_to_ZR(*args):
+    if instrumentation.enabled:
+        instrumentation.count('hash_to_ZR')
+    return h.hashToZr(*args)
+
 
 class TIPRE:
 
-    def __init__(self, groupObj, pkencObj=None):
-        global group, h, pkenc
+    def __init__(self, groupObj, pkencObj=None, memo_size=1024):
+        global group, hash_group, h, pkenc
         group = groupObj
+        # Keys of symmetric curves stay in G1, as they were before asymmetric curves
+        hash_group = G1 if group.groupType() in SYMMETRIC_CURVES else G2
         h = Hash(group)
         if pkencObj is not None:
             pkenc = HybridEnc(pkencObj, msg_len=20)
+        self._fixed_bases = {}
+        self.memo = {
+            'H1': LRUMemo(memo_size),  # H1(ID)
+            'pair': LRUMemo(memo_size),  # e(g_s, H1(ID))
+            'hashToZr': LRUMemo(memo_size),  # h(skid || t)
+            'H1x': LRUMemo(memo_size),  # H2(x) of re-encryption keys
+            'skid_h': LRUMemo(memo_size),  # skid ^ h(skid || t)
+            'R3': LRUMemo(memo_size),  # H2(x) of the R3 of a re-encryption key, decrypted with skid
+        }
+
+    def memo_stats(self):
+        return {name: memo.stats() for name, memo in self.memo.items()}
+
+    def dump_memo(self, outfile):
+        """
+        Persist the identity memos. Only public values (H1(ID) and the pairings)
+        are written, the memos derived from secret keys stay in memory.
+        """
+        self.memo['H1'].dump(group, outfile)
+        self.memo['pair'].dump(group, outfile)
+
+    def load_memo(self, infile):
+        self.memo['H1'].load(group, infile)
+        self.memo['pair'].load(group, infile)
+        for e in self.memo['pair'].values():
+            if not e.preproc:
+                e.initPP()
+
+    def _H1(self, ID):
+        return self.memo['H1'].get(ID, lambda: _hash_to_group(ID))
+
+    def _H1x(self, x):
+        return self.memo['H1x'].get(group.serialize(x), lambda: _hash_to_group(x))
+
+    def _hashToZr(self, skid, t):
+        key = (group.serialize(skid), group.serialize(t) if isinstance(t, pc_element) else t)
+        return self.memo['hashToZr'].get(key, lambda: _hash_to_ZR(skid, t))
+
+    def _skid_h(self, skid, t):
+        """
+        skid ^ h(skid || t), so a direct decryption is one pairing without an
+        exponentiation in GT: e(C1, skid) ^ h = e(C1, skid ^ h)
+        """
+        key = (group.serialize(skid), group.serialize(t) if isinstance(t, pc_element) else t)
+        return self.memo['skid_h'].get(key, lambda: skid ** self._hashToZr(skid, t))
+
+    def _R3(self, params, skid, R3):
+        """
+        H2(x) of the R3 of a re-encryption key. All ciphertexts that were
+        re-encrypted with one key carry the same R3, so x is decrypted once
+        per key instead of once per ciphertext.
+        """
+        key = (group.serialize(skid['skid']), group.serialize(R3['C1']), group.serialize(R3['C2']))
+        return self.memo['R3'].get(key, lambda: self._H1x(self.decrypt1(params, skid, R3)))
+
+    def _pair_id(self, tag, params, ID):
+        """
+        e(g_s, H1(ID)), with a fixed-base table because it is raised to a fresh
+        exponent for every ciphertext. Memoized per params (tag) and identity.
+        """
+
+        def compute():
+            e = pair(params['g_s'], self._H1(ID))
+            e.initPP()
+            return e
+
+        return self.memo['pair'].get((tag, ID), compute)
+
+    def precompute(self, params):
+        """
+        Build the windowed fixed-base exponentiation tables for g and g_s. The
+        tables are kept per set of public parameters, so params that are loaded
+        from disk again reuse the tables that were built before.
+
+        :param params:  Public parameters from setup
+        :return:        Params whose g and g_s exponentiate through the tables
+        """
+        return self._prepare(params)[1]
+
+    def _prepare(self, params):
+        tag = (group.serialize(params['g']), group.serialize(params['g_s']))
+        prepared = self._fixed_bases.get(tag)
+        if prepared is None:
+            prepared = dict(params)
+            for base in ('g', 'g_s'):
+                if not prepared[base].preproc:
+                    prepared[base].initPP()
+            self._fixed_bases[tag] = prepared
+        return tag[1], prepared
 
     def setup(self):
         s = group.random(ZR)
         g = group.random(G1)
+        g.initPP()
         msk = {'s': s}
-        params = {'g': g, 'g_s': g ** s}
+        params = self.precompute({'g': g, 'g_s': g ** s})
         return msk, params
 
     def keyGen(self, msk, ID):
-        k = group.hash(ID, G1) ** msk['s']  # H1(ID) ^ s
+        k = self._H1(ID) ** msk['s']  # H1(ID) ^ s
         return {'skid': k}
 
     def encrypt(self, params, ID, m, skid, t):
+        tag, params = self._prepare(params)
         r = h.group.random(ZR)
         C1 = params['g'] ** r
-        C2 = m * (pair(params['g_s'], group.hash(ID, G1)) ** (r * h.hashToZr(skid['skid'], t)))
+        C2 = m * (self._pair_id(tag, params, ID) ** (r * self._hashToZr(skid['skid'], t)))
         C3 = t
         return {'C1': C1, 'C2': C2, 'C3': C3}
 
+    def encrypt_many(self, params, ID, ms, skid, t):
+        """
+        Encrypt many messages for one identity and type. The pairing base and
+        h(skid || t) are computed once and combined into a single GT base, so
+        every message only costs two fixed-base exponentiations.
+        """
+        tag, params = self._prepare(params)
+        base = self._pair_id(tag, params, ID) ** self._hashToZr(skid['skid'], t)
+        if len(ms) >= 4:
+            base.initPP()
+        ciphertexts = []
+        for m in ms:
+            r = h.group.random(ZR)
+            ciphertexts.append({'C1': params['g'] ** r, 'C2': m * base ** r, 'C3': t})
+        return ciphertexts
+
     def encrypt1(self, params, m, ID):
+        tag, params = self._prepare(params)
         r = h.group.random(ZR)
         C1 = params['g'] ** r
-        C2 = m * pair(group.hash(ID, G1), params['g_s']) ** r
+        C2 = m * self._pair_id(tag, params, ID) ** r  # e(H1(ID), g_s) = e(g_s, H1(ID))
         return {'C1': C1, 'C2': C2}
 
     def decrypt1(self, params, skid, c):
-        return c['C2'] / pair(skid['skid'], c['C1'])
+        return c['C2'] / pair(c['C1'], skid['skid'])
 
     def decrypt(self, params, skid, cid):
+        # Both cases are a single pairing. The two pairings of a re-encrypted
+        # ciphertext can't share a multi-pairing, the second one is on H2(x)
+        # of the first; the first is memoized per re-encryption key instead.
         if len(cid) == 3:
-            m = cid['C2'] / (pair(cid['C1'], skid['skid']) ** h.hashToZr(skid['skid'], cid['C3']))
+            m = cid['C2'] / pair(cid['C1'], self._skid_h(skid['skid'], cid['C3']))
         if len(cid) == 4:
-            x = self.decrypt1(params, skid, cid['C3'])
-            m = cid['C2'] / pair(cid['C1'], group.hash(x, G1))
+            m = cid['C2'] / pair(cid['C1'], self._R3(params, skid, cid['C3']))
         return m
 
     def rkGen(self, params, skid_i, id_j, t):
         x = group.random(GT)
         return {
             'R1': t,
-            'R2': skid_i['skid'] ** (-h.hashToZr(skid_i['skid'], t)) * group.hash(x, G1),  # sk ^(-h1(sk||t)) * h2(x)
+            'R2': skid_i['skid'] ** (-self._hashToZr(skid_i['skid'], t)) * _hash_to_group(x),  # sk ^(-h1(sk||t)) * h2(x)
             'R3': self.encrypt1(params, x, id_j)  # Encrypt2(x, idj)
         }
 
@@ -88,7 +220,7 @@ class TIPRE:
 
 
 if __name__ == '__main__':
-    from charm.toolbox.pairinggroup import PairingGroup, GT, extract_key
+    from charm.toolbox.pairinggroup import PairingGroup, extract_key
     from charm.toolbox.symcrypto import SymmetricCryptoAbstraction
 
     group = PairingGroup('SS512', secparam=1024)
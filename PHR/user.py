@@ -2,55 +2,80 @@
 
 Usage:
     user.py
-    user.py read <record> -u <user> 
-    user.py read -u <user> 
-    user.py insert <data> -u <user> -t <type> -r <record>
-    user.py new <user>
-    user.py allow-access -u <user> -p <to_user> -t <type> -r <record>
+    user.py read (<record> -u <user> | -u <user> | --all -u <user> [--type=<type>] [--writer=<writer>] [--processes=<n>])
+                 [-c <column>]... [--profile=<format>]
+    user.py delete <record> -u <user> [--profile=<format>]
+    user.py list -u <user> [--type=<type>] [--writer=<writer>] [--limit=<n>] [--offset=<n>] [--profile=<format>]
+    user.py insert <data> -u <user> -t <type> -r <record> [--profile=<format>]
+    user.py new <user> [--profile=<format>]
+    user.py allow-access -u <user> -p <to_user> -t <type> -r <record> [--profile=<format>]
+    user.py rotate-key -u <user> -t <type> [--profile=<format>]
+
 
-    
 Options:
     -h --help                       Show this screen.
     -v --version                    Show version.
     -r<record> --record=<record>    Execute command for a specific public health record.
     -t<type> --type=<type>          Specify type of data.
+    -c <column>, --column=<column>  Only decrypt this column, can be given more than once.
+    --all                           Read all records, or all records of the type or writer.
+    --processes=<n>                 Number of worker processes to decrypt with.
+    --writer=<writer>               List or read the records written by this user, like hospital_<hospital>.
+    --limit=<n>                     Number of records to list.
+    --offset=<n>                    Number of records to skip.
+    --profile=<format>              Print operation counts and stage timings to stderr, as json or prometheus.
 """
-from subprocess import call
-
+import instrumentation
 from docopt import docopt
 
 import PHR
 
 
 def read(arguments):
-    data = PHR.read(PHR.USER(arguments['<user>']), arguments['<record>'])
+    data = PHR.read(PHR.USER(arguments['<user>']), arguments['<record>'], arguments['--column'] or None)
     print(data)
 
 
+def read_all(arguments):
+    for record, data in PHR.read_all(PHR.USER(arguments['<user>']), arguments['--column'] or None,
+                                     int(arguments['--processes']) if arguments['--processes'] else None,
+                                     type_attribute=arguments['--type'], writer=arguments['--writer']):
+        print('{}: {}'.format(record, data))
+
+
 if __name__ == '__main__':
     arguments = docopt(__doc__, version='0.1')
-    if arguments['read'] and arguments['<user>']:
-        if arguments['<record>'] is not None:
-            read(arguments)
+    with instrumentation.cli_profile(arguments['--profile'], lambda: PHR.group):
+        if arguments['read'] and arguments['<user>']:
+            if arguments['--all']:
+                read_all(arguments)
+            elif arguments['<record>'] is not None:
+                read(arguments)
+            else:
+                print(PHR.select_file(PHR.USER(arguments['<user>']), arguments['--column'] or None))
+        elif arguments['delete']:
+            PHR.delete(PHR.USER(arguments['<user>']), arguments['<record>'])
+        elif arguments['list']:
+            PHR.list_records(PHR.USER(arguments['<user>']), arguments['--type'], arguments['--writer'],
+                             int(arguments['--limit']) if arguments['--limit'] else None,
+                             int(arguments['--offset'] or 0))
+        elif arguments['insert']:
+            # A patient's own delegatees are the parties they allowed access
+            PHR.insert(PHR.USER(arguments['<user>']), {'data': arguments['<data>']}, arguments['<record>'],
+                       arguments['<type>'], fan_out=True)
+        elif arguments['new']:
+            print('Creating new user {}'.format(arguments['<user>']))
+            PHR.kgc_generate_user(PHR.USER(arguments['<user>']))
+        elif arguments['allow-access']:
+            PHR.allow_access('user_{}'.format(arguments['<user>']), 'user_{}'.format(arguments['<to_user>']),
+                             arguments['<type>'])
+
+            # Call the proxy to reencrypt the just created ciphertext
+            PHR.reencrypt_with_proxy('user_{}'.format(arguments['<user>']), 'user_{}'.format(arguments['<to_user>']),
+                                     arguments['<record>'], arguments['<type>'])
+        elif arguments['rotate-key']:
+            user = PHR.USER(arguments['<user>'])
+            epoch = PHR.rotate_kek(PHR.get_params(), user, PHR.load_user_key(user), arguments['<type>'])
+            print('Records of type {} of {} are now written in epoch {}'.format(arguments['<type>'], user, epoch))
         else:
-            print(PHR.select_file(PHR.USER(arguments['<user>'])))
-    elif arguments['insert']:
-        PHR.insert(PHR.USER(arguments['<user>']), {'data': arguments['<data>']}, arguments['<record>'],
-                   arguments['<type>'])
-    elif arguments['new']:
-        print('Creating new user {}'.format(arguments['<user>']))
-        PHR.kgc_generate_user(PHR.USER(arguments['<user>']))
-    elif arguments['allow-access']:
-        PHR.allow_access('user_{}'.format(arguments['<user>']), 'user_{}'.format(arguments['<to_user>']),
-                         arguments['<type>'])
-
-        # Call the proxy to reencrypt the just created ciphertext
-        arguments = "python3 proxy.py reencrypt {} {} -r {} -t {}".format(
-            'user_{}'.format(arguments['<user>']),
-            'user_{}'.format(arguments['<to_user>']),
-            arguments['<record>'],
-            arguments['<type>']
-        )
-        call(arguments.split(' '))
-    else:
-        print(__doc__)
+            print(__doc__)